@@ -1,13 +1,26 @@
 import os
 import json
+import time
 import base64
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 
 # Constants
 BASE_SAVE_DIRECTORY = "./received_inference_results"
 SERVER_URL = "http://your ip:8000"  # Replace with your server's URL and port
+# Base64 text is decoded in pieces of this many characters (a multiple of 4) when saving files
+BASE64_DECODE_CHUNK_SIZE = 4 * 1024 * 1024
+# Result files are downloaded in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Pending results are fetched RESULTS_PAGE_SIZE at a time, PAGE_FETCH_WORKERS pages in parallel
+RESULTS_PAGE_SIZE = 50
+PAGE_FETCH_WORKERS = 4
+# Listen on the server's /events stream for new results instead of exiting after one pass
+LISTEN_FOR_EVENTS = True
+EVENT_READ_TIMEOUT = 60  # Seconds without data (the server sends keep-alives) before reconnecting
+EVENT_RECONNECT_DELAY = 3
 
 # Set up logging
 log_file = "client_receiver.log"
@@ -21,33 +34,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# One keep-alive connection pool for all requests to the server
+session = requests.Session()
+
 def save_file(file_content_base64, save_path):
-    """Save base64 encoded file content to disk."""
+    """Save base64 encoded file content to disk. Returns True on success."""
     try:
         #logger.info(f"Attempting to save file at {save_path}")
-        file_content = base64.b64decode(file_content_base64)
-        logger.debug(f"Decoded base64 content, length: {len(file_content)} bytes")
-        
         # Ensure the directory exists
         directory = os.path.dirname(save_path)
         os.makedirs(directory, exist_ok=True)
         
-        # Save the file
+        # Decode and save the file piece by piece so the decoded file is never held in memory at once
+        decoded_length = 0
         with open(save_path, "wb") as f:
-            f.write(file_content)
+            for start in range(0, len(file_content_base64), BASE64_DECODE_CHUNK_SIZE):
+                chunk = base64.b64decode(file_content_base64[start:start + BASE64_DECODE_CHUNK_SIZE])
+                f.write(chunk)
+                decoded_length += len(chunk)
+        logger.debug(f"Decoded base64 content, length: {decoded_length} bytes")
         #logger.info(f"Successfully saved file at {save_path}")
         
         # Verify the file was saved correctly
         if os.path.exists(save_path):
             logger.info(f"File verified at {save_path}")
-        else:
-            logger.error(f"File not found at {save_path} after saving attempt")
+            return True
+        logger.error(f"File not found at {save_path} after saving attempt")
+        return False
     except Exception as e:
         logger.error(f"Error saving file at {save_path}: {str(e)}")
         logger.exception("Detailed error information:")
+        return False
+
+def download_file(file_info, save_path):
+    """
+    Stream a result file from its /files/... URL to disk.
+    An interrupted download is kept as a .part file and resumed with a Range request.
+    Returns True on success.
+    """
+    try:
+        directory = os.path.dirname(save_path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Skip files that are already complete
+        if os.path.exists(save_path) and os.path.getsize(save_path) == file_info.get("size"):
+            logger.info(f"File already downloaded at {save_path}")
+            return True
+
+        part_path = f"{save_path}.part"
+        headers = {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            # Resume only if the file on the server has not changed since the partial download
+            headers = {"Range": f"bytes={offset}-", "If-Range": file_info.get("etag", "")}
+
+        with session.get(f"{SERVER_URL}{file_info['url']}", headers=headers, stream=True) as response:
+            if response.status_code == 200:
+                mode = "wb"  # Full body: start over
+            elif response.status_code == 206:
+                mode = "ab"
+            else:
+                logger.error(f"Failed to download {file_info['url']}: {response.status_code}")
+                return False
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        os.replace(part_path, save_path)
+        logger.info(f"File verified at {save_path}")
+        return True
+    except Exception as e:
+        logger.error(f"Error downloading file to {save_path}: {str(e)}")
+        logger.exception("Detailed error information:")
+        return False
 
 def process_inference_result(user_id, result):
-    """Process a single inference result and save its files."""
+    """Process a single inference result and save its files. Returns True when every file was saved."""
     try:
         #logger.info(f"Processing inference result for user {user_id}")
         #logger.debug(f"Result content: {result}")
@@ -60,54 +121,105 @@ def process_inference_result(user_id, result):
 
         if not all([project_number, floor_number, image_name]):
             logger.error(f"Missing required information in result: {result}")
-            return
+            return True  # Malformed results are skipped so they do not block the acknowledgement
 
         if not files:
             logger.error(f"No files received for image: {image_name}. Skipping processing.")
-            return  # Skip further processing if no files are available
+            return True  # Skip further processing if no files are available
         
         base_path = BASE_SAVE_DIRECTORY
+        saved = True
         
         # Loop through all the files received and save them dynamically
-        for key, file_content_base64 in files.items():
+        for key, file_content in files.items():
             if key in filenames:
                 filename = filenames[key]
                 # Dynamically save the file in the corresponding folder structure
                 save_path = os.path.join(base_path, user_id, project_number, f"floor_{floor_number}", os.path.splitext(image_name)[0], key, filename)
                 #logger.info(f"Saving file: {key} as {filename}")
-                save_file(file_content_base64, save_path)
+                if isinstance(file_content, dict):
+                    # The server sends file metadata; the contents are downloaded separately
+                    saved = download_file(file_content, save_path) and saved
+                else:
+                    # Older servers embed the file as base64
+                    saved = save_file(file_content, save_path) and saved
             else:
                 logger.warning(f"Filename not found for key {key}")
         
         logger.info(f"Processed and saved files for user: {user_id}, project: {project_number}, floor: {floor_number}, image: {image_name}")
+        return saved
     except Exception as e:
         logger.error(f"Error processing inference result: {str(e)}")
         logger.error(f"Problematic result: {result}")
         logger.exception("Detailed error information:")
+        return False
+
+def fetch_results_page(user_id, cursor=None):
+    """
+    Fetch one page of pending results after cursor (after the last acknowledged result when None).
+    Returns the page, or None when there are no results or the request failed.
+    """
+    params = {"limit": RESULTS_PAGE_SIZE}
+    if cursor is not None:
+        params["cursor"] = cursor
+    # Stream the body so it is parsed straight from the socket instead of being buffered first
+    with session.get(f"{SERVER_URL}/get_inference_results/{user_id}", params=params, stream=True) as response:
+        if response.status_code == 200:
+            response.raw.decode_content = True
+            return json.load(response.raw)
+        if response.status_code == 204:
+            return None
+        logger.error(f"Failed to get results page after cursor {cursor} for user {user_id}: {response.status_code}")
+        logger.debug(f"Response content: {response.text}")
+        return None
+
+def receive_results_page(user_id, cursor):
+    """Fetch the page after cursor and save its files. Returns a list of (seq, saved) pairs."""
+    page = fetch_results_page(user_id, cursor)
+    if page is None:
+        return []
+    return [(result["seq"], process_inference_result(user_id, result)) for result in page["results"]]
+
+def acknowledge_results(user_id, cursor):
+    """Tell the server that every result up to and including cursor has been saved."""
+    response = session.post(f"{SERVER_URL}/ack_inference_results/{user_id}", data={"cursor": cursor})
+    if response.status_code == 200:
+        logger.info(f"Acknowledged {response.json().get('acknowledged')} results for user {user_id} up to {cursor}")
+    else:
+        logger.error(f"Failed to acknowledge results for user {user_id}: {response.status_code}")
 
 def receive_inference_results(user_id):
-    """Receive historical inference results for a specific user."""
+    """
+    Receive the pending inference results for a specific user.
+    The first page tells how many results are pending; sequence numbers are consecutive, so the remaining
+    pages are fetched in parallel. Results are acknowledged up to the first one that could not be saved.
+    Returns the acknowledged cursor, or None when nothing was acknowledged.
+    """
     try:
-        url = f"{SERVER_URL}/get_inference_results/{user_id}"  # Construct URL with user_id
-        #logger.info(f"Requesting inference results from server for user {user_id}: {url}")
-        response = requests.get(url)
-        
-        #logger.info(f"Server response status code: {response.status_code}")
-        #logger.debug(f"Server response content: {response.text}")
-        
-        if response.status_code == 200:
-            results = response.json()
-            logger.info(f"Received inference results for user: {user_id}. Processing...")
-            #logger.debug(f"Results content: {results}")
-            for result in results:
-                process_inference_result(user_id, result)
-            logger.info(f"All files for user {user_id} have been processed.")
-        elif response.status_code == 204:
+        first_page = fetch_results_page(user_id)
+        if first_page is None:
             logger.info(f"No new inference results available for user {user_id}.")
-        else:
-            logger.error(f"Failed to get response from server for user {user_id}: {response.status_code}")
-            logger.debug(f"Response content: {response.text}")
-    
+            return None
+        logger.info(f"Received inference results for user: {user_id}. Processing...")
+
+        cursors = range(first_page["next_cursor"], first_page["last_seq"], RESULTS_PAGE_SIZE)
+        outcomes = [(result["seq"], process_inference_result(user_id, result)) for result in first_page["results"]]
+        with ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS) as pool:
+            for page_outcomes in pool.map(lambda cursor: receive_results_page(user_id, cursor), cursors):
+                outcomes.extend(page_outcomes)
+
+        # Acknowledge only the unbroken run of saved results so a failed one is fetched again next time
+        ack_cursor = first_page["cursor"]
+        for seq, saved in sorted(outcomes):
+            if not saved or seq != ack_cursor + 1:
+                break
+            ack_cursor = seq
+        logger.info(f"All files for user {user_id} have been processed.")
+        if ack_cursor > first_page["cursor"]:
+            acknowledge_results(user_id, ack_cursor)
+            return ack_cursor
+        return None
+
     except requests.RequestException as e:
         logger.error(f"Error occurred while receiving data from the server for user {user_id}: {str(e)}")
         logger.exception("Detailed error information:")
@@ -122,7 +234,7 @@ def get_users_with_results():
     """Retrieve the list of users who have results available from the server."""
     try:
         url = f"{SERVER_URL}/get_users_with_results"
-        response = requests.get(url)
+        response = session.get(url)
         logger.info(f"Requesting list of users with results from server: {url}")
         
         if response.status_code == 200:
@@ -137,17 +249,74 @@ def get_users_with_results():
         logger.exception("Detailed error information:")
         return []
 
-def main():
-    """Main function to dynamically retrieve file results for all users with pending results."""
+def receive_all_results():
+    """Retrieve the pending results of every user that has any. Returns {user_id: acknowledged cursor}."""
     users_with_results = get_users_with_results()
     
     if not users_with_results:
         logger.info("No users with results found.")
-        return
+        return {}
     
-    # Loop through each user ID and get their historical results
-    for user_id in users_with_results:
-        receive_inference_results(user_id)
+    # Loop through each user ID and get their pending results
+    return {user_id: receive_inference_results(user_id) for user_id in users_with_results}
+
+def iter_sse_events(response):
+    """Yield (event type, event id, data) for each Server-Sent Event in a streamed response."""
+    event_type, event_id, data_lines = "message", None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            if line.startswith(":"):
+                continue  # Comment, used by the server as keep-alive
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event_type = value
+            elif field == "id":
+                event_id = value
+            elif field == "data":
+                data_lines.append(value)
+        elif data_lines:
+            yield event_type, event_id, json.loads("\n".join(data_lines))
+            event_type, event_id, data_lines = "message", None, []
+
+def listen_for_results():
+    """
+    Receive results as the server announces them on /events.
+    The last event ID is sent back on reconnect so missed events are replayed; a "resync" event
+    (sent on the first connection too) triggers a full pass over every user's pending results.
+    """
+    last_event_id = None
+    acked = {}  # user_id -> highest acknowledged sequence number
+    while True:
+        headers = {"Accept": "text/event-stream"}
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        try:
+            with session.get(f"{SERVER_URL}/events", headers=headers, stream=True, timeout=(10, EVENT_READ_TIMEOUT)) as response:
+                if response.status_code != 200:
+                    logger.error(f"Failed to open the event stream: {response.status_code}")
+                else:
+                    logger.info("Listening for inference results")
+                    for event_type, event_id, data in iter_sse_events(response):
+                        if event_type == "resync":
+                            for user_id, cursor in receive_all_results().items():
+                                acked[user_id] = max(acked.get(user_id) or 0, cursor or 0)
+                        elif event_type == "result" and data["seq"] > acked.get(data["user_id"], 0):
+                            # One fetch picks up every pending result, so later events for them are skipped
+                            cursor = receive_inference_results(data["user_id"])
+                            acked[data["user_id"]] = max(acked.get(data["user_id"], 0), cursor or 0)
+                        if event_id:
+                            last_event_id = event_id
+        except requests.RequestException as e:
+            logger.warning(f"Event stream interrupted: {str(e)}")
+        time.sleep(EVENT_RECONNECT_DELAY)
+
+def main():
+    """Main function to retrieve file results for all users, then keep receiving them as they are produced."""
+    if LISTEN_FOR_EVENTS:
+        listen_for_results()
+    else:
+        receive_all_results()
 
 if __name__ == "__main__":
     main()
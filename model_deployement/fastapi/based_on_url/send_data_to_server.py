@@ -1,10 +1,16 @@
 import requests
 import random
+import time
 from datetime import datetime
 import os
 
 # Remote server URL
-REMOTE_SERVER_URL = "http://your ip:port/receive_data"
+SERVER_URL = "http://your ip:port"
+REMOTE_SERVER_URL = f"{SERVER_URL}/receive_data"
+
+# How often and how long to poll a queued job for its result
+JOB_POLL_INTERVAL = 2
+JOB_POLL_TIMEOUT = 600
 
 # Get the absolute path of the script's directory
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +31,16 @@ USER_DATA = {
     ],
 }
 
+def wait_for_job(result_url):
+    """Poll a queued job until the server reports it as done or failed."""
+    deadline = time.time() + JOB_POLL_TIMEOUT
+    while time.time() < deadline:
+        response = requests.get(f"{SERVER_URL}{result_url}")
+        if response.status_code != 202:
+            return response
+        time.sleep(JOB_POLL_INTERVAL)
+    raise TimeoutError(f"Job did not finish within {JOB_POLL_TIMEOUT} seconds: {result_url}")
+
 def send_data(user_id, project_data, floor_number):
     try:
         # Check if the image file exists
@@ -48,6 +64,11 @@ def send_data(user_id, project_data, floor_number):
             print(f"Sending data for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number}...")
             response = requests.post(REMOTE_SERVER_URL, files=files, data=payload)
 
+            # The server queues the upload and answers with a job to follow
+            if response.status_code == 202:
+                print(f"Upload queued as job {response.json()['job_id']}, waiting for the result...")
+                response = wait_for_job(response.json()["result_url"])
+
             # Handle the response from the server
             if response.status_code == 200:
                 print(f"Successfully uploaded data for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number} to the remote server.")
@@ -1,26 +1,252 @@
 import os
+import asyncio
 import json
 import base64
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+import functools
+import multiprocessing
+import shutil
+import socket
+import sys
+import tempfile
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from multiprocessing import resource_tracker
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from datetime import datetime
+from typing import List
+from urllib.parse import quote
 import logging
 from logging.handlers import RotatingFileHandler
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 # Import the FloorPlanProcessor from the correct module, ensuring it handles image processing
 from src.utils.processor import FloorPlanProcessor # this is from AI model module
+# The serving machinery shared with the zipfile server lives one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from floorplan_serving import (
+    ENCODE_SECONDS, INFERENCE_STAGE_SECONDS, PRIORITY_CLASSES, STORE_SECONDS, ArtifactRetention, FairScheduler,
+    MicroBatcher, ResultCache, ResultLog, SingleWriterRegistry, SqliteResultLog, StagedPipeline, TiledInference,
+    check_stage_methods, claim_sqlite_job, create_processed_image_registry, duplicate_base_names,
+    extract_archive_images, health_response, read_result_manifest, record_request_metrics, register_state_collector,
+    resolve_processor_config, run_image_batch, save_upload_file, write_result_manifest
+)
 
 
 # Base directory for all uploaded files
 BASE_UPLOAD_DIRECTORY = "/home/cadian/project/ai_ce_main/receive_data"
 
-# File to track processed images and inference results
+# Legacy JSON files for processed images and inference results; the SQLite registry and the result log import them once
 PROCESSED_IMAGES_FILE = "processed_images.json"
 INFERENCE_RESULTS_FILE = "inference_results.json"
+# Pending inference results are kept per user in this directory until the client acknowledges them
+RESULTS_DIRECTORY = "inference_results"
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 500
+# Each user's log is split into segments of about RESULTS_SEGMENT_BYTES; the oldest segment is compacted
+# once more than RESULTS_COMPACT_RATIO of its results are acknowledged
+RESULTS_SEGMENT_BYTES = 4 * 1024 * 1024
+RESULTS_COMPACT_RATIO = 0.5
+# Sync every appended result to disk before it is reported; concurrent appends share one fsync
+RESULTS_FSYNC = True
+# Each processed image folder gets a manifest of the files in RESULT_FOLDERS (path, size, SHA-256 and content type),
+# written once after inference; result records and /files downloads are served from it instead of probing the folder
+RESULT_MANIFEST_FILENAME = "manifest.json"
+RESULT_FOLDERS = ('json', 'images', 'cropped', 'original_img')
+# Result events pushed over /events: how many recent events are kept for reconnecting clients,
+# and how often an idle stream gets a keep-alive comment
+RESULT_EVENT_BUFFER = 1000
+EVENT_KEEPALIVE_SECONDS = 15
+
+# Processed-image registry backend: "sqlite" (indexed, concurrency-safe) or "json" (legacy file)
+PROCESSED_IMAGES_BACKEND = "sqlite"
+PROCESSED_IMAGES_DB = "processed_images.db"
+# Registry writes from all threads go through one writer thread, which merges the writes arriving within
+# REGISTRY_WRITE_MAX_WAIT_MS into one transaction (one file rewrite for the json backend)
+REGISTRY_SINGLE_WRITER = True
+REGISTRY_WRITE_MAX_BATCH = 256
+REGISTRY_WRITE_MAX_WAIT_MS = 5
+
+# Job queue limits: uploads beyond JOB_QUEUE_MAX_SIZE unfinished jobs are rejected with 429
+JOB_QUEUE_MAX_SIZE = 100
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+# A shared-broker job stays pending until its upload is saved; a pending job this old belongs to an API pod
+# that died mid-upload and is deleted so it no longer holds a queue slot
+JOB_PENDING_TIMEOUT_SECONDS = 60 * 60
+# /health/ready fails while the models load, while draining, and when more jobs than this wait for a worker
+READINESS_MAX_QUEUED_JOBS = 50
+# On shutdown, queued and running jobs get this long to finish before the queued ones are cancelled
+DRAIN_TIMEOUT_SECONDS = 300
+# Open connections get this long to close on shutdown before they are cut
+SHUTDOWN_CONNECTION_TIMEOUT_SECONDS = 30
+# Scheduling of jobs. Each upload runs in a priority class, set by its priority form field or else the default of
+# its endpoint; queued interactive jobs always start before bulk ones, and SCHEDULER_INTERACTIVE_RESERVED_WORKERS
+# executor workers never run bulk jobs, so a backfill cannot hold them all. Within a class, users take turns
+# (and the projects of a user), each running at most SCHEDULER_MAX_RUNNING_PER_USER jobs. The classes themselves,
+# highest first, are PRIORITY_CLASSES in floorplan_serving.
+SCHEDULER_INTERACTIVE_RESERVED_WORKERS = 1
+SCHEDULER_MAX_RUNNING_PER_USER = 2
+# Queue-time objective of each class: jobs that waited longer for a worker count as SLO misses on /metrics
+SCHEDULER_QUEUE_SLO_SECONDS = {"interactive": 2, "bulk": 600}
+# Images of a batch job in the micro-batcher or worker processes at once, so it does not delay the images of others
+BATCH_IMAGES_IN_FLIGHT = 8
+
+# Scale-out: "standalone" servers take uploads and run their jobs. With a shared JOB_BROKER, "api" pods only take
+# uploads and serve jobs and results, while "worker" pods load the models and run the queued jobs, so both tiers
+# scale on their own. The role is read from the SERVER_ROLE environment variable so one image serves both tiers.
+SERVER_ROLE = os.environ.get("SERVER_ROLE", "standalone")
+# "local" keeps jobs in this process; "sqlite" keeps jobs and results in JOB_BROKER_DB, which every pod must reach
+# on shared storage together with BASE_UPLOAD_DIRECTORY and the registry
+JOB_BROKER = "local"
+JOB_BROKER_DB = "jobs.db"
+# A job claimed by a worker that stops renewing its lease (e.g. the pod died) is queued again after this long
+JOB_LEASE_SECONDS = 120
+# How often idle workers look for queued jobs, and API pods for results to push to /events
+JOB_POLL_SECONDS = 1
+
+# Uploads are streamed to disk in chunks and rejected with 413 beyond MAX_UPLOAD_BYTES
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+# /receive_batch takes up to BATCH_UPLOAD_MAX_IMAGES images per request, as files or in a ZIP archive whose
+# extracted images may not exceed MAX_UPLOAD_BYTES
+BATCH_UPLOAD_MAX_IMAGES = 200
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Result files are served from /files/... in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Micro-batching window: images arriving within BATCH_MAX_WAIT_MS are sent to the processor together
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 20
+# Only processors that provide process_batch are micro-batched; otherwise process_image runs on up to this many
+# images at once, and a failed batch is retried one image per thread
+INFERENCE_THREADS = 5
+
+# Where inference runs: "thread" shares one FloorPlanProcessor across the executor threads,
+# "process" sends every image to one of WORKER_PROCESSES worker processes that each hold their own models
+EXECUTION_MODE = "thread"
+# Model threads (torch and ONNX Runtime) per worker process; WORKER_PROCESSES x WORKER_THREADS should not exceed the cores
+WORKER_THREADS = 2
+WORKER_PROCESSES = max((os.cpu_count() or 1) // WORKER_THREADS, 1)
+# Pin each worker process to its own WORKER_THREADS cores, so the workers do not compete for them (Linux only)
+WORKER_CPU_AFFINITY = True
+# "forkserver" and "spawn" start the workers from a fresh interpreter that loads its own models. "fork" lets them
+# start from the parent's loaded models (copy-on-write), but forks a server that already runs threads (executor,
+# micro-batcher, model thread pools), so a worker can deadlock on a lock one of them held at the time
+WORKER_START_METHOD = "forkserver"
+# Image used for the warm-up inference at startup; a blank page is generated when None
+WARMUP_IMAGE_PATH = None
+
+# How images run through the models: "batched" micro-batches them (see INFERENCE_THREADS), "staged" runs crop,
+# segmentation, detection and OOB as pipeline stages with their own workers and bounded queues
+INFERENCE_PIPELINE = "batched"
+PIPELINE_STAGE_WORKERS = 1
+PIPELINE_QUEUE_SIZE = 16
+# FloorPlanProcessor methods used for each pipeline stage and tile; each is called like process_image and writes
+# the files process_image writes for its stage (see check_stage_methods). They are checked on a test image at
+# startup, and whole images run on the "batched" path when they fail
+PIPELINE_STAGE_METHODS = {
+    "crop": "crop_background",
+    "segmentation": "segment",
+    "detection": "detect",
+    "oob": "detect_oob"
+}
+
+# Content-addressed cache of inference outputs, keyed by the image bytes and the model files
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_DIRECTORY = "result_cache"
+RESULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Retention of the upload tree: request folders unused for RETENTION_MAX_AGE_SECONDS are deleted, then the oldest ones
+# while a user holds more than RETENTION_MAX_USER_BYTES or the tree more than RETENTION_MAX_TOTAL_BYTES (None disables
+# a limit). Folders used in the last RETENTION_MIN_AGE_SECONDS are always kept. Sizes are kept in RETENTION_INDEX_DB.
+RETENTION_ENABLED = True
+RETENTION_INDEX_DB = "artifacts.db"
+RETENTION_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+RETENTION_MAX_USER_BYTES = 50 * 1024 ** 3
+RETENTION_MAX_TOTAL_BYTES = 500 * 1024 ** 3
+RETENTION_MIN_AGE_SECONDS = 60 * 60
+RETENTION_SWEEP_INTERVAL_SECONDS = 10 * 60
+
+# Tiled inference for large scans: cropped plans of TILE_MIN_IMAGE_SIZE pixels or more on a side are cut into
+# TILE_SIZE tiles overlapping by TILE_OVERLAP pixels (keep it above the largest fixture), run on TILE_WORKERS threads
+TILED_INFERENCE_ENABLED = False
+TILE_SIZE = 1536
+TILE_OVERLAP = 256
+TILE_MIN_IMAGE_SIZE = 4096
+TILE_WORKERS = 2
+# Detections from neighbouring tiles are duplicates above this IoU, or when this share of the smaller box overlaps
+TILE_NMS_IOU = 0.5
+TILE_NMS_CONTAINMENT = 0.8
+# Field names of the segment and detection JSON files the processor writes, which the tiles are merged by;
+# a processor declaring an OUTPUT_SCHEMA dict overrides them (see TiledInference)
+TILE_OUTPUT_SCHEMA = {
+    "segments": "segments", "detections": "detections", "class": "class_name", "box": "bbox", "score": "score",
+    "points": "points", "width": "width", "height": "height"
+}
+
+# Configuration for the different models and classes used for detection and segmentation
+PROCESSOR_CONFIG = {
+    'background_crop_model_path': './models/best_crop.pt',
+    'segmentation_model_path': './models/best_segmentation.pt',
+    'detection_model_paths': ['./models/best_detection.pt'],
+    'oob_model_path': './models/best_oob.pt',
+    'segmentation_classes': [
+        'wall', 'bed_room', 'bathroom', 'others', 'balcony', 'stairs', 
+        'living_kitchen', 'entrance', 'utility_room', 'air_room', 
+        'elevator', 'pantry', 'dressing_room', 'hallway'
+    ],
+    'detection_classes': [
+        'basin', 'bathtub', 'commode', 'door_dwouble', 'door_hinged', 
+        'door_normal', 'elevator', 'gas', 'junc_I', 'junc_L', 'junc_T', 
+        'junc_X', 'sink', 'stairs', 'window'
+    ],
+    'oob_classes': ['wall'],
+    # "torch" runs the .pt checkpoints; "onnx" runs the exports written by export_onnx.py with ONNX Runtime
+    'inference_backend': 'torch',
+    # With the onnx backend, "int8" runs the dynamically quantized exports instead of the float ones
+    'onnx_quantization': None,
+    # Threads of each ONNX Runtime session; 0 uses every core, so lower it when running several worker processes
+    'onnx_intra_op_threads': 0,
+    'onnx_inter_op_threads': 1
+}
+
+# Manage server startup and shutdown
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Manage the server's startup and shutdown events.
+    The models are loaded and warmed up before the server starts accepting requests.
+    """
+    global result_relay
+    logger.info(f"Server starting up as {SERVER_ROLE}")
+    # Load the models in the background so /health/live answers while they load; API pods run no inference
+    startup = asyncio.create_task(load_inference_workers()) if SERVER_ROLE != "api" else None
+    await asyncio.to_thread(start_artifact_retention)
+    if job_store.shared and SERVER_ROLE != "worker":
+        result_relay = ResultEventRelay(result_log, result_events)
+        result_relay.start()
+    yield
+    logger.info("Server shutting down")
+    draining.set()
+    if startup is not None:
+        await startup
+    await asyncio.to_thread(drain_jobs)
+    if job_consumer is not None:
+        job_consumer.close()
+    stop_inference_workers()
+    if result_relay is not None:
+        result_relay.close()
+    if artifact_retention is not None:
+        artifact_retention.close()
+    processed_image_registry.close()
 
 # Initialize the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Set up logging to track server activity
 log_file = "server.log"
@@ -34,87 +260,303 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+app.middleware("http")(record_request_metrics)
+
+def instrument_processor(processor):
+    """
+    Time the FloorPlanProcessor model stages. The wrappers are set on the instance, so the calls
+    process_image makes to its own stage methods are timed as well.
+    """
+    def timed(method, histogram):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return method(*args, **kwargs)
+        return wrapper
+
+    for stage, method_name in list(PIPELINE_STAGE_METHODS.items()) + [("process_image", "process_image")]:
+        method = getattr(processor, method_name, None)
+        if method is not None:
+            setattr(processor, method_name, timed(method, INFERENCE_STAGE_SECONDS.labels(stage)))
+
+class ServerStateCollector:
+    """Reports the job queue, executor, micro-batcher, pipeline and cache state when /metrics is scraped."""
+
+    def collect(self):
+        job_counts = job_store.counts()
+        yield GaugeMetricFamily("floorplan_executor_queue_depth", "Jobs waiting for an executor worker", value=job_counts["queued"])
+        yield GaugeMetricFamily("floorplan_executor_active_workers", "Jobs being processed", value=job_counts["running"])
+        yield GaugeMetricFamily("floorplan_executor_max_workers", "Size of the executor", value=executor.max_workers)
+
+        scheduler_stats = executor.stats()
+        scheduler_queued = GaugeMetricFamily("floorplan_scheduler_queued", "Jobs waiting for an executor worker, by priority class", labels=["priority"])
+        scheduler_running = GaugeMetricFamily("floorplan_scheduler_running", "Jobs being processed, by priority class", labels=["priority"])
+        for priority, values in scheduler_stats["classes"].items():
+            scheduler_queued.add_metric([priority], values["queued"])
+            scheduler_running.add_metric([priority], values["running"])
+        yield scheduler_queued
+        yield scheduler_running
+
+        batcher_stats = image_batcher.stats()
+        yield CounterMetricFamily("floorplan_batcher_batches", "Batches run by the micro-batcher", value=batcher_stats["batches"])
+        yield CounterMetricFamily("floorplan_batcher_items", "Images run by the micro-batcher", value=batcher_stats["items"])
+        yield CounterMetricFamily(
+            "floorplan_batcher_queue_wait_seconds", "Total time images waited for their batch",
+            value=batcher_stats["queue_wait_ms_total"] / 1000
+        )
+
+        if image_pipeline is not None:
+            pipeline_stats = image_pipeline.stats()
+            queue_depth = GaugeMetricFamily("floorplan_pipeline_queue_depth", "Items waiting for each pipeline stage", labels=["stage"])
+            for stage_name, depth in pipeline_stats["queue_depth"].items():
+                queue_depth.add_metric([stage_name], depth)
+            yield queue_depth
+            step_seconds = CounterMetricFamily("floorplan_pipeline_step_seconds", "Total time spent in each pipeline step", labels=["step"])
+            step_runs = CounterMetricFamily("floorplan_pipeline_step_runs", "Pipeline step runs by outcome", labels=["step", "outcome"])
+            for step_name, values in pipeline_stats["steps"].items():
+                step_seconds.add_metric([step_name], values["latency_ms_total"] / 1000)
+                step_runs.add_metric([step_name, "ok"], values["count"] - values["errors"])
+                step_runs.add_metric([step_name, "error"], values["errors"])
+            yield step_seconds
+            yield step_runs
+
+        if result_cache is not None:
+            cache_stats = result_cache.stats()
+            lookups = CounterMetricFamily("floorplan_result_cache_lookups", "Result cache lookups", labels=["outcome"])
+            lookups.add_metric(["hit"], cache_stats["hits"])
+            lookups.add_metric(["miss"], cache_stats["misses"])
+            yield lookups
+            yield GaugeMetricFamily("floorplan_result_cache_entries", "Images in the result cache", value=cache_stats["entries"])
+            yield GaugeMetricFamily("floorplan_result_cache_size_bytes", "Size of the result cache", value=cache_stats["size_bytes"])
+
+        if artifact_retention is not None:
+            retention_stats = artifact_retention.stats()
+            yield GaugeMetricFamily("floorplan_artifact_folders", "Request folders in the upload tree", value=retention_stats["folders"])
+            yield GaugeMetricFamily("floorplan_artifact_size_bytes", "Size of the upload tree", value=retention_stats["size_bytes"])
+
 # Initialize processor and thread pool for asynchronous processing
 processor = None
-executor = ThreadPoolExecutor(max_workers=5)
+# PROCESSOR_CONFIG with the model paths of the selected inference backend, set when the processor is loaded
+processor_config = None
+processor_lock = threading.Lock()
+# Jobs run in the fair-share scheduler; in process mode enough have to run at once to keep every worker process busy
+executor = FairScheduler(
+    max(5, WORKER_PROCESSES) if EXECUTION_MODE == "process" else 5, SCHEDULER_INTERACTIVE_RESERVED_WORKERS,
+    SCHEDULER_MAX_RUNNING_PER_USER, SCHEDULER_QUEUE_SLO_SECONDS
+)
+# Worker processes used for inference when EXECUTION_MODE is "process"
+process_pool = None
+# Index of the current worker process, None in the server process
+worker_index = None
+# Set once the models are loaded and warmed up, and once the server stops taking uploads
+models_ready = threading.Event()
+draining = threading.Event()
+startup_error = None
 
 def initialize_processor():
     """Initialize the FloorPlanProcessor for handling image processing."""
-    global processor # Ensure the processor is a global variable
-    if processor is None:
-        # Define the configuration for different models and classes for detection and segmentation
-        config = {
-            'background_crop_model_path': './models/best_crop.pt',
-            'segmentation_model_path': './models/best_segmentation.pt',
-            'detection_model_paths': ['./models/best_detection.pt'],
-            'oob_model_path': './models/best_oob.pt',
-            'segmentation_classes': [
-                'wall', 'bed_room', 'bathroom', 'others', 'balcony', 'stairs', 
-                'living_kitchen', 'entrance', 'utility_room', 'air_room', 
-                'elevator', 'pantry', 'dressing_room', 'hallway'
-            ],
-            'detection_classes': [
-                'basin', 'bathtub', 'commode', 'door_dwouble', 'door_hinged', 
-                'door_normal', 'elevator', 'gas', 'junc_I', 'junc_L', 'junc_T', 
-                'junc_X', 'sink', 'stairs', 'window'
-            ],
-            'oob_classes': ['wall']
-        }
-        processor = FloorPlanProcessor(config)  # Initialize the processor with the configuration
-
-# Utility functions to load and save data from JSON files
-def load_json_data(filename):
-    """Load JSON data from a file."""
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_json_data(filename, data):
-    """Save JSON data to a file."""
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+    global processor, processor_config # Ensure the processor is a global variable
+    with processor_lock:
+        if processor is not None:
+            return
+        # Worker processes default to their share of the cores rather than every core
+        processor_config = resolve_processor_config(PROCESSOR_CONFIG, WORKER_THREADS if worker_index is not None else 0)
+        processor = FloorPlanProcessor(processor_config)  # Initialize the processor with the configuration
+        instrument_processor(processor)
+        logger.info(f"FloorPlanProcessor loaded ({PROCESSOR_CONFIG.get('inference_backend', 'torch')} backend)")
+
+def warm_up_processor():
+    """Run one inference on a throwaway image so the first real request does not pay for lazy initialization."""
+    warmup_folder = tempfile.mkdtemp(prefix="warmup_")
+    try:
+        original_img_directory = os.path.join(warmup_folder, "original_img")
+        crop_image_dir = os.path.join(warmup_folder, "cropped")
+        save_json_dir = os.path.join(warmup_folder, "json")
+        save_image_dir = os.path.join(warmup_folder, "images")
+        for directory in (original_img_directory, crop_image_dir, save_json_dir, save_image_dir):
+            os.makedirs(directory, exist_ok=True)
+        image_name = "warmup.png"
+        if WARMUP_IMAGE_PATH:
+            shutil.copy(WARMUP_IMAGE_PATH, os.path.join(original_img_directory, image_name))
+        else:
+            import cv2
+            import numpy as np
+            cv2.imwrite(os.path.join(original_img_directory, image_name), np.full((1024, 1024, 3), 255, dtype=np.uint8))
+        started = time.monotonic()
+        processor.process_image(image_name, crop_image_dir, save_json_dir, save_image_dir)
+        logger.info(f"Warm-up inference finished in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        logger.warning(f"Warm-up inference failed: {e}")
+    finally:
+        shutil.rmtree(warmup_folder, ignore_errors=True)
+
+def limit_worker_threads(index):
+    """Pin a worker process to its own WORKER_THREADS cores and size the torch thread pool to match."""
+    if WORKER_CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = index * WORKER_THREADS
+        os.sched_setaffinity(0, {cores[(first + offset) % len(cores)] for offset in range(WORKER_THREADS)})
+    try:
+        import torch
+        torch.set_num_threads(WORKER_THREADS)
+    except ImportError:
+        pass
+
+def init_worker_process(worker_counter):
+    """
+    Prepare a freshly started worker process for inference: give it its cores, then load and warm up the models.
+    Workers started with "fork" inherit the models from the parent; with "forkserver" or "spawn" they load their own.
+    """
+    global process_pool, worker_index
+    # A forked worker inherits the parent's pool handle; images sent to a worker run on its own models
+    process_pool = None
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    limit_worker_threads(worker_index)
+    initialize_processor()
+    warm_up_processor()
+    TiledInference.worker_processor = processor
+
+def run_image_in_worker(item):
+    """Run one (image_name, crop_image_dir, save_json_dir, save_image_dir) item on the models of this worker process."""
+    processor.process_image(*item)
+
+def start_inference_workers():
+    """
+    Load the models once, warm them up, open the result cache and start the worker processes when
+    running in process mode.
+    """
+    global process_pool, image_pipeline, tiled_inference, result_cache
+    initialize_processor()
+    warm_up_processor()
+    stage_problems = None
+    if (INFERENCE_PIPELINE == "staged" and EXECUTION_MODE != "process") or TILED_INFERENCE_ENABLED:
+        stage_problems = check_stage_methods(processor, PIPELINE_STAGE_METHODS, WARMUP_IMAGE_PATH)
+    if INFERENCE_PIPELINE == "staged" and EXECUTION_MODE != "process":
+        image_pipeline = create_image_pipeline(stage_problems)
+    if EXECUTION_MODE == "process":
+        mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+        if WORKER_START_METHOD == "forkserver":
+            # The fork server imports the processor module (and its model libraries) once for every worker
+            mp_context.set_forkserver_preload([FloorPlanProcessor.__module__])
+        # Forked workers share a resource tracker only if it runs before they start; otherwise each starts its
+        # own and claims the shared memory of tiled plans as leaked when it exits
+        resource_tracker.ensure_running()
+        process_pool = ProcessPoolExecutor(
+            max_workers=WORKER_PROCESSES,
+            mp_context=mp_context,
+            initializer=init_worker_process,
+            initargs=(mp_context.Value("i", 0),)
+        )
+        # Start every worker now so none of them warms up while a request is waiting
+        for future in [process_pool.submit(os.getpid) for _ in range(WORKER_PROCESSES)]:
+            future.result()
+        logger.info(f"Started {WORKER_PROCESSES} inference worker processes with {WORKER_THREADS} threads each")
+    tiled_inference = create_tiled_inference(stage_problems)
+    if RESULT_CACHE_ENABLED:
+        tiling = tiled_inference.settings() if tiled_inference is not None else None
+        result_cache = ResultCache(RESULT_CACHE_DIRECTORY, RESULT_CACHE_MAX_BYTES, ResultCache.fingerprint_models(dict(processor_config, tiling=tiling)))
+    models_ready.set()
+    if job_store.shared:
+        start_job_consumer()
+    logger.info("Server is ready")
+
+def start_job_consumer():
+    """Start claiming jobs from the shared broker, one for each executor worker."""
+    global job_consumer
+    job_consumer = JobConsumer(job_store, executor.max_workers)
+    job_consumer.start()
+
+def start_artifact_retention():
+    """Open the artifact index and start the retention sweeper when RETENTION_ENABLED is set."""
+    global artifact_retention
+    if RETENTION_ENABLED:
+        artifact_retention = ArtifactRetention(
+            BASE_UPLOAD_DIRECTORY, RETENTION_INDEX_DB, forget_processed_images, RETENTION_MAX_AGE_SECONDS,
+            RETENTION_MAX_USER_BYTES, RETENTION_MAX_TOTAL_BYTES, RETENTION_MIN_AGE_SECONDS, RETENTION_SWEEP_INTERVAL_SECONDS
+        )
+        artifact_retention.start()
+
+async def load_inference_workers():
+    """Run start_inference_workers in a thread; a failure is kept in startup_error and fails the liveness probe."""
+    global startup_error
+    try:
+        await asyncio.to_thread(start_inference_workers)
+    except Exception as e:
+        startup_error = e
+        logger.exception(f"Server startup failed: {e}")
+
+def drain_jobs(timeout=DRAIN_TIMEOUT_SECONDS):
+    """Wait until every queued and running job has finished or the timeout has passed. Returns True when all finished."""
+    deadline = time.monotonic() + timeout
+    while True:
+        unfinished = count_unfinished_jobs()
+        if unfinished == 0:
+            return True
+        if time.monotonic() >= deadline:
+            logger.warning(f"Drain timed out after {timeout}s with {unfinished} jobs unfinished")
+            return False
+        time.sleep(0.5)
+
+def stop_inference_workers():
+    """Stop the worker threads and processes; jobs still queued after the drain are cancelled, running ones finish."""
+    executor.shutdown(wait=True, cancel_futures=True)
+    if process_pool is not None:
+        process_pool.shutdown(wait=True)
+    if image_pipeline is not None:
+        image_pipeline.close()
+    if tiled_inference is not None:
+        tiled_inference.close()
+    image_batcher.close()
+    image_executor.shutdown(wait=True)
+
+def run_inference(user_id, project_number, floor_number, image_base_name, images_dir, priority="interactive"):
+    """Run process_user_data and wait for the processed file names; in process mode its images go to the worker processes."""
+    return process_user_data(user_id, project_number, floor_number, image_base_name, images_dir, priority)
+
+processed_image_registry = create_processed_image_registry(
+    PROCESSED_IMAGES_BACKEND, PROCESSED_IMAGES_DB, PROCESSED_IMAGES_FILE, REGISTRY_SINGLE_WRITER,
+    REGISTRY_WRITE_MAX_BATCH, REGISTRY_WRITE_MAX_WAIT_MS
+)
+
 # Check and log processed images
+@STORE_SECONDS.labels("registry", "read").time()
 def is_image_processed(user_id, project_number, floor_number, image_name):
     """Check if a specific image has already been processed."""
-    processed_images = load_json_data(PROCESSED_IMAGES_FILE)
-    return (
-        user_id in processed_images and 
-        project_number in processed_images[user_id] and 
-        floor_number in processed_images[user_id][project_number] and 
-        image_name in processed_images[user_id][project_number][floor_number]
-    )
+    return processed_image_registry.contains(user_id, project_number, floor_number, image_name)
 
+@STORE_SECONDS.labels("registry", "write").time()
 def log_image_as_processed(user_id, project_number, floor_number, image_name):
-    """Mark an image as processed by recording it in the processed images file."""
-    processed_images = load_json_data(PROCESSED_IMAGES_FILE)
-    if user_id not in processed_images:
-        processed_images[user_id] = {}
-    if project_number not in processed_images[user_id]:
-        processed_images[user_id][project_number] = {}
-    floor_key = f"floor_{floor_number}"
-    if floor_key not in processed_images[user_id][project_number]:
-        processed_images[user_id][project_number][floor_key] = []
-    if image_name not in processed_images[user_id][project_number][floor_key]:
-        processed_images[user_id][project_number][floor_key].append(image_name)
-    save_json_data(PROCESSED_IMAGES_FILE, processed_images)
+    """Mark an image as processed by recording it in the processed images registry."""
+    processed_image_registry.add(user_id, project_number, floor_number, image_name)
+
+@STORE_SECONDS.labels("registry", "write").time()
+def log_images_as_processed(entries):
+    """Mark several (user_id, project_number, floor_number, image_name) entries as processed in one write."""
+    processed_image_registry.add_many(entries)
+
+@STORE_SECONDS.labels("registry", "write").time()
+def forget_processed_images(entries):
+    """Remove (user_id, project_number, floor_number, image_name) entries from the registry once their files are deleted."""
+    processed_image_registry.remove_many(entries)
     
 # Encode files to base64 for transmission. It is important to encode the files before sending them back to the client.
+@ENCODE_SECONDS.labels("base64").time()
 def encode_file_to_base64(file_path: str) -> str:
     """Read a file and encode it in base64 format."""
     with open(file_path, "rb") as file:
         return base64.b64encode(file.read()).decode('utf-8')
-# Post processed inference results for user
-def post_inference_results(user_id, project_number, floor_number, image_name):
-    """
-    Prepare and encode the processed files for a specific user, project, and image.
-    The files are returned as base64 encoded data ready for transmission.
-    """
-    image_base_name = os.path.splitext(image_name)[0]
-    image_folder = os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}", image_base_name)
+# Locate the processed files of an image
+def result_image_folder(user_id, project_number, floor_number, image_name):
+    """Return the folder holding the upload and the results of an image."""
+    return os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}", os.path.splitext(image_name)[0])
 
-    # Define where the various processed files should be stored
-    result_files = {
+def result_file_paths(user_id, project_number, floor_number, image_name):
+    """Return the paths where the processor stores each result file of an image, keyed by file type."""
+    image_base_name = os.path.splitext(image_name)[0]
+    image_folder = result_image_folder(user_id, project_number, floor_number, image_name)
+    return {
         "detection_json": os.path.join(image_folder, 'json', 'detect', f"{image_base_name}_detection.json"),
         "oob_json": os.path.join(image_folder, 'json', 'oob', f"{image_base_name}_oob.json"),
         "segmentation_json": os.path.join(image_folder, 'json', 'segment', f"{image_base_name}_segment.json"),
@@ -123,83 +565,375 @@ def post_inference_results(user_id, project_number, floor_number, image_name):
         "original_image": os.path.join(image_folder, 'original_img', f"{image_name}"),
         "cropped_image": os.path.join(image_folder, 'cropped', f"{image_base_name}.png"),
     }
+
+def write_image_manifest(user_id, project_number, floor_number, image_name):
+    """Describe the files in the RESULT_FOLDERS of an image's folder in its manifest and return the manifest."""
+    return write_result_manifest(
+        result_image_folder(user_id, project_number, floor_number, image_name), image_name,
+        result_file_paths(user_id, project_number, floor_number, image_name), RESULT_FOLDERS, RESULT_MANIFEST_FILENAME
+    )
+
+def result_manifest(user_id, project_number, floor_number, image_name):
+    """Return the manifest of an image's results, or None when its folder does not exist."""
+    return read_result_manifest(
+        result_image_folder(user_id, project_number, floor_number, image_name), image_name,
+        result_file_paths(user_id, project_number, floor_number, image_name), RESULT_FOLDERS, RESULT_MANIFEST_FILENAME
+    )
+
+def result_file_url(user_id, project_number, floor_number, image_name, file_key):
+    """Return the /files URL of a result file, with each path segment percent-encoded."""
+    return "/files/" + "/".join(quote(str(segment), safe="") for segment in (user_id, project_number, floor_number, image_name, file_key))
+
+def manifest_etag(entry):
+    """Build the ETag of a result file from the checksum in its manifest entry."""
+    return f'"{entry["sha256"]}"'
+
+# Post processed inference results for user
+def post_inference_results(user_id, project_number, floor_number, image_name):
+    """
+    Record the processed files for a specific user, project, and image.
+    Only file metadata is stored; the client downloads each file from its /files/... URL.
+    A summary of the result is returned.
+    """
+    return post_batch_inference_results(user_id, project_number, floor_number, [image_name])[0]
+
+def post_batch_inference_results(user_id, project_number, floor_number, image_names):
+    """Record the processed files of several images of a floor with one result log write and return their summaries."""
     try:
-        encoded_files = {}
-        filenames = {}
-        # Encode each file in base64 and store it in the encoded_files dictionary
-        for key, file_path in result_files.items():
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as file:
-                    encoded_files[key] = base64.b64encode(file.read()).decode('utf-8')
-                    filenames[key] = os.path.basename(file_path)  # Get the filename for tracking
-            else:
-                logger.warning(f"File not found: {file_path}. Skipping {key}.")
-        if not encoded_files:
-            logger.error(f"No files were found to send for image {image_name}.")
-        # Append the results to the INFERENCE_RESULTS_FILE for the given user
-        inference_results = load_json_data(INFERENCE_RESULTS_FILE)
-        if user_id not in inference_results:
-            inference_results[user_id] = []
-        # This will store the results for the user, project, floor, and image in the INFERENCE_RESULTS_FILE
-        inference_results[user_id].append({
-            "project_number": project_number,
-            "floor_number": floor_number,
-            "image_name": image_name,
-            "files": encoded_files,
-            "filenames": filenames
-        })
-        save_json_data(INFERENCE_RESULTS_FILE, inference_results)
-        # Response to the client that the inference results are ready
-        return JSONResponse(
-            content={
+        records = []
+        for image_name in image_names:
+            manifest = result_manifest(user_id, project_number, floor_number, image_name) or {"files": [], "missing": []}
+            files = {}
+            filenames = {}
+            # Describe each file listed in the manifest instead of embedding its contents
+            for entry in manifest["files"]:
+                key = entry.get("key")
+                if key is None:
+                    continue
+                files[key] = {
+                    "filename": os.path.basename(entry["path"]),
+                    "size": entry["size"],
+                    "content_type": entry["content_type"],
+                    "etag": manifest_etag(entry),
+                    "url": result_file_url(user_id, project_number, floor_number, image_name, key)
+                }
+                filenames[key] = os.path.basename(entry["path"])  # Get the filename for tracking
+            if manifest["missing"]:
+                logger.warning(f"No {', '.join(manifest['missing'])} in the results of image {image_name}.")
+            if not files:
+                logger.error(f"No files were found to send for image {image_name}.")
+            records.append({
+                "project_number": project_number,
+                "floor_number": floor_number,
+                "image_name": image_name,
+                "files": files,
+                "filenames": filenames
+            })
+        # Queue the results for the user; they stay pending until the client acknowledges them
+        seqs = result_log.append_many(user_id, records)
+        summaries = []
+        for seq, image_name in zip(seqs, image_names):
+            # Push a small event to connected clients so they do not have to poll for it; with a shared
+            # broker the clients are connected to the API pods, whose relays publish it
+            if not job_store.shared:
+                result_events.publish({
+                    "user_id": user_id,
+                    "seq": seq,
+                    "project_number": project_number,
+                    "floor_number": floor_number,
+                    "image_name": image_name
+                })
+            # Tell the client that the inference results are ready
+            summaries.append({
                 "message": "Inference results ready",
                 "user_id": user_id,
                 "project_number": project_number,
                 "floor_number": floor_number,
                 "image_name": image_name
-            },
-            status_code=200 # status code 200 indicates success
-        )
+            })
+        return summaries
     except Exception as e:
-        error_message = f"Unexpected error processing files for {image_name}: {str(e)}"
-        logger.error(error_message)
-        return JSONResponse(status_code=500, content={"message": error_message})
+        logger.error(f"Unexpected error processing files for {', '.join(image_names)}: {str(e)}")
+        raise
 
-# New global variable to keep track of sent results and last retrievals
-sent_results = {}
-last_retrieval_time = {}
-# Retrieve inference results for a specific user
+def iter_file_range(file_path, start, end):
+    """Yield the bytes of file_path from start to end (inclusive) in DOWNLOAD_CHUNK_SIZE chunks."""
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
-@app.get("/get_inference_results/{user_id}")
-async def get_inference_results(user_id: str):
+def parse_range_header(range_header, file_size):
     """
-    Retrieve the inference results for a given user.
-    Once retrieved, the results are marked as sent, and future retrievals will not resend the same results.
-    """    
+    Parse a single 'bytes=start-end' range. Returns (start, end), or None when the header is not
+    a single byte range; raises HTTPException(416) when the range cannot be satisfied.
+    """
+    if not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
     try:
-        inference_results = load_json_data(INFERENCE_RESULTS_FILE)
-        
-        if user_id in inference_results and inference_results[user_id]:
-            user_results = inference_results[user_id]
-            
-            # Clear the results for this user after sending
-            if user_id not in last_retrieval_time:
-                last_retrieval_time[user_id] = datetime.now()
-
-            # Store the sent results for tracking and mark retrieval time
-            sent_results[user_id] = user_results
-            last_retrieval_time[user_id] = datetime.now()
-
-            # Clear results only after they are retrieved
-            inference_results[user_id] = []
-            save_json_data(INFERENCE_RESULTS_FILE, inference_results)
-            
-            return JSONResponse(content=user_results, status_code=200)
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
         else:
-            return JSONResponse(content={"message": "No new inference results available"}, status_code=204)
+            # Suffix range: the last N bytes
+            start = max(file_size - int(end_text), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or start > end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{file_size}"})
+    return start, min(end, file_size - 1)
+
+# Serve one processed file as binary data
+@app.get("/files/{user_id}/{project_number}/{floor_number}/{image_name}/{file_key}")
+async def get_result_file(user_id: str, project_number: str, floor_number: str, image_name: str, file_key: str, request: Request):
+    """
+    Stream one result file of an image, as described in the image's result manifest.
+    Supports conditional requests (If-None-Match) and single byte ranges (Range, If-Range) for resumable downloads.
+    """
+    if file_key not in result_file_paths(user_id, project_number, floor_number, image_name):
+        raise HTTPException(status_code=404, detail=f"Unknown result file: {file_key}")
+    image_folder = result_image_folder(user_id, project_number, floor_number, image_name)
+    base_directory = os.path.realpath(BASE_UPLOAD_DIRECTORY)
+    if not os.path.realpath(image_folder).startswith(base_directory + os.sep):
+        raise HTTPException(status_code=404, detail=f"Unknown result file: {file_key}")
+    manifest = await asyncio.to_thread(result_manifest, user_id, project_number, floor_number, image_name)
+    entry = next((entry for entry in (manifest or {"files": []})["files"] if entry.get("key") == file_key), None)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Result file not found: {file_key}")
+    file_path = os.path.join(image_folder, entry["path"])
+    # The size sent is the one on disk now, not the one in the manifest
+    try:
+        file_stat = await asyncio.to_thread(os.stat, file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Result file not found: {file_key}")
+    if file_stat.st_size != entry["size"] or file_stat.st_mtime > manifest.get("created_at", 0):
+        # The file was rewritten after the manifest (the image was processed again), so its checksum is stale too
+        manifest = await asyncio.to_thread(write_image_manifest, user_id, project_number, floor_number, image_name)
+        entry = next((entry for entry in manifest["files"] if entry.get("key") == file_key), None)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"Result file not found: {file_key}")
+
+    etag = manifest_etag(entry)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{os.path.basename(file_path)}"'
+    }
+    media_type = entry["content_type"]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    file_size = file_stat.st_size
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range_header(range_header, file_size)
+    if byte_range is None:
+        headers["Content-Length"] = str(file_size)
+        return StreamingResponse(iter_file_range(file_path, 0, file_size - 1), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file_range(file_path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+# With a shared broker the results live next to the jobs, where every API pod reads them
+if JOB_BROKER == "sqlite":
+    result_log = SqliteResultLog(JOB_BROKER_DB)
+else:
+    result_log = ResultLog(RESULTS_DIRECTORY, INFERENCE_RESULTS_FILE, RESULTS_SEGMENT_BYTES, RESULTS_COMPACT_RATIO, RESULTS_FSYNC)
+
+class ResultEventBroker:
+    """
+    Fan-out of result events to the clients connected to /events.
+    Event IDs are "<boot id>:<counter>" and the last RESULT_EVENT_BUFFER events are kept, so a client that
+    reconnects with Last-Event-ID gets what it missed. When that is not possible (no ID, an ID from before a
+    restart, or events that already left the buffer) the client is sent a "resync" event instead and catches up
+    through /get_inference_results, which loses nothing because results stay there until acknowledged.
+    """
+
+    RESYNC = None  # Queued for a subscriber that fell too far behind
+
+    def __init__(self, buffer_size=RESULT_EVENT_BUFFER):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=buffer_size)
+        self._next_id = 1
+        self._subscribers = set()
+
+    def event_id(self, counter):
+        return f"{self.boot_id}:{counter}"
+
+    def latest_event_id(self):
+        with self._lock:
+            return self.event_id(self._next_id - 1)
+
+    def publish(self, data):
+        """Record an event and hand it to every subscriber; safe to call from any thread."""
+        with self._lock:
+            event = (self._next_id, data)
+            self._next_id += 1
+            self._events.append(event)
+            subscribers = list(self._subscribers)
+        for loop, event_queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, event_queue, event)
+            except RuntimeError:
+                pass  # The subscriber's event loop is closed
+
+    @staticmethod
+    def _deliver(event_queue, event):
+        if event_queue.full():
+            # The client is not keeping up; drop its backlog and make it resynchronize
+            while not event_queue.empty():
+                event_queue.get_nowait()
+            event = ResultEventBroker.RESYNC
+        event_queue.put_nowait(event)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Register a subscriber on the running event loop. Returns (subscription, backlog, latest event ID), where
+        backlog lists the buffered events after last_event_id, or is None when the client has to resynchronize.
+        """
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(maxsize=RESULT_EVENT_BUFFER))
+        with self._lock:
+            self._subscribers.add(subscription)
+            backlog = None
+            boot_id, _, counter = (last_event_id or "").partition(":")
+            if boot_id == self.boot_id and counter.isdigit():
+                oldest = self._events[0][0] if self._events else self._next_id
+                if int(counter) >= oldest - 1:
+                    backlog = [event for event in self._events if event[0] > int(counter)]
+            latest_id = self.event_id(self._next_id - 1)
+        return subscription, backlog, latest_id
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+result_events = ResultEventBroker()
+
+class ResultEventRelay:
+    """
+    Publishes to /events the results recorded in the shared result log, by whichever pod ran the job.
+    The log is polled for rows newer than the last one relayed, every JOB_POLL_SECONDS.
+    """
+
+    def __init__(self, log, events, poll_seconds=JOB_POLL_SECONDS):
+        self.log = log
+        self.events = events
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="result-relay", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        last_id = None
+        while not self._stop.wait(0 if last_id is None else self.poll_seconds):
+            try:
+                if last_id is None:
+                    last_id = self.log.last_change_id()  # Clients catch up on older results through /get_inference_results
+                    continue
+                for last_id, user_id, record in self.log.changes_since(last_id):
+                    self.events.publish({
+                        "user_id": user_id,
+                        "seq": record["seq"],
+                        "project_number": record["project_number"],
+                        "floor_number": record["floor_number"],
+                        "image_name": record["image_name"]
+                    })
+            except Exception as e:
+                logger.error(f"Could not relay result events: {e}")
+
+result_relay = None
+
+# Retrieve inference results for a specific user, one page at a time
+@app.get("/get_inference_results/{user_id}")
+async def get_inference_results(user_id: str, cursor: int = None, limit: int = RESULTS_PAGE_SIZE):
+    """
+    Return one page of pending inference results for a user, starting after cursor
+    (after the last acknowledged result when cursor is omitted).
+    Results are not removed here; the client acknowledges them with /ack_inference_results/{user_id}.
+    """
+    limit = max(1, min(limit, RESULTS_MAX_PAGE_SIZE))
+    try:
+        page = await asyncio.to_thread(result_log.read, user_id, cursor, limit)
     except Exception as e:
         logger.error(f"Error retrieving inference results for user {user_id}: {str(e)}")
         return JSONResponse(content={"message": f"Error retrieving inference results: {str(e)}"}, status_code=500)
+    if not page["results"]:
+        return JSONResponse(content={"message": "No new inference results available"}, status_code=204)
+    return JSONResponse(content=page, status_code=200)
+
+@app.post("/ack_inference_results/{user_id}")
+async def ack_inference_results(user_id: str, cursor: int = Form(...)):
+    """Acknowledge every result of a user up to and including cursor, removing them from the server."""
+    try:
+        removed = await asyncio.to_thread(result_log.ack, user_id, cursor)
+    except Exception as e:
+        logger.error(f"Error acknowledging inference results for user {user_id}: {str(e)}")
+        return JSONResponse(content={"message": f"Error acknowledging inference results: {str(e)}"}, status_code=500)
+    return JSONResponse(content={"acknowledged": removed, "cursor": cursor}, status_code=200)
+
+def format_sse(event_type, event_id, data):
+    """Format one Server-Sent Events message."""
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+# Push channel for new results
+@app.get("/events")
+async def result_event_stream(request: Request, user_id: str = None):
+    """
+    Server-Sent Events stream with one "result" event per recorded inference result, optionally limited to one user.
+    Reconnecting clients send Last-Event-ID to receive the events they missed, or get a "resync" event
+    telling them to fetch their pending results with /get_inference_results.
+    """
+    subscription, backlog, latest_id = result_events.subscribe(request.headers.get("last-event-id"))
+    event_queue = subscription[1]
+
+    async def stream():
+        try:
+            yield f"retry: {EVENT_KEEPALIVE_SECONDS * 1000}\n\n"
+            if backlog is None:
+                yield format_sse("resync", latest_id, {})
+            else:
+                for counter, data in backlog:
+                    if user_id is None or data["user_id"] == user_id:
+                        yield format_sse("result", result_events.event_id(counter), data)
+            while True:
+                try:
+                    event = await asyncio.wait_for(event_queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if draining.is_set():
+                        break  # Let the client reconnect to a server that is not shutting down
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is ResultEventBroker.RESYNC:
+                    yield format_sse("resync", result_events.latest_event_id(), {})
+                elif user_id is None or event[1]["user_id"] == user_id:
+                    yield format_sse("result", result_events.event_id(event[0]), event[1])
+        finally:
+            result_events.unsubscribe(subscription)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
 
 @app.get("/get_users_with_results")
 async def get_users_with_results():
@@ -208,30 +942,455 @@ async def get_users_with_results():
     This endpoint helps the client dynamically fetch users that have results available.
     """
     try:
-        inference_results = load_json_data(INFERENCE_RESULTS_FILE)
-        users_with_results = [user_id for user_id, results in inference_results.items() if results]
+        users_with_results = await asyncio.to_thread(result_log.users_with_pending_results)
         #logger.info(f"Users with results: {users_with_results}")
         return JSONResponse(content={"users_with_results": users_with_results}, status_code=200)
     except Exception as e:
         logger.error(f"Error retrieving users with results: {str(e)}")
         return JSONResponse(content={"message": f"Error retrieving users with results: {str(e)}"}, status_code=500)
 
-# Upload and process images sent by the client
+# Background jobs created by /receive_data and /receive_batch
+class LocalJobStore:
+    """
+    Jobs kept in this process and run by its executor.
+    Each job carries a task, ("image", args) or ("batch", args), that run_queued_job turns into a run_job or
+    run_batch_job call; an Idempotency-Key header value maps to the job it created, so a retried upload does
+    not queue the image twice.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._idempotency_keys = {}
+
+    def _prune(self):
+        """Forget finished jobs older than JOB_RETENTION_SECONDS. Must be called with the lock held."""
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "failed") and job["updated_at"] < cutoff]:
+            del self._jobs[job_id]
+        for key in [key for key, job_id in self._idempotency_keys.items() if job_id not in self._jobs]:
+            del self._idempotency_keys[key]
+
+    def create(self, user_id, project_number, floor_number, image_name, idempotency_key=None):
+        """
+        Register a new queued job and return (job_id, created); job_id is None when the queue is full.
+        When idempotency_key belongs to a job that has not failed, that job is returned with created set to False.
+        """
+        with self._lock:
+            self._prune()
+            existing_job = self._jobs.get(self._idempotency_keys.get(idempotency_key))
+            if existing_job is not None and existing_job["status"] != "failed":
+                return existing_job["job_id"], False
+            if sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running")) >= JOB_QUEUE_MAX_SIZE:
+                return None, False
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "user_id": user_id,
+                "project_number": project_number,
+                "floor_number": floor_number,
+                "image_name": image_name,
+                "created_at": now,
+                "updated_at": now,
+                "result": None,
+                "error": None
+            }
+            if idempotency_key:
+                self._idempotency_keys[idempotency_key] = job_id
+            return job_id, True
+
+    def enqueue(self, job_id, task, priority="interactive"):
+        """Hand a job whose upload is saved to the executor."""
+        submit_queued_job(job_id, task, priority)
+
+    def discard(self, job_id):
+        """Forget a job whose upload was rejected before it was queued."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        """Return a copy of the stored state of a job, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def counts(self):
+        """Return the number of queued and of running jobs."""
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {"queued": statuses.count("queued"), "running": statuses.count("running")}
+
+class SqliteJobStore:
+    """
+    Job broker kept in a SQLite database on storage shared by every pod.
+    API pods create pending jobs and enqueue their task once the upload is saved; workers claim the oldest queued job of
+    the highest priority class they have room for in a write transaction, so each job goes to one worker, and
+    hold it under a lease they renew while it runs.
+    A job whose lease ran out is claimed again by the next worker, so the jobs of a worker that died are not lost.
+    """
+
+    shared = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, user_id TEXT, project_number TEXT, floor_number TEXT, "
+            "image_name TEXT, image_names TEXT, task TEXT, result TEXT, error TEXT, idempotency_key TEXT UNIQUE, "
+            "worker TEXT, lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL, priority INTEGER NOT NULL DEFAULT 0)"
+        )
+        if "priority" not in [column["name"] for column in conn.execute("PRAGMA table_info(jobs)")]:
+            conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at)")
+        self.reap_stale_pending()
+
+    def reap_stale_pending(self, conn=None, now=None):
+        """
+        Delete the jobs whose upload was never saved because their API pod died, which include the jobs created
+        queued without a task before the pending status existed. Return the number deleted.
+        """
+        conn = conn or self._connection()
+        cutoff = (now or time.time()) - JOB_PENDING_TIMEOUT_SECONDS
+        return conn.execute(
+            "DELETE FROM jobs WHERE status IN ('pending', 'queued') AND task IS NULL AND updated_at < ?", (cutoff,)
+        ).rowcount
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @STORE_SECONDS.labels("jobs", "write").time()
+    def create(self, user_id, project_number, floor_number, image_name, idempotency_key=None):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (now - JOB_RETENTION_SECONDS,))
+            self.reap_stale_pending(conn, now)
+            if idempotency_key:
+                existing_job = conn.execute("SELECT job_id, status FROM jobs WHERE idempotency_key=?", (idempotency_key,)).fetchone()
+                if existing_job is not None and existing_job["status"] != "failed":
+                    conn.execute("COMMIT")
+                    return existing_job["job_id"], False
+                # A failed job gives its key up to the retry
+                conn.execute("UPDATE jobs SET idempotency_key=NULL WHERE idempotency_key=?", (idempotency_key,))
+            unfinished = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'queued', 'running')").fetchone()[0]
+            if unfinished >= JOB_QUEUE_MAX_SIZE:
+                conn.execute("COMMIT")
+                return None, False
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, user_id, project_number, floor_number, image_name, idempotency_key, created_at, updated_at) "
+                "VALUES (?, 'pending', ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, user_id, project_number, floor_number, image_name, idempotency_key or None, now, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id, True
+
+    @STORE_SECONDS.labels("jobs", "write").time()
+    def enqueue(self, job_id, task, priority="interactive"):
+        """Make a pending job whose upload is saved claimable by the workers."""
+        self._connection().execute(
+            "UPDATE jobs SET status='queued', task=?, priority=?, updated_at=? WHERE job_id=? AND status='pending'",
+            (json.dumps(task), PRIORITY_CLASSES.index(priority), time.time(), job_id)
+        )
+
+    def discard(self, job_id):
+        self._connection().execute("DELETE FROM jobs WHERE job_id=?", (job_id,))
+
+    @STORE_SECONDS.labels("jobs", "write").time()
+    def update(self, job_id, **fields):
+        columns = {key: json.dumps(value) if key in ("result", "image_names") else value for key, value in fields.items()}
+        columns["updated_at"] = time.time()
+        self._connection().execute(
+            f"UPDATE jobs SET {', '.join(f'{column}=?' for column in columns)} WHERE job_id=?",
+            (*columns.values(), job_id)
+        )
+
+    @STORE_SECONDS.labels("jobs", "read").time()
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {key: row[key] for key in ("job_id", "status", "user_id", "project_number", "floor_number", "image_name", "error", "created_at", "updated_at")}
+        job["result"] = json.loads(row["result"]) if row["result"] is not None else None
+        if row["image_names"] is not None:
+            job["image_names"] = json.loads(row["image_names"])
+        return job
+
+    def counts(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    @STORE_SECONDS.labels("jobs", "claim").time()
+    def claim(self, worker, lease_seconds=JOB_LEASE_SECONDS, priorities=PRIORITY_CLASSES):
+        """
+        Claim the oldest claimable job of the highest of priorities for worker and return (job_id, task, priority),
+        or None when there is none.
+        """
+        return claim_sqlite_job(self._connection(), worker, lease_seconds, priorities)
+
+    def renew(self, job_ids, worker, lease_seconds=JOB_LEASE_SECONDS):
+        """Extend the lease of the jobs worker is running."""
+        self._connection().executemany(
+            "UPDATE jobs SET lease_until=? WHERE job_id=? AND worker=? AND status='running'",
+            [(time.time() + lease_seconds, job_id, worker) for job_id in job_ids]
+        )
+
+def create_job_store(broker=JOB_BROKER, role=SERVER_ROLE):
+    """Create the job store for the configured broker; API and worker pods need a broker shared between pods."""
+    if role not in ("standalone", "api", "worker"):
+        raise ValueError(f"Unknown server role: {role}")
+    if broker == "local":
+        if role != "standalone":
+            raise ValueError(f"The {role} role needs a shared JOB_BROKER")
+        return LocalJobStore()
+    if broker == "sqlite":
+        return SqliteJobStore(JOB_BROKER_DB)
+    raise ValueError(f"Unknown job broker: {broker}")
+
+job_store = create_job_store()
+
+class JobConsumer:
+    """
+    Runs jobs from a shared job store in the executor.
+    A claiming thread takes one job per free executor worker, bulk ones only while fewer run than the executor's
+    bulk workers, and renews the leases of the running jobs every third of JOB_LEASE_SECONDS so they are not
+    handed to another worker.
+    """
+
+    def __init__(self, store, slots, poll_seconds=JOB_POLL_SECONDS, lease_seconds=JOB_LEASE_SECONDS):
+        self.store = store
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self._slots = threading.Semaphore(slots)
+        self._lock = threading.Lock()
+        # job_id -> priority class of the claimed jobs
+        self._running = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-consumer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        """Stop the claiming thread; the jobs already claimed keep running but their leases are no longer renewed."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def running_count(self):
+        with self._lock:
+            return len(self._running)
+
+    def _finish(self, job_id):
+        with self._lock:
+            self._running.pop(job_id, None)
+        self._slots.release()
+
+    def _renew(self):
+        with self._lock:
+            job_ids = list(self._running)
+        if job_ids:
+            self.store.renew(job_ids, self.worker, self.lease_seconds)
+
+    def _run(self):
+        renewed_at = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() - renewed_at >= self.lease_seconds / 3:
+                try:
+                    self._renew()
+                    renewed_at = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Could not renew job leases: {e}")
+            if draining.is_set():
+                # Leave the queue to the other workers but keep renewing the leases of the jobs still running
+                self._stop.wait(self.poll_seconds)
+                continue
+            if not self._slots.acquire(timeout=self.poll_seconds):
+                continue
+            with self._lock:
+                running_bulk = list(self._running.values()).count("bulk")
+            priorities = PRIORITY_CLASSES if running_bulk < executor.bulk_workers else ("interactive",)
+            try:
+                claimed = self.store.claim(self.worker, self.lease_seconds, priorities)
+            except Exception as e:
+                logger.error(f"Could not claim a job: {e}")
+                claimed = None
+            if claimed is None:
+                self._slots.release()
+                self._stop.wait(self.poll_seconds)
+                continue
+            job_id, task, priority = claimed
+            with self._lock:
+                self._running[job_id] = priority
+            logger.info(f"Claimed {priority} job {job_id}")
+            submit_queued_job(job_id, task, priority).add_done_callback(lambda future, job_id=job_id: self._finish(job_id))
+
+job_consumer = None
+
+def create_job(user_id, project_number, floor_number, image_name, idempotency_key=None):
+    """Register a new job and return (job_id, created); see LocalJobStore.create."""
+    return job_store.create(user_id, project_number, floor_number, image_name, idempotency_key)
+
+def discard_job(job_id):
+    """Forget a job whose upload was rejected before it was queued."""
+    job_store.discard(job_id)
+
+def update_job(job_id, **fields):
+    """Update the stored state of a job."""
+    job_store.update(job_id, **fields)
+
+def count_unfinished_jobs():
+    """
+    Return the number of jobs this server still has to finish: every queued and running job with the local
+    broker, and the jobs it claimed with a shared one.
+    """
+    if job_consumer is not None:
+        return job_consumer.running_count()
+    if job_store.shared:
+        return 0
+    counts = job_store.counts()
+    return counts["queued"] + counts["running"]
+
+def submit_queued_job(job_id, task, priority):
+    """Submit a queued job to the executor in its priority class, taking turns with the other users and projects."""
+    user_id, project_number = task[1][:2]
+    return executor.submit(run_queued_job, job_id, task, priority, user_id=user_id, project_number=project_number, priority=priority)
+
+def run_queued_job(job_id, task, priority="interactive"):
+    """Run the task of a queued job."""
+    kind, args = task
+    if kind == "batch":
+        run_batch_job(job_id, *args, priority=priority)
+    else:
+        run_job(job_id, *args, priority=priority)
+
+def run_job(job_id, user_id, project_number, floor_number, folder_name, original_img_directory, filename, priority="interactive"):
+    """Run inference for one uploaded image in the executor and record the outcome on the job."""
+    update_job(job_id, status="running")
+    try:
+        processed_files = run_inference(user_id, project_number, floor_number, folder_name, original_img_directory, priority)
+        if filename not in processed_files:
+            raise RuntimeError("File processing failed")
+        result = post_inference_results(user_id, project_number, floor_number, filename)
+        update_job(job_id, status="done", result=result)
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {str(e)}")
+        update_job(job_id, status="failed", error=str(e))
+    finally:
+        # The folder is only subject to retention once its job no longer writes to it
+        if artifact_retention is not None:
+            artifact_retention.record(os.path.dirname(original_img_directory), user_id, project_number, floor_number)
+
+def run_batch_job(job_id, user_id, project_number, floor_number, images_dirs, priority="bulk"):
+    """
+    Run inference for the images of a batch upload in the executor and record the outcome on the job.
+    The job is done when at least one image was processed; the images that failed are listed in its result.
+    """
+    update_job(job_id, status="running")
+    try:
+        processed_files, failed = process_image_folders(user_id, project_number, floor_number, images_dirs, priority)
+        if not processed_files:
+            raise RuntimeError(f"File processing failed: {next(iter(failed.values()), 'no images')}")
+        update_job(job_id, status="done", result={
+            "message": "Inference results ready",
+            "user_id": user_id,
+            "project_number": project_number,
+            "floor_number": floor_number,
+            "images": post_batch_inference_results(user_id, project_number, floor_number, processed_files),
+            "failed": {image_name: str(error) for image_name, error in failed.items()}
+        })
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {str(e)}")
+        update_job(job_id, status="failed", error=str(e))
+    finally:
+        if artifact_retention is not None:
+            for images_dir in images_dirs:
+                artifact_retention.record(os.path.dirname(images_dir), user_id, project_number, floor_number)
+
+def job_status(job):
+    """Return the public view of a job."""
+    status = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "user_id": job["user_id"],
+        "project_number": job["project_number"],
+        "floor_number": job["floor_number"],
+        "image_name": job["image_name"],
+        "created_at": datetime.fromtimestamp(job["created_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+        "updated_at": datetime.fromtimestamp(job["updated_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+        "error": job["error"]
+    }
+    if "image_names" in job:
+        status["image_names"] = job["image_names"]  # Batch jobs
+    return status
+
+def check_accepting_uploads():
+    """Refuse uploads on worker pods, until the models are ready (API pods load none) and once the server is draining."""
+    if SERVER_ROLE == "worker":
+        raise HTTPException(status_code=503, detail="This server only runs queued jobs, send uploads to the API service")
+    if draining.is_set():
+        raise HTTPException(status_code=503, detail="Server is shutting down, please retry later", headers={"Retry-After": "30"})
+    if SERVER_ROLE != "api" and not models_ready.is_set():
+        raise HTTPException(status_code=503, detail="Models are loading, please retry later", headers={"Retry-After": "10"})
+
+def job_accepted_response(job_id, message):
+    """Return the 202 response that points the client to a queued job."""
+    return JSONResponse(
+        content={
+            "message": message,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "result_url": f"/jobs/{job_id}/result"
+        },
+        status_code=202 # status code 202 indicates the job was queued
+    )
+
+# Upload images sent by the client and queue them for processing
 @app.post("/receive_data")
 async def upload_file(
     user_id: str = Form(...),
     project_number: str = Form(...),
     floor_number: str = Form(...),
     date: str = Form(...),
-    images: UploadFile = File(...)
+    images: UploadFile = File(...),
+    priority: str = Form(None),
+    idempotency_key: str = Header(None)
 ):
     """
-    Handle file uploads from the client, including processing and saving images.
-    Results are generated based on the uploaded images and stored in the appropriate directories.
+    Handle file uploads from the client and queue them for processing.
+    The upload is saved to disk and a job ID is returned immediately with status 202.
+    Clients follow the job through /jobs/{job_id} and /jobs/{job_id}/result.
+    A retry that repeats the Idempotency-Key header of an earlier upload gets the earlier job back.
+    The priority field puts the job in the "interactive" (default) or "bulk" class.
     """    
     try:
-        # Initialize the processor to handle image-related tasks
-        initialize_processor()
+        check_accepting_uploads()
+        priority = FairScheduler.priority_of(priority, "interactive")
 
         # Define the directory structure based on the user, project, and floor numbers
         user_directory = os.path.join(BASE_UPLOAD_DIRECTORY, user_id)
@@ -246,6 +1405,14 @@ async def upload_file(
         
         # Create a folder based on the original filename and timestamp (excluding the extension)
         folder_name = f"{original_filename}_{timestamp}"
+        filename = f"{original_filename}_{timestamp}{file_extension}"
+
+        # Reserve a slot in the job queue before touching the disk
+        job_id, created = await asyncio.to_thread(create_job, user_id, project_number, floor_number, filename, idempotency_key)
+        if job_id is None:
+            raise HTTPException(status_code=429, detail="Job queue is full, please retry later", headers={"Retry-After": "30"})
+        if not created:
+            return job_accepted_response(job_id, "Upload already accepted")
 
         # Create the full directory path to save the file
         image_folder = os.path.join(floor_directory, folder_name)
@@ -256,83 +1423,396 @@ async def upload_file(
         os.makedirs(original_img_directory, exist_ok=True)
 
         # Save the uploaded image
-        filename = f"{original_filename}_{timestamp}{file_extension}"
         file_location = os.path.join(original_img_directory, filename)
         
-        with open(file_location, "wb") as file:
-            file.write(await images.read())
+        try:
+            await save_upload_file(images, file_location, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE)
+        except Exception:
+            await asyncio.to_thread(discard_job, job_id)
+            shutil.rmtree(image_folder, ignore_errors=True)
+            raise
 
-        # Process the uploaded file asynchronously using a thread pool
-        future = executor.submit(process_user_data, user_id, project_number, floor_number, folder_name, original_img_directory)
-        processed_files = future.result()
+        # Process the uploaded file in the background, in the thread pool or on a worker pod
+        await asyncio.to_thread(
+            job_store.enqueue, job_id, ("image", [user_id, project_number, floor_number, folder_name, original_img_directory, filename]), priority
+        )
 
-        if filename not in processed_files:
-            raise HTTPException(status_code=500, detail="File processing failed")
+        return job_accepted_response(job_id, "Upload accepted")
 
-        # Send back the inference results after processing
-        response_data = post_inference_results(user_id, project_number, floor_number, filename)
-        
-        return response_data
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error during file upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Upload the images of a whole floor at once and queue them as one job
+@app.post("/receive_batch")
+async def upload_batch(
+    user_id: str = Form(...),
+    project_number: str = Form(...),
+    floor_number: str = Form(...),
+    images: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    priority: str = Form(None),
+    idempotency_key: str = Header(None)
+):
+    """
+    Handle a batch upload of many images of one floor, sent as several 'images' files and/or one ZIP 'archive'.
+    Each image gets its own folder as with /receive_data, but the batch is one job: its images are processed
+    together through the worker pool, their results are recorded in one write, and /jobs/{job_id}/result
+    returns the results of every image. The priority field puts the job in the "bulk" (default) or "interactive" class.
+    """
+    images = images or []
+    try:
+        check_accepting_uploads()
+        priority = FairScheduler.priority_of(priority, "bulk")
+        if not images and archive is None:
+            raise HTTPException(status_code=400, detail="Send the images as 'images' files or as a ZIP 'archive'")
+        if len(images) > BATCH_UPLOAD_MAX_IMAGES:
+            raise HTTPException(status_code=413, detail=f"A batch can hold at most {BATCH_UPLOAD_MAX_IMAGES} images")
+        image_names = [os.path.basename(upload.filename) for upload in images]
+        unsupported = [image_name for image_name in image_names if not image_name.lower().endswith(IMAGE_EXTENSIONS)]
+        if unsupported:
+            raise HTTPException(status_code=400, detail=f"Unsupported image files: {', '.join(unsupported)}")
+        # An image's folder is named after it without the extension, so two images may not share that name
+        duplicates = duplicate_base_names(image_names)
+        if duplicates:
+            raise HTTPException(status_code=400, detail=f"Every image in a batch needs a different name: {', '.join(duplicates)}")
+
+        floor_directory = os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # Reserve a slot in the job queue before touching the disk
+        job_id, created = await asyncio.to_thread(create_job, user_id, project_number, floor_number, None, idempotency_key)
+        if job_id is None:
+            raise HTTPException(status_code=429, detail="Job queue is full, please retry later", headers={"Retry-After": "30"})
+        if not created:
+            return job_accepted_response(job_id, "Upload already accepted")
+
+        os.makedirs(floor_directory, exist_ok=True)
+        staging_directory = tempfile.mkdtemp(prefix=".batch_", dir=floor_directory)
+        image_folders = []
+        try:
+            staged_files = []
+            for upload, image_name in zip(images, image_names):
+                staged_path = os.path.join(staging_directory, image_name)
+                await save_upload_file(upload, staged_path, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE)
+                staged_files.append((image_name, staged_path))
+            if archive is not None:
+                archive_path = os.path.join(staging_directory, ".archive.zip")
+                await save_upload_file(archive, archive_path, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE)
+                archive_directory = os.path.join(staging_directory, "archive")
+                os.makedirs(archive_directory)
+                archive_names = await asyncio.to_thread(
+                    extract_archive_images, archive_path, archive_directory, BATCH_UPLOAD_MAX_IMAGES - len(images),
+                    MAX_UPLOAD_BYTES, IMAGE_EXTENSIONS, UPLOAD_CHUNK_SIZE
+                )
+                duplicates = duplicate_base_names(image_names + archive_names)
+                if duplicates:
+                    raise HTTPException(status_code=400, detail=f"Every image in a batch needs a different name: {', '.join(duplicates)}")
+                staged_files.extend((image_name, os.path.join(archive_directory, image_name)) for image_name in archive_names)
+            if not staged_files:
+                raise HTTPException(status_code=400, detail="The batch holds no images")
+
+            # Give every image the folder /receive_data would have created for it
+            filenames = []
+            for image_name, staged_path in staged_files:
+                original_filename, file_extension = os.path.splitext(image_name)
+                image_folder = os.path.join(floor_directory, f"{original_filename}_{timestamp}")
+                image_folders.append(image_folder)
+                os.makedirs(os.path.join(image_folder, "original_img"), exist_ok=True)
+                filename = f"{original_filename}_{timestamp}{file_extension}"
+                os.replace(staged_path, os.path.join(image_folder, "original_img", filename))
+                filenames.append(filename)
+        except Exception:
+            await asyncio.to_thread(discard_job, job_id)
+            for image_folder in image_folders:
+                shutil.rmtree(image_folder, ignore_errors=True)
+            raise
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
 
+        await asyncio.to_thread(update_job, job_id, image_names=filenames)
+        await asyncio.to_thread(job_store.enqueue, job_id, ("batch", [user_id, project_number, floor_number,
+                                [os.path.join(image_folder, "original_img") for image_folder in image_folders]]), priority)
+        return job_accepted_response(job_id, f"Batch of {len(filenames)} images accepted")
+
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error during file upload and processing: {str(e)}")
+        logger.error(f"Error during batch upload: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return the current status of a queued job."""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job_status(job)
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    Return the result of a finished job.
+    Responds with 202 while the job is still queued or running, and 500 if it failed.
+    """
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    if job["status"] == "done":
+        return JSONResponse(content=job["result"], status_code=200)
+    if job["status"] == "failed":
+        return JSONResponse(content={"message": job["error"], "job_id": job_id}, status_code=500)
+    return JSONResponse(content=job_status(job), status_code=202)
+
+# Threads that run process_image, for processors without process_batch and for retrying a failed batch
+image_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+image_batcher = MicroBatcher(lambda items: run_image_batch(processor, items, image_executor), BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+# Staged pipeline, created once the processor is loaded when INFERENCE_PIPELINE is "staged"
+image_pipeline = None
+# Result cache, opened at startup when RESULT_CACHE_ENABLED is set
+result_cache = None
+# Tiled inference for large plans, created once the processor is loaded when TILED_INFERENCE_ENABLED is set
+tiled_inference = None
+# Retention index and sweeper of the upload tree, started with the server when RETENTION_ENABLED is set
+artifact_retention = None
+
+def create_image_pipeline(stage_problems):
+    """
+    Build the staged pipeline from the processor's stage methods: the background crop runs first, then
+    segmentation, detection and OOB run in parallel on the cropped plan.
+    Returns None, so images run on the "batched" path, when check_stage_methods found stage_problems.
+    """
+    if stage_problems:
+        logger.warning(f"FloorPlanProcessor stage methods cannot be used ({'; '.join(stage_problems)}); "
+                       "using the batched path instead of the staged pipeline")
+        return None
+    methods = {stage: getattr(processor, name) for stage, name in PIPELINE_STAGE_METHODS.items()}
+
+    def step(method):
+        return lambda item: method(*item)
+
+    return StagedPipeline([
+        ("crop", [("crop", step(methods["crop"]))]),
+        ("analysis", [(stage, step(methods[stage])) for stage in ("segmentation", "detection", "oob")])
+    ], PIPELINE_STAGE_WORKERS, PIPELINE_QUEUE_SIZE)
+
+def create_tiled_inference(stage_problems):
+    """
+    Set up tiled inference when TILED_INFERENCE_ENABLED is set. Tiles run through the processor's stage methods,
+    so None is returned when check_stage_methods found stage_problems.
+    """
+    if not TILED_INFERENCE_ENABLED:
+        return None
+    if stage_problems:
+        logger.warning(f"FloorPlanProcessor stage methods cannot be used ({'; '.join(stage_problems)}); large images will not be tiled")
+        return None
+    return TiledInference(
+        processor, PIPELINE_STAGE_METHODS, TILE_SIZE, TILE_OVERLAP, TILE_MIN_IMAGE_SIZE, TILE_WORKERS,
+        TILE_NMS_IOU, TILE_NMS_CONTAINMENT, process_pool, TILE_OUTPUT_SCHEMA
+    )
+
+def submit_image(item, priority="interactive"):
+    """
+    Submit an (image_name, crop_image_dir, save_json_dir, save_image_dir) item to the configured inference path;
+    the micro-batcher runs the items of a higher priority class first.
+    """
+    if tiled_inference is not None and tiled_inference.wants(item):
+        return tiled_inference.submit(item)
+    if process_pool is not None:
+        return process_pool.submit(run_image_in_worker, item)
+    if image_pipeline is not None:
+        return image_pipeline.submit(item)
+    if hasattr(processor, "process_batch"):
+        return image_batcher.submit(item, priority)
+    return image_executor.submit(processor.process_image, *item)
+
 # Handle image processing and saving results
-def process_user_data(user_id, project_number, floor_number, image_base_name, images_dir):
+def process_user_data(user_id, project_number, floor_number, image_base_name, images_dir, priority="interactive"):
     """
     Process images using the FloorPlanProcessor and store the processed data.
+    Images are submitted to the shared micro-batcher or inference threads, to the staged pipeline when it is
+    enabled, or one by one to the worker processes in process mode, so they run alongside images from other requests.
     Results include segmentation, detection, and cropping.
     """
-    image_folder = os.path.dirname(images_dir)
-    save_json_dir = os.path.join(image_folder, 'json')
-    save_image_dir = os.path.join(image_folder, 'images')
-    crop_image_dir = os.path.join(image_folder, 'cropped')
+    processed_files, failed = process_image_folders(user_id, project_number, floor_number, [images_dir], priority)
+    if failed:
+        raise next(iter(failed.values()))
+    return processed_files
 
-    # Ensure that the necessary directories exist for storing processed data
-    os.makedirs(save_json_dir, exist_ok=True)
-    os.makedirs(save_image_dir, exist_ok=True)
-    os.makedirs(crop_image_dir, exist_ok=True)
+def process_image_folders(user_id, project_number, floor_number, images_dirs, priority="bulk"):
+    """
+    Process the images of several upload folders (their original_img directories) together: up to
+    BATCH_IMAGES_IN_FLIGHT images are submitted at once, and the registry is written once for all of them.
+    The result manifest of every processed image is written before returning.
+    Returns the processed image names and a dict of the images that failed with their exceptions.
+    """
+    # The models are normally loaded at startup; this only loads them if the lifespan hook did not run
+    initialize_processor()
 
     processed_files = []
-    
-    # Process each image in the directory
-    for image_name in os.listdir(images_dir):
-        if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-            #logger.info(f"Processing image {image_name}...")
-            if not is_image_processed(user_id, project_number, floor_number, image_name):
-                try:
-                    # Call the processor to generate the necessary results
-                    #logger.info(f"Saving JSON files to {save_json_dir}, images to {save_image_dir}, and cropped images to {crop_image_dir}")
-                    processor.process_image(image_name, crop_image_dir, save_json_dir, save_image_dir)
-                    #logger.info(f"Processed and saved image: {image_name}")
-                    
-                    # Mark the image as processed
-                    log_image_as_processed(user_id, project_number, floor_number, image_name)
+    newly_processed = []
+    pending = []
+    in_flight = threading.BoundedSemaphore(BATCH_IMAGES_IN_FLIGHT)
+
+    for images_dir in images_dirs:
+        image_folder = os.path.dirname(images_dir)
+        save_json_dir = os.path.join(image_folder, 'json')
+        save_image_dir = os.path.join(image_folder, 'images')
+        crop_image_dir = os.path.join(image_folder, 'cropped')
+
+        # Ensure that the necessary directories exist for storing processed data
+        os.makedirs(save_json_dir, exist_ok=True)
+        os.makedirs(save_image_dir, exist_ok=True)
+        os.makedirs(crop_image_dir, exist_ok=True)
+
+        # Queue each new image in the directory for processing
+        for image_name in os.listdir(images_dir):
+            if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                if result_cache is not None:
+                    # The image content, not its name, decides whether it was already processed
+                    cache_key = result_cache.key_for(os.path.join(images_dir, image_name))
+                    if result_cache.restore(cache_key, image_name, image_folder):
+                        logger.info(f"Reused cached results for image {image_name}.")
+                        newly_processed.append((user_id, project_number, floor_number, image_name))
+                        processed_files.append(image_name)
+                        continue
+                elif is_image_processed(user_id, project_number, floor_number, image_name):
+                    logger.info(f"Image {image_name} was already processed.")
                     processed_files.append(image_name)
-                except Exception as e:
-                    logger.error(f"Error processing image {image_name}: {e}")
-                    raise e
-            else:
-                logger.info(f"Image {image_name} was already processed.")
-                processed_files.append(image_name)
-    
-    return processed_files
+                    continue
+                else:
+                    cache_key = None
+                # The processor generates the necessary results once the image's batch runs; images of other
+                # jobs join the micro-batcher between the ones of a large batch
+                in_flight.acquire()
+                future = submit_image((image_name, crop_image_dir, save_json_dir, save_image_dir), priority)
+                future.add_done_callback(lambda _: in_flight.release())
+                pending.append((image_name, future, cache_key, image_folder, [crop_image_dir, save_json_dir, save_image_dir]))
+
+    failed = {}
+    for image_name, future, cache_key, image_folder, output_dirs in pending:
+        try:
+            future.result()
+            newly_processed.append((user_id, project_number, floor_number, image_name))
+            processed_files.append(image_name)
+        except Exception as e:
+            logger.error(f"Error processing image {image_name}: {e}")
+            failed[image_name] = e
+            continue
+        if cache_key is not None:
+            try:
+                result_cache.store(cache_key, image_name, image_folder, output_dirs)
+            except Exception as e:
+                logger.warning(f"Could not cache results for image {image_name}: {e}")
+
+    # Mark the new images as processed in a single write, keeping the ones that succeeded on failure
+    log_images_as_processed(newly_processed)
+    for image_name in processed_files:
+        try:
+            write_image_manifest(user_id, project_number, floor_number, image_name)
+        except Exception as e:
+            # Reading the results writes the manifest when it is missing
+            logger.warning(f"Could not write the result manifest of image {image_name}: {e}")
+    return processed_files, failed
+
+@app.get("/batching_stats")
+async def batching_stats():
+    """Return batch size and queue wait statistics of the image micro-batcher."""
+    return image_batcher.stats()
+
+@app.get("/scheduler_stats")
+async def scheduler_stats():
+    """Return the queued and running jobs of each priority class and their queue-time SLO misses."""
+    return executor.stats()
+
+@app.get("/pipeline_stats")
+async def pipeline_stats():
+    """Return per-stage latency and queue depth of the staged inference pipeline."""
+    if image_pipeline is None:
+        return JSONResponse(content={"message": "Staged pipeline is not enabled"}, status_code=404)
+    return image_pipeline.stats()
+
+@app.get("/retention_stats")
+async def retention_stats():
+    """Return the size of the upload tree and what the retention sweeper of this process deleted."""
+    if artifact_retention is None:
+        return JSONResponse(content={"message": "Retention is not enabled"}, status_code=404)
+    return await asyncio.to_thread(artifact_retention.stats)
+
+@app.get("/registry_stats")
+async def registry_stats():
+    """Return how the processed-image registry writes of this process were merged by its writer thread."""
+    if not isinstance(processed_image_registry, SingleWriterRegistry):
+        return JSONResponse(content={"message": "The registry has no single writer"}, status_code=404)
+    return processed_image_registry.stats()
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Return hit/miss counters and size of the inference result cache. Counters are kept per process."""
+    if result_cache is None:
+        return JSONResponse(content={"message": "Result cache is not enabled"}, status_code=404)
+    return await asyncio.to_thread(result_cache.stats)
+
+register_state_collector(ServerStateCollector())
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request counts and latencies, inference stage timings, queue and store state."""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Merge the samples every worker process wrote to the shared directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(ServerStateCollector())
+    # The collectors query the job store and the upload tree
+    return Response(content=await asyncio.to_thread(generate_latest, registry), media_type=CONTENT_TYPE_LATEST)
+
+# Health check endpoints
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness probe: the process is serving requests and its startup has not failed. Stays up while loading and draining."""
+    if startup_error is not None:
+        return health_response("failed", 503, error=str(startup_error))
+    return health_response("alive")
+
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness probe: the models are warmed up, the server is not draining and the job queue is below READINESS_MAX_QUEUED_JOBS.
+    API pods load no models, and worker pods stay ready however long the queue they work off is.
+    """
+    queued_jobs = (await asyncio.to_thread(job_store.counts))["queued"]
+    reasons = []
+    if SERVER_ROLE != "api" and not models_ready.is_set():
+        reasons.append("models are loading")
+    if draining.is_set():
+        reasons.append("server is draining")
+    if SERVER_ROLE != "worker" and queued_jobs > READINESS_MAX_QUEUED_JOBS:
+        reasons.append(f"{queued_jobs} jobs are queued")
+    if reasons:
+        return health_response("not ready", 503, reasons=reasons, queued_jobs=queued_jobs)
+    return health_response("ready", queued_jobs=queued_jobs)
+
+@app.post("/drain")
+async def start_drain():
+    """
+    Stop taking uploads ahead of a shutdown: readiness fails and /receive_data returns 503 while queued jobs finish.
+    Meant for a Kubernetes preStop hook; the jobs left are drained again on shutdown.
+    """
+    draining.set()
+    unfinished = await asyncio.to_thread(count_unfinished_jobs)
+    logger.info(f"Draining with {unfinished} unfinished jobs")
+    return {"status": "draining", "unfinished_jobs": unfinished}
 
-# Health check endpoint
 @app.get("/health")
 async def health_check():
-    """Endpoint for checking the health status of the server."""
-    return {"status": "healthy"}
-
-# Manage server startup and shutdown
-@asynccontextmanager
-async def lifespan(app):
-    """Manage the server's startup and shutdown events."""
-    logger.info("Server starting up")
-    yield
-    logger.info("Server shutting down")
+    """Endpoint for checking the health status of the server; kept for existing checks, see /health/live and /health/ready."""
+    if startup_error is not None:
+        return health_response("failed", 503, error=str(startup_error))
+    return health_response("healthy")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, timeout_graceful_shutdown=SHUTDOWN_CONNECTION_TIMEOUT_SECONDS)
@@ -1,26 +1,29 @@
-import threading
+import asyncio
+import importlib
 import os
+import sys
 
-def run_script(script_name):
-    """
-    Function to run a script using os.system.
-    """
-    os.system(f"python3 {script_name}")
+# The async client lives one directory up, shared by both servers
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+from floorplan_client import floor_plans_from_user_data, submit_all
+
+# Remote server URL
+SERVER_URL = "http://your ip:port"
+# Number of uploads in flight at once
+CONCURRENCY = 8
 
 def main():
-    # List of user scripts to run in parallel
+    # User scripts whose USER_DATA is submitted together
     scripts = ["user1.py", "user2.py", "user3.py"]
     #scripts = ["user1.py"]
-    # Create and start a thread for each script
-    threads = []
+    # Collect every floor plan and submit them concurrently over one connection pool
+    floor_plans = []
     for script in scripts:
-        thread = threading.Thread(target=run_script, args=(script,))
-        thread.start()
-        threads.append(thread)
+        module = importlib.import_module(os.path.splitext(script)[0])
+        floor_plans.extend(floor_plans_from_user_data(module.USER_DATA))
 
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    asyncio.run(submit_all(SERVER_URL, floor_plans, concurrency=CONCURRENCY))
 
     print("All scripts have finished execution.")
 
@@ -1,22 +1,210 @@
 import os
 import json
-import base64
+import asyncio
+import functools
+import io
+import multiprocessing
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import tempfile
+import time
+import uuid
 import zipfile
+from typing import List
+from multiprocessing import resource_tracker
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse
 from datetime import datetime
 import logging
 from logging.handlers import RotatingFileHandler
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from src.utils.processor import FloorPlanProcessor
+# The serving machinery shared with the URL server lives one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from floorplan_serving import (
+    ENCODE_SECONDS, INFERENCE_STAGE_SECONDS, PRIORITY_CLASSES, STORE_SECONDS, ArtifactRetention, FairScheduler,
+    MicroBatcher, ResultCache, ResultLog, SingleWriterRegistry, SqliteResultLog, StagedPipeline, TiledInference,
+    check_stage_methods, claim_sqlite_job, create_processed_image_registry, duplicate_base_names,
+    extract_archive_images, health_response, load_json_data, read_result_manifest, record_request_metrics,
+    register_state_collector, resolve_processor_config, run_image_batch, save_json_data, save_upload_file,
+    write_result_manifest
+)
 
 
 # Base directory for all uploaded files
 BASE_UPLOAD_DIRECTORY = "/home/cadian/project/ai_ce_main/receive_data"
 PROCESSED_IMAGES_FILE = "processed_images.json"
 INFERENCE_RESULTS_FILE = "inference_results.json"
+# Inference results are appended per user to a segmented log in this directory; the legacy
+# inference_results.json is imported once
+RESULTS_DIRECTORY = "inference_results"
+# The results are already in the ZIP response, so the log is a history that nobody acknowledges: the newest
+# RESULTS_KEEP_PER_USER results of each user are kept, and older ones are dropped in steps of RESULTS_TRIM_STEP
+RESULTS_KEEP_PER_USER = 1000
+RESULTS_TRIM_STEP = 100
+# Each user's log is split into segments of about RESULTS_SEGMENT_BYTES; the oldest segment is compacted
+# once more than RESULTS_COMPACT_RATIO of its results are dropped
+RESULTS_SEGMENT_BYTES = 4 * 1024 * 1024
+RESULTS_COMPACT_RATIO = 0.5
+# Sync every appended result to disk before it is reported; concurrent appends share one fsync
+RESULTS_FSYNC = True
+# Each processed image folder gets a manifest of the files in RESULT_FOLDERS (path, size, SHA-256 and content type),
+# written once after inference; result records and ZIP responses are built from it instead of probing the folders
+RESULT_MANIFEST_FILENAME = "manifest.json"
+RESULT_FOLDERS = ('json', 'images', 'cropped', 'original_img')
 LOG_FILE = "server.log"
+# Processed-image registry backend: "sqlite" (indexed, concurrency-safe) or "json" (legacy file)
+PROCESSED_IMAGES_BACKEND = "sqlite"
+PROCESSED_IMAGES_DB = "processed_images.db"
+# Registry writes from all threads go through one writer thread, which merges the writes arriving within
+# REGISTRY_WRITE_MAX_WAIT_MS into one transaction (one file rewrite for the json backend)
+REGISTRY_SINGLE_WRITER = True
+REGISTRY_WRITE_MAX_BATCH = 256
+REGISTRY_WRITE_MAX_WAIT_MS = 5
+# Micro-batching window: images arriving within BATCH_MAX_WAIT_MS are sent to the processor together
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 20
+# Only processors that provide process_batch are micro-batched; otherwise process_image runs on up to this many
+# images at once, and a failed batch is retried one image per thread
+INFERENCE_THREADS = 5
+# Uploads are streamed to disk in chunks and rejected with 413 beyond MAX_UPLOAD_BYTES
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+# /receive_batch takes up to BATCH_UPLOAD_MAX_IMAGES images per request, as files or in a ZIP archive whose
+# extracted images may not exceed MAX_UPLOAD_BYTES
+BATCH_UPLOAD_MAX_IMAGES = 200
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# /health/ready fails while the models load, while draining, and when more requests than this wait for a worker
+READINESS_MAX_QUEUED_REQUESTS = 50
+# On shutdown, requests still being processed get this long to finish
+DRAIN_TIMEOUT_SECONDS = 300
+# Open connections get this long to close on shutdown before they are cut. A request's connection stays open until
+# its results are streamed back, so this is as long as the drain
+SHUTDOWN_CONNECTION_TIMEOUT_SECONDS = DRAIN_TIMEOUT_SECONDS
+# Scheduling of inference requests. Each upload runs in a priority class, set by the SCHEDULER_PRIORITY_FIELD form
+# field or else the default of its endpoint; queued interactive requests always start before bulk ones, and
+# SCHEDULER_INTERACTIVE_RESERVED_WORKERS executor workers never run bulk requests, so a backfill cannot hold them all.
+# Within a class, users take turns (and the projects of a user), each running at most SCHEDULER_MAX_RUNNING_PER_USER.
+# The classes themselves, highest first, are PRIORITY_CLASSES in floorplan_serving.
+SCHEDULER_PRIORITY_FIELD = "priority"
+SCHEDULER_INTERACTIVE_RESERVED_WORKERS = 1
+SCHEDULER_MAX_RUNNING_PER_USER = 2
+# Queue-time objective of each class: requests that waited longer for a worker count as SLO misses on /metrics
+SCHEDULER_QUEUE_SLO_SECONDS = {"interactive": 2, "bulk": 600}
+# Images of a batch upload in the micro-batcher or worker processes at once, so it does not delay the images of others
+BATCH_IMAGES_IN_FLIGHT = 8
+
+# Scale-out: "standalone" servers take uploads and run inference. With a shared JOB_BROKER, "api" pods only take
+# uploads, queue their inference in the broker and stream the results once a "worker" pod has run it, so both
+# tiers scale on their own. The role is read from the SERVER_ROLE environment variable so one image serves both tiers.
+SERVER_ROLE = os.environ.get("SERVER_ROLE", "standalone")
+# "local" runs inference in this process; "sqlite" queues it in JOB_BROKER_DB, which every pod must reach on
+# shared storage together with BASE_UPLOAD_DIRECTORY and the registry, and keeps the result log there too
+JOB_BROKER = "local"
+JOB_BROKER_DB = "jobs.db"
+# A job claimed by a worker that stops renewing its lease (e.g. the pod died) is queued again after this long
+JOB_LEASE_SECONDS = 120
+# The API pod waiting for a job marks it as waited for every third of JOB_WAIT_TIMEOUT_SECONDS; a queued job not
+# marked for this long belongs to a pod that died and is deleted instead of run
+JOB_WAIT_TIMEOUT_SECONDS = 5 * 60
+# Finished jobs are removed by the API pod that takes their result; ones left behind by a pod that died are
+# deleted after this long
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+# How often idle workers look for queued jobs, and API pods check the jobs their requests wait for
+JOB_POLL_SECONDS = 0.25
+# Result ZIPs are streamed as they are built; already-compressed images are stored, everything else deflated
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+ZIP_STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Where inference runs: "thread" shares one FloorPlanProcessor across the executor threads,
+# "process" sends every image to one of WORKER_PROCESSES worker processes that each hold their own models
+EXECUTION_MODE = "thread"
+# Model threads (torch and ONNX Runtime) per worker process; WORKER_PROCESSES x WORKER_THREADS should not exceed the cores
+WORKER_THREADS = 2
+WORKER_PROCESSES = max((os.cpu_count() or 1) // WORKER_THREADS, 1)
+# Pin each worker process to its own WORKER_THREADS cores, so the workers do not compete for them (Linux only)
+WORKER_CPU_AFFINITY = True
+# "forkserver" and "spawn" start the workers from a fresh interpreter that loads its own models. "fork" lets them
+# start from the parent's loaded models (copy-on-write), but forks a server that already runs threads (executor,
+# micro-batcher, model thread pools), so a worker can deadlock on a lock one of them held at the time
+WORKER_START_METHOD = "forkserver"
+# Image used for the warm-up inference at startup; a blank page is generated when None
+WARMUP_IMAGE_PATH = None
+# How images run through the models: "batched" micro-batches them (see INFERENCE_THREADS), "staged" runs crop,
+# segmentation, detection and OOB as pipeline stages with their own workers and bounded queues
+INFERENCE_PIPELINE = "batched"
+PIPELINE_STAGE_WORKERS = 1
+PIPELINE_QUEUE_SIZE = 16
+# FloorPlanProcessor methods used for each pipeline stage and tile; each is called like process_image and writes
+# the files process_image writes for its stage (see check_stage_methods). They are checked on a test image at
+# startup, and whole images run on the "batched" path when they fail
+PIPELINE_STAGE_METHODS = {
+    "crop": "crop_background",
+    "segmentation": "segment",
+    "detection": "detect",
+    "oob": "detect_oob"
+}
+# Content-addressed cache of inference outputs, keyed by the image bytes and the model files
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_DIRECTORY = "result_cache"
+RESULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+# Retention of the upload tree: request folders unused for RETENTION_MAX_AGE_SECONDS are deleted, then the oldest ones
+# while a user holds more than RETENTION_MAX_USER_BYTES or the tree more than RETENTION_MAX_TOTAL_BYTES (None disables
+# a limit). Folders used in the last RETENTION_MIN_AGE_SECONDS are always kept. Sizes are kept in RETENTION_INDEX_DB.
+RETENTION_ENABLED = True
+RETENTION_INDEX_DB = "artifacts.db"
+RETENTION_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+RETENTION_MAX_USER_BYTES = 50 * 1024 ** 3
+RETENTION_MAX_TOTAL_BYTES = 500 * 1024 ** 3
+RETENTION_MIN_AGE_SECONDS = 60 * 60
+RETENTION_SWEEP_INTERVAL_SECONDS = 10 * 60
+
+# Tiled inference for large scans: cropped plans of TILE_MIN_IMAGE_SIZE pixels or more on a side are cut into
+# TILE_SIZE tiles overlapping by TILE_OVERLAP pixels (keep it above the largest fixture), run on TILE_WORKERS threads
+TILED_INFERENCE_ENABLED = False
+TILE_SIZE = 1536
+TILE_OVERLAP = 256
+TILE_MIN_IMAGE_SIZE = 4096
+TILE_WORKERS = 2
+# Detections from neighbouring tiles are duplicates above this IoU, or when this share of the smaller box overlaps
+TILE_NMS_IOU = 0.5
+TILE_NMS_CONTAINMENT = 0.8
+# Field names of the segment and detection JSON files the processor writes, which the tiles are merged by;
+# a processor declaring an OUTPUT_SCHEMA dict overrides them (see TiledInference)
+TILE_OUTPUT_SCHEMA = {
+    "segments": "segments", "detections": "detections", "class": "class_name", "box": "bbox", "score": "score",
+    "points": "points", "width": "width", "height": "height"
+}
+# Configuration for the different models and classes used for detection and segmentation
+PROCESSOR_CONFIG = {
+    'background_crop_model_path': './models/best_crop.pt',
+    'segmentation_model_path': './models/best_segmentation.pt',
+    'detection_model_paths': ['./models/best_detection.pt'],
+    'oob_model_path': './models/best_oob.pt',
+    'segmentation_classes': [
+        'wall', 'bed_room', 'bathroom', 'others', 'balcony', 'stairs',
+        'living_kitchen', 'entrance', 'utility_room', 'air_room',
+        'elevator', 'pantry', 'dressing_room', 'hallway'
+    ],
+    'detection_classes': [
+        'basin', 'bathtub', 'commode', 'door_dwouble', 'door_hinged',
+        'door_normal', 'elevator', 'gas', 'junc_I', 'junc_L', 'junc_T',
+        'junc_X', 'sink', 'stairs', 'window'
+    ],
+    'oob_classes': ['wall'],
+    # "torch" runs the .pt checkpoints; "onnx" runs the exports written by export_onnx.py with ONNX Runtime
+    'inference_backend': 'torch',
+    # With the onnx backend, "int8" runs the dynamically quantized exports instead of the float ones
+    'onnx_quantization': None,
+    # Threads of each ONNX Runtime session; 0 uses every core, so lower it when running several worker processes
+    'onnx_intra_op_threads': 0,
+    'onnx_inter_op_threads': 1
+}
 
 # Logging Configuration
 logging.basicConfig(
@@ -29,128 +217,938 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared ImageProcessor, created once at startup by the lifespan hook; API pods have none
+image_processor = None
+# What uploads are submitted to: the ImageProcessor, or a BrokeredImageProcessor with a shared JOB_BROKER
+upload_processor = None
+# Shared job broker, and the consumer that runs its jobs on this pod's ImageProcessor
+job_store = None
+job_consumer = None
+# Retention index and sweeper of the upload tree, started with the server when RETENTION_ENABLED is set
+artifact_retention = None
+# Set once the server stops taking uploads; startup_error keeps a failed startup for the liveness probe
+draining = threading.Event()
+startup_error = None
+
+
+# Manage server startup and shutdown
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Manage the server's startup and shutdown events.
+    The models are loaded and warmed up before the server starts accepting requests.
+    """
+    global job_store
+    logger.info(f"Server starting up as {SERVER_ROLE}")
+    job_store = await asyncio.to_thread(SqliteJobStore.create, JOB_BROKER, SERVER_ROLE)
+    # Load the models in the background so /health/live answers while they load
+    startup = asyncio.create_task(start_image_processor())
+    await asyncio.to_thread(start_artifact_retention)
+    yield
+    logger.info("Server shutting down")
+    draining.set()
+    await startup
+    if upload_processor is not None and upload_processor is not image_processor:
+        await asyncio.to_thread(upload_processor.drain, DRAIN_TIMEOUT_SECONDS)
+        upload_processor.shutdown()
+    if image_processor is not None:
+        await asyncio.to_thread(image_processor.drain, DRAIN_TIMEOUT_SECONDS)
+        if job_consumer is not None:
+            job_consumer.close()
+        image_processor.shutdown()
+    if artifact_retention is not None:
+        artifact_retention.close()
+    if InferenceManager.registry is not None:
+        InferenceManager.registry.close()
+
+def start_artifact_retention():
+    """Open the artifact index and start the retention sweeper when RETENTION_ENABLED is set."""
+    global artifact_retention
+    if RETENTION_ENABLED:
+        artifact_retention = ArtifactRetention(
+            BASE_UPLOAD_DIRECTORY, RETENTION_INDEX_DB, InferenceManager.forget_processed_images, RETENTION_MAX_AGE_SECONDS,
+            RETENTION_MAX_USER_BYTES, RETENTION_MAX_TOTAL_BYTES, RETENTION_MIN_AGE_SECONDS, RETENTION_SWEEP_INTERVAL_SECONDS
+        )
+        artifact_retention.start()
+
+async def start_image_processor():
+    """
+    Create and start the shared ImageProcessor in a thread, and with a shared broker the consumer of its jobs
+    and the BrokeredImageProcessor uploads are queued through; a failure is kept in startup_error.
+    """
+    global image_processor, upload_processor, job_consumer, startup_error
+    try:
+        processor = None
+        if SERVER_ROLE != "api":
+            processor = await asyncio.to_thread(ImageProcessor)
+            await asyncio.to_thread(processor.start)
+        # Opening the result log imports a legacy inference_results.json before the first upload arrives
+        await asyncio.to_thread(InferenceManager.get_result_log)
+        image_processor = processor
+        if job_store is None:
+            upload_processor = processor
+        else:
+            if processor is not None:
+                job_consumer = JobConsumer(job_store, processor)
+                job_consumer.start()
+            if SERVER_ROLE != "worker":
+                brokered = BrokeredImageProcessor(job_store)
+                brokered.start()
+                upload_processor = brokered
+        logger.info("Server is ready")
+    except Exception as e:
+        startup_error = e
+        logger.exception(f"Server startup failed: {e}")
+
+
 # FastAPI app initialization
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(record_request_metrics)
 
 
 class FileManager:
     """Handles file management, loading, saving, and directory creation."""
 
-    @staticmethod
-    def load_json_data(filename):
-        """Load JSON data from a file."""
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                return json.load(f)
-        return {}
-
-    @staticmethod
-    def save_json_data(filename, data):
-        """Save JSON data to a file."""
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
+    load_json_data = staticmethod(load_json_data)
+    save_json_data = staticmethod(save_json_data)
 
     @staticmethod
     def create_directory(path):
         """Create a directory if it does not exist."""
         os.makedirs(path, exist_ok=True)
 
+    @staticmethod
+    async def save_upload_file(upload, destination):
+        """Stream an uploaded file to disk in UPLOAD_CHUNK_SIZE chunks, rejecting it above MAX_UPLOAD_BYTES."""
+        return await save_upload_file(upload, destination, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE)
+
+    @staticmethod
+    def extract_archive_images(archive_path, destination, max_images=BATCH_UPLOAD_MAX_IMAGES):
+        """Extract at most max_images IMAGE_EXTENSIONS images of an uploaded ZIP archive into destination and return their names."""
+        return extract_archive_images(archive_path, destination, max_images, MAX_UPLOAD_BYTES, IMAGE_EXTENSIONS, UPLOAD_CHUNK_SIZE)
+
+
+class ZipStreamer:
+    """Builds a ZIP archive on the fly and yields it in chunks, without writing the archive to disk."""
+
+    class _Sink(io.RawIOBase):
+        """Unseekable sink that collects what zipfile writes until the generator hands it out."""
+
+        def __init__(self):
+            super().__init__()
+            self._chunks = []
+            self._position = 0
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            self._chunks.append(bytes(data))
+            self._position += len(data)
+            return len(data)
+
+        def tell(self):
+            return self._position
+
+        def pop(self):
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            return data
+
+    @staticmethod
+    def compress_type(file_path):
+        """Store files that are already compressed (PNG/JPEG) and deflate the rest (JSON)."""
+        if file_path.lower().endswith(ZIP_STORED_EXTENSIONS):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    @staticmethod
+    def stream(entries):
+        """
+        Yield the bytes of a ZIP archive holding the given (file_path, arcname) entries as each file is read.
+        An entry whose first item is bytes instead of a path is stored with that content.
+        The time spent building the archive, not sending it, is recorded as the zip encode time.
+        """
+        chunks = ZipStreamer._generate(entries)
+        encode_seconds = 0.0
+        while True:
+            started = time.perf_counter()
+            try:
+                data = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                encode_seconds += time.perf_counter() - started
+            yield data
+        ENCODE_SECONDS.labels("zip").observe(encode_seconds)
+
+    @staticmethod
+    def _generate(entries):
+        sink = ZipStreamer._Sink()
+        with zipfile.ZipFile(sink, 'w') as zipf:
+            for file_path, arcname in entries:
+                if isinstance(file_path, bytes):
+                    zipf.writestr(arcname, file_path, compress_type=zipfile.ZIP_DEFLATED)
+                    yield sink.pop()
+                    continue
+                info = zipfile.ZipInfo.from_file(file_path, arcname)
+                info.compress_type = ZipStreamer.compress_type(file_path)
+                with open(file_path, "rb") as source, zipf.open(info, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as target:
+                    for chunk in iter(lambda: source.read(ZIP_STREAM_CHUNK_SIZE), b""):
+                        target.write(chunk)
+                        data = sink.pop()
+                        if data:
+                            yield data
+                data = sink.pop()
+                if data:
+                    yield data
+        # Closing the archive writes the central directory
+        yield sink.pop()
+
 
 class ImageProcessor:
     """Encapsulates the image processing logic."""
+
+    # Processor loaded in the parent before the worker processes are forked, with WORKER_START_METHOD "fork"
+    fork_parent_processor = None
+    # ImageProcessor used inside a worker process in "process" mode, and the index of that worker
+    worker = None
+    worker_index = None
     
-    def __init__(self, processor=None):
-        self.processor = processor or self._initialize_processor()
-        self.executor = ThreadPoolExecutor(max_workers=5)
+    def __init__(self, processor=None, execution_mode=EXECUTION_MODE):
+        # Worker processes default to their share of the cores rather than every core
+        self.processor_config = resolve_processor_config(PROCESSOR_CONFIG, WORKER_THREADS if ImageProcessor.worker_index is not None else 0)
+        self.processor = processor or self._initialize_processor(self.processor_config)
+        self.execution_mode = execution_mode
+        # Threads that run process_image, for processors without process_batch and for retrying a failed batch
+        self.image_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+        self.batcher = MicroBatcher(
+            lambda items: run_image_batch(self.processor, items, self.image_executor), BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+        )
+        stage_problems = None
+        if (INFERENCE_PIPELINE == "staged" and execution_mode == "thread") or (TILED_INFERENCE_ENABLED and execution_mode != "worker"):
+            stage_problems = check_stage_methods(self.processor, PIPELINE_STAGE_METHODS, WARMUP_IMAGE_PATH)
+        # In process mode whole images go to the worker processes instead of the pipeline
+        self.pipeline = self._create_pipeline(stage_problems) if INFERENCE_PIPELINE == "staged" and execution_mode == "thread" else None
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # In process mode enough requests have to run at once to keep every worker process busy
+        self.max_workers = max(5, WORKER_PROCESSES) if execution_mode == "process" else 5
+        self.process_pool = None
+        if execution_mode == "process":
+            ImageProcessor.fork_parent_processor = self.processor
+            mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+            if WORKER_START_METHOD == "forkserver":
+                # The fork server imports the processor module (and its model libraries) once for every worker
+                mp_context.set_forkserver_preload([FloorPlanProcessor.__module__])
+            # Forked workers share a resource tracker only if it runs before they start; otherwise each starts its
+            # own and claims the shared memory of tiled plans as leaked when it exits
+            resource_tracker.ensure_running()
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=WORKER_PROCESSES,
+                mp_context=mp_context,
+                initializer=ImageProcessor._init_worker_process,
+                initargs=(mp_context.Value("i", 0),)
+            )
+            self.executor = ImageProcessor._create_scheduler(self.max_workers)
+        elif execution_mode == "thread":
+            self.executor = ImageProcessor._create_scheduler(self.max_workers)
+        elif execution_mode == "worker":
+            self.executor = None  # Runs inside a worker process of another ImageProcessor
+        else:
+            raise ValueError(f"Unknown execution mode: {execution_mode}")
+        # Worker processes only run the images sent to them; caching, pipelining and tiling happen in the server
+        self.tiled_inference = self._create_tiled_inference(stage_problems) if execution_mode != "worker" else None
+        self.result_cache = None
+        if RESULT_CACHE_ENABLED and execution_mode != "worker":
+            tiling = self.tiled_inference.settings() if self.tiled_inference is not None else None
+            self.result_cache = ResultCache(RESULT_CACHE_DIRECTORY, RESULT_CACHE_MAX_BYTES, ResultCache.fingerprint_models(dict(self.processor_config, tiling=tiling)))
+
+    def start(self):
+        """Warm up the models and, in process mode, start every worker before requests arrive."""
+        self.warm_up()
+        if self.execution_mode == "process":
+            for future in [self.process_pool.submit(os.getpid) for _ in range(WORKER_PROCESSES)]:
+                future.result()
+            logger.info(f"Started {WORKER_PROCESSES} inference worker processes with {WORKER_THREADS} threads each")
+
+    def shutdown(self):
+        """Wait for running work to finish and stop the worker threads and processes owned by this processor."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if self.tiled_inference is not None:
+            self.tiled_inference.close()
+        self.batcher.close()
+        self.image_executor.shutdown(wait=True)
+
+    def _create_pipeline(self, stage_problems):
+        """
+        Build the staged pipeline from the processor's stage methods: the background crop runs first, then
+        segmentation, detection and OOB run in parallel on the cropped plan.
+        Returns None, so images run on the "batched" path, when check_stage_methods found stage_problems.
+        """
+        if stage_problems:
+            logger.warning(f"FloorPlanProcessor stage methods cannot be used ({'; '.join(stage_problems)}); "
+                           "using the batched path instead of the staged pipeline")
+            return None
+        methods = {stage: getattr(self.processor, name) for stage, name in PIPELINE_STAGE_METHODS.items()}
+
+        def step(method):
+            return lambda item: method(*item)
+
+        return StagedPipeline([
+            ("crop", [("crop", step(methods["crop"]))]),
+            ("analysis", [(stage, step(methods[stage])) for stage in ("segmentation", "detection", "oob")])
+        ], PIPELINE_STAGE_WORKERS, PIPELINE_QUEUE_SIZE)
+
+    def _create_tiled_inference(self, stage_problems):
+        """
+        Set up tiled inference when TILED_INFERENCE_ENABLED is set. Tiles run through the processor's stage methods,
+        so None is returned when check_stage_methods found stage_problems.
+        """
+        if not TILED_INFERENCE_ENABLED:
+            return None
+        if stage_problems:
+            logger.warning(f"FloorPlanProcessor stage methods cannot be used ({'; '.join(stage_problems)}); large images will not be tiled")
+            return None
+        return TiledInference(
+            self.processor, PIPELINE_STAGE_METHODS, TILE_SIZE, TILE_OVERLAP, TILE_MIN_IMAGE_SIZE, TILE_WORKERS,
+            TILE_NMS_IOU, TILE_NMS_CONTAINMENT, self.process_pool, TILE_OUTPUT_SCHEMA
+        )
+
+    def submit_image(self, item, priority="interactive"):
+        """
+        Submit an (image_name, crop_image_dir, save_json_dir, save_image_dir) item to the configured inference path;
+        the micro-batcher runs the items of a higher priority class first.
+        """
+        if self.tiled_inference is not None and self.tiled_inference.wants(item):
+            return self.tiled_inference.submit(item)
+        if self.process_pool is not None:
+            return self.process_pool.submit(ImageProcessor._run_image_in_worker, item)
+        if self.pipeline is not None:
+            return self.pipeline.submit(item)
+        if hasattr(self.processor, "process_batch"):
+            return self.batcher.submit(item, priority)
+        return self.image_executor.submit(self.processor.process_image, *item)
+
+    def submit(self, user_id, project_number, floor_number, image_base_name, images_dir, priority="interactive"):
+        """Submit process_images to the executor and return its Future; in process mode its images go to the worker processes."""
+        return self._track(self.executor.submit(
+            self.process_images, user_id, project_number, floor_number, image_base_name, images_dir, priority,
+            user_id=user_id, project_number=project_number, priority=priority
+        ))
+
+    def submit_batch(self, user_id, project_number, floor_number, images_dirs, priority="bulk"):
+        """Submit process_image_folders for the folders of a batch upload and return its Future."""
+        return self._track(self.executor.submit(
+            self.process_image_folders, user_id, project_number, floor_number, images_dirs, priority,
+            user_id=user_id, project_number=project_number, priority=priority
+        ))
+
+    def _track(self, future):
+        with self._in_flight_lock:
+            self._in_flight += 1
+        future.add_done_callback(self._finish_request)
+        return future
+
+    def _finish_request(self, future):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def drain(self, timeout):
+        """Wait until every submitted request has finished or the timeout has passed. Returns True when all finished."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._in_flight_lock:
+                in_flight = self._in_flight
+            if in_flight == 0:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Drain timed out after {timeout}s with {in_flight} requests unfinished")
+                return False
+            time.sleep(0.5)
+
+    def executor_state(self):
+        """Return (queued, active, max_workers) for the requests submitted to the executor."""
+        with self._in_flight_lock:
+            in_flight = self._in_flight
+        return max(in_flight - self.max_workers, 0), min(in_flight, self.max_workers), self.max_workers
+
+    @staticmethod
+    def _create_scheduler(max_workers):
+        """Create the fair-share scheduler the requests of this processor wait in for an executor worker."""
+        return FairScheduler(max_workers, SCHEDULER_INTERACTIVE_RESERVED_WORKERS, SCHEDULER_MAX_RUNNING_PER_USER, SCHEDULER_QUEUE_SLO_SECONDS)
+
+    @staticmethod
+    def _limit_worker_threads(index):
+        """Pin a worker process to its own WORKER_THREADS cores and size the torch thread pool to match."""
+        if WORKER_CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+            first = index * WORKER_THREADS
+            os.sched_setaffinity(0, {cores[(first + offset) % len(cores)] for offset in range(WORKER_THREADS)})
+        try:
+            import torch
+            torch.set_num_threads(WORKER_THREADS)
+        except ImportError:
+            pass
+
+    @staticmethod
+    def _init_worker_process(worker_counter):
+        """
+        Prepare a freshly started worker process for inference: give it its cores, then load and warm up the models.
+        Workers started with "fork" reuse the parent's loaded models (copy-on-write); with "forkserver" or "spawn"
+        they load their own.
+        """
+        with worker_counter.get_lock():
+            ImageProcessor.worker_index = worker_counter.value
+            worker_counter.value += 1
+        ImageProcessor._limit_worker_threads(ImageProcessor.worker_index)
+        ImageProcessor.worker = ImageProcessor(processor=ImageProcessor.fork_parent_processor, execution_mode="worker")
+        ImageProcessor.worker.warm_up()
+        TiledInference.worker_processor = ImageProcessor.worker.processor
 
     @staticmethod
-    def _initialize_processor():
+    def _run_image_in_worker(item):
+        """Run one (image_name, crop_image_dir, save_json_dir, save_image_dir) item on the models of this worker process."""
+        ImageProcessor.worker.processor.process_image(*item)
+
+    def warm_up(self):
+        """Run one inference on a throwaway image so the first real request does not pay for lazy initialization."""
+        warmup_folder = tempfile.mkdtemp(prefix="warmup_")
+        try:
+            original_img_directory = os.path.join(warmup_folder, "original_img")
+            crop_image_dir = os.path.join(warmup_folder, "cropped")
+            save_json_dir = os.path.join(warmup_folder, "json")
+            save_image_dir = os.path.join(warmup_folder, "images")
+            for directory in (original_img_directory, crop_image_dir, save_json_dir, save_image_dir):
+                FileManager.create_directory(directory)
+            image_name = "warmup.png"
+            if WARMUP_IMAGE_PATH:
+                shutil.copy(WARMUP_IMAGE_PATH, os.path.join(original_img_directory, image_name))
+            else:
+                import cv2
+                import numpy as np
+                cv2.imwrite(os.path.join(original_img_directory, image_name), np.full((1024, 1024, 3), 255, dtype=np.uint8))
+            started = time.monotonic()
+            self.processor.process_image(image_name, crop_image_dir, save_json_dir, save_image_dir)
+            logger.info(f"Warm-up inference finished in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"Warm-up inference failed: {e}")
+        finally:
+            shutil.rmtree(warmup_folder, ignore_errors=True)
+
+    @staticmethod
+    def _initialize_processor(processor_config):
         """Initialize the FloorPlanProcessor with its configuration."""
-        config = {
-            'background_crop_model_path': './models/best_crop.pt',
-            'segmentation_model_path': './models/best_segmentation.pt',
-            'detection_model_paths': ['./models/best_detection.pt'],
-            'oob_model_path': './models/best_oob.pt',
-            'segmentation_classes': [
-                'wall', 'bed_room', 'bathroom', 'others', 'balcony', 'stairs',
-                'living_kitchen', 'entrance', 'utility_room', 'air_room',
-                'elevator', 'pantry', 'dressing_room', 'hallway'
-            ],
-            'detection_classes': [
-                'basin', 'bathtub', 'commode', 'door_dwouble', 'door_hinged',
-                'door_normal', 'elevator', 'gas', 'junc_I', 'junc_L', 'junc_T',
-                'junc_X', 'sink', 'stairs', 'window'
-            ],
-            'oob_classes': ['wall']
-        }
-        return FloorPlanProcessor(config)
+        processor = ImageProcessor._instrument_processor(FloorPlanProcessor(processor_config))
+        logger.info(f"FloorPlanProcessor loaded ({PROCESSOR_CONFIG.get('inference_backend', 'torch')} backend)")
+        return processor
+
+    @staticmethod
+    def _instrument_processor(processor):
+        """
+        Time the FloorPlanProcessor model stages. The wrappers are set on the instance, so the calls
+        process_image makes to its own stage methods are timed as well.
+        """
+        def timed(method, histogram):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                with histogram.time():
+                    return method(*args, **kwargs)
+            return wrapper
 
-    def process_images(self, user_id, project_number, floor_number, image_base_name, images_dir):
-        """Process images using the FloorPlanProcessor."""
-        image_folder = os.path.dirname(images_dir)
-        save_json_dir = os.path.join(image_folder, 'json')
-        save_image_dir = os.path.join(image_folder, 'images')
-        crop_image_dir = os.path.join(image_folder, 'cropped')
+        for stage, method_name in list(PIPELINE_STAGE_METHODS.items()) + [("process_image", "process_image")]:
+            method = getattr(processor, method_name, None)
+            if method is not None:
+                setattr(processor, method_name, timed(method, INFERENCE_STAGE_SECONDS.labels(stage)))
+        return processor
 
-        # Create necessary directories
-        FileManager.create_directory(save_json_dir)
-        FileManager.create_directory(save_image_dir)
-        FileManager.create_directory(crop_image_dir)
+    def process_images(self, user_id, project_number, floor_number, image_base_name, images_dir, priority="interactive"):
+        """
+        Process images using the FloorPlanProcessor, submitting them through the micro-batcher, inference threads
+        or staged pipeline.
+        """
+        processed_files, failed = self.process_image_folders(user_id, project_number, floor_number, [images_dir], priority)
+        if failed:
+            raise next(iter(failed.values()))
+        return processed_files
 
+    def process_image_folders(self, user_id, project_number, floor_number, images_dirs, priority="bulk"):
+        """
+        Process the images of several upload folders (their original_img directories) together: up to
+        BATCH_IMAGES_IN_FLIGHT images are submitted at once, and the registry is written once for all of them.
+        The result manifest of every processed image is written before returning.
+        Returns the base names of the processed images and a dict of the images that failed with their exceptions.
+        """
         processed_files = []
+        processed_names = []
+        newly_processed = []
+        pending = []
+        in_flight = threading.BoundedSemaphore(BATCH_IMAGES_IN_FLIGHT)
+
+        for images_dir in images_dirs:
+            image_folder = os.path.dirname(images_dir)
+            save_json_dir = os.path.join(image_folder, 'json')
+            save_image_dir = os.path.join(image_folder, 'images')
+            crop_image_dir = os.path.join(image_folder, 'cropped')
+
+            # Create necessary directories
+            FileManager.create_directory(save_json_dir)
+            FileManager.create_directory(save_image_dir)
+            FileManager.create_directory(crop_image_dir)
 
-        for image_name in os.listdir(images_dir):
-            if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                logger.info(f"Processing image: {image_name} for user: {user_id}")
-                if not InferenceManager.is_image_processed(user_id, project_number, floor_number, image_name):
-                    try:
-                        self.processor.process_image(image_name, crop_image_dir, save_json_dir, save_image_dir)
-                        InferenceManager.log_image_as_processed(user_id, project_number, floor_number, image_name)
-                        logger.info(f"Successfully processed image: {image_name}")
+            for image_name in os.listdir(images_dir):
+                if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    logger.info(f"Processing image: {image_name} for user: {user_id}")
+                    cache_key = None
+                    if self.result_cache is not None:
+                        # The image content, not its name, decides whether it was already processed
+                        cache_key = self.result_cache.key_for(os.path.join(images_dir, image_name))
+                        if self.result_cache.restore(cache_key, image_name, image_folder):
+                            logger.info(f"Reused cached results for image {image_name}.")
+                            newly_processed.append((user_id, project_number, floor_number, image_name))
+                            processed_files.append(os.path.splitext(image_name)[0])
+                            processed_names.append(image_name)
+                            continue
+                    elif InferenceManager.is_image_processed(user_id, project_number, floor_number, image_name):
+                        logger.info(f"Image {image_name} was already processed.")
                         processed_files.append(os.path.splitext(image_name)[0])
-                    except Exception as e:
-                        logger.error(f"Error processing image {image_name}: {e}")
-                        raise e
+                        processed_names.append(image_name)
+                        continue
+                    # Images of other requests join the micro-batcher between the ones of a large batch
+                    in_flight.acquire()
+                    future = self.submit_image((image_name, crop_image_dir, save_json_dir, save_image_dir), priority)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    pending.append((image_name, future, cache_key, image_folder, [crop_image_dir, save_json_dir, save_image_dir]))
+
+        failed = {}
+        for image_name, future, cache_key, image_folder, output_dirs in pending:
+            try:
+                future.result()
+                newly_processed.append((user_id, project_number, floor_number, image_name))
+                logger.info(f"Successfully processed image: {image_name}")
+                processed_files.append(os.path.splitext(image_name)[0])
+                processed_names.append(image_name)
+            except Exception as e:
+                logger.error(f"Error processing image {image_name}: {e}")
+                failed[image_name] = e
+                continue
+            if cache_key is not None:
+                try:
+                    self.result_cache.store(cache_key, image_name, image_folder, output_dirs)
+                except Exception as e:
+                    logger.warning(f"Could not cache results for image {image_name}: {e}")
+
+        # Mark the new images as processed in a single write, keeping the ones that succeeded on failure
+        InferenceManager.log_images_as_processed(newly_processed)
+        for image_name in processed_names:
+            try:
+                InferenceManager.write_result_manifest(user_id, project_number, floor_number, image_name)
+            except Exception as e:
+                # Reading the results writes the manifest when it is missing
+                logger.warning(f"Could not write the result manifest of image {image_name}: {e}")
+        return processed_files, failed
+
+
+class SqliteJobStore:
+    """
+    Job broker kept in a SQLite database on storage shared by every pod.
+    API pods queue the inference of an upload as a job with its task, ("images", args) or ("batch", args);
+    workers claim the oldest queued job of the highest priority class they have room for in a write transaction,
+    so each job goes to one worker, and hold it under a lease they renew while it runs. A job whose lease ran out
+    is claimed again by the next worker, so the jobs of a worker that died are not lost.
+    Finished jobs are removed by the API pod that waited for them. The jobs of an API pod that died are deleted
+    instead of run once it stops marking them as waited for, and their results after JOB_RETENTION_SECONDS.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, task TEXT NOT NULL, result TEXT, error TEXT, "
+            "worker TEXT, lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL, priority INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [column for _, column, *_ in conn.execute("PRAGMA table_info(jobs)")]
+        if "priority" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "waited_at" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN waited_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at)")
+
+    @staticmethod
+    def create(broker=JOB_BROKER, role=SERVER_ROLE):
+        """Create the job store for the configured broker, or return None for the local one; API and worker pods need a shared one."""
+        if role not in ("standalone", "api", "worker"):
+            raise ValueError(f"Unknown server role: {role}")
+        if broker == "local":
+            if role != "standalone":
+                raise ValueError(f"The {role} role needs a shared JOB_BROKER")
+            return None
+        if broker == "sqlite":
+            return SqliteJobStore(JOB_BROKER_DB)
+        raise ValueError(f"Unknown job broker: {broker}")
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def reap(conn, now=None):
+        """
+        Delete the queued jobs no API pod has marked as waited for within JOB_WAIT_TIMEOUT_SECONDS, and the
+        finished jobs older than JOB_RETENTION_SECONDS. Return the number deleted.
+        """
+        now = now or time.time()
+        abandoned = conn.execute(
+            "DELETE FROM jobs WHERE status='queued' AND COALESCE(waited_at, updated_at) < ?", (now - JOB_WAIT_TIMEOUT_SECONDS,)
+        ).rowcount
+        expired = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (now - JOB_RETENTION_SECONDS,)
+        ).rowcount
+        if abandoned:
+            logger.warning(f"Deleted {abandoned} queued jobs that no server waits for any more")
+        return abandoned + expired
+
+    @STORE_SECONDS.labels("jobs", "write").time()
+    def enqueue(self, task, priority="interactive"):
+        """Queue a job for task in a priority class and return its ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO jobs (job_id, status, task, created_at, updated_at, priority, waited_at) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(task), now, now, PRIORITY_CLASSES.index(priority), now)
+        )
+        return job_id
+
+    def keep_waiting(self, job_ids):
+        """Mark the jobs among job_ids as still waited for by their API pod."""
+        self._connection().executemany("UPDATE jobs SET waited_at=? WHERE job_id=?", [(time.time(), job_id) for job_id in job_ids])
+
+    def abandon(self, job_ids):
+        """Delete the jobs among job_ids that no worker has claimed yet, for an API pod that stops waiting for them."""
+        self._connection().executemany("DELETE FROM jobs WHERE job_id=? AND status='queued'", [(job_id,) for job_id in job_ids])
+
+    @STORE_SECONDS.labels("jobs", "claim").time()
+    def claim(self, worker, lease_seconds=JOB_LEASE_SECONDS, priorities=PRIORITY_CLASSES):
+        """
+        Claim the oldest claimable job of the highest of priorities for worker and return (job_id, task, priority),
+        or None when there is none. Jobs no API pod waits for any more are deleted first.
+        """
+        return claim_sqlite_job(self._connection(), worker, lease_seconds, priorities, SqliteJobStore.reap)
+
+    def renew(self, job_ids, worker, lease_seconds=JOB_LEASE_SECONDS):
+        """Extend the lease of the jobs worker is running."""
+        self._connection().executemany(
+            "UPDATE jobs SET lease_until=? WHERE job_id=? AND worker=? AND status='running'",
+            [(time.time() + lease_seconds, job_id, worker) for job_id in job_ids]
+        )
+
+    @STORE_SECONDS.labels("jobs", "write").time()
+    def finish(self, job_id, worker, result=None, error=None):
+        """Record the outcome of a job, unless its lease ran out and another worker claimed it since."""
+        self._connection().execute(
+            "UPDATE jobs SET status=?, result=?, error=?, updated_at=? WHERE job_id=? AND worker=?",
+            ("failed" if error is not None else "done", json.dumps(result), error, time.time(), job_id, worker)
+        )
+
+    @STORE_SECONDS.labels("jobs", "read").time()
+    def take_finished(self, job_ids):
+        """Remove the finished jobs among job_ids and return {job_id: (status, result, error)} for them."""
+        if not job_ids:
+            return {}
+        conn = self._connection()
+        placeholders = ", ".join("?" * len(job_ids))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT job_id, status, result, error FROM jobs WHERE job_id IN ({placeholders}) AND status IN ('done', 'failed')",
+                list(job_ids)
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE job_id=?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {job_id: (status, json.loads(result) if result is not None else None, error) for job_id, status, result, error in rows}
+
+    def counts(self):
+        """Return the number of queued and of running jobs."""
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+
+class JobConsumer:
+    """
+    Runs jobs from a shared job store on an ImageProcessor.
+    A claiming thread takes one job per free executor worker, bulk ones only while fewer run than the executor's
+    bulk workers, and renews the leases of the running jobs every third of JOB_LEASE_SECONDS so they are not handed
+    to another worker. No jobs are claimed while draining.
+    """
+
+    def __init__(self, store, processor, poll_seconds=JOB_POLL_SECONDS, lease_seconds=JOB_LEASE_SECONDS):
+        self.store = store
+        self.processor = processor
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self._slots = threading.Semaphore(processor.max_workers)
+        self._lock = threading.Lock()
+        # job_id -> priority class of the claimed jobs
+        self._running = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-consumer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        """Stop the claiming thread; the jobs already claimed keep running but their leases are no longer renewed."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _submit(self, task):
+        kind, args = task
+        if kind == "batch":
+            return self.processor.submit_batch(*args)
+        return self.processor.submit(*args)
+
+    def _finish(self, job_id, kind, future):
+        try:
+            if kind == "batch":
+                processed_files, failed = future.result()
+                result = {"processed": processed_files, "failed": {image_name: str(error) for image_name, error in failed.items()}}
+            else:
+                result = future.result()
+            self.store.finish(job_id, self.worker, result=result)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            try:
+                self.store.finish(job_id, self.worker, error=str(e))
+            except Exception as store_error:
+                logger.error(f"Could not record the failure of job {job_id}: {store_error}")
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+            self._slots.release()
+
+    def _renew(self):
+        with self._lock:
+            job_ids = list(self._running)
+        if job_ids:
+            self.store.renew(job_ids, self.worker, self.lease_seconds)
+
+    def _run(self):
+        renewed_at = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() - renewed_at >= self.lease_seconds / 3:
+                try:
+                    self._renew()
+                    renewed_at = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Could not renew job leases: {e}")
+            if draining.is_set():
+                # Leave the queue to the other workers but keep renewing the leases of the jobs still running
+                self._stop.wait(self.poll_seconds)
+                continue
+            if not self._slots.acquire(timeout=self.poll_seconds):
+                continue
+            with self._lock:
+                running_bulk = list(self._running.values()).count("bulk")
+            priorities = PRIORITY_CLASSES if running_bulk < self.processor.executor.bulk_workers else ("interactive",)
+            try:
+                claimed = self.store.claim(self.worker, self.lease_seconds, priorities)
+            except Exception as e:
+                logger.error(f"Could not claim a job: {e}")
+                claimed = None
+            if claimed is None:
+                self._slots.release()
+                self._stop.wait(self.poll_seconds)
+                continue
+            job_id, task, priority = claimed
+            with self._lock:
+                self._running[job_id] = priority
+            logger.info(f"Claimed {priority} job {job_id}")
+            try:
+                future = self._submit(task)
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(functools.partial(self._finish, job_id, task[0]))
+
+
+class BrokeredImageProcessor:
+    """
+    Stands in for the ImageProcessor on API pods: submit and submit_batch queue the work in the shared job
+    broker and return a Future that resolves once a worker pod has run it, with what ImageProcessor would return.
+    One thread polls the broker every JOB_POLL_SECONDS for the jobs this server waits for, and marks them as
+    waited for every third of JOB_WAIT_TIMEOUT_SECONDS so they are not deleted as abandoned.
+    """
+
+    def __init__(self, store, poll_seconds=JOB_POLL_SECONDS, wait_timeout=JOB_WAIT_TIMEOUT_SECONDS):
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="job-waiter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        """Stop waiting; requests still waiting fail and their jobs that no worker has claimed yet are deleted."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            waiting, self._waiting = self._waiting, {}
+        try:
+            self.store.abandon(list(waiting))
+        except Exception as e:
+            logger.error(f"Could not delete the queued jobs of this server: {e}")
+        for future, _ in waiting.values():
+            future.set_exception(RuntimeError("Server shut down before the job finished"))
+
+    def submit(self, user_id, project_number, floor_number, image_base_name, images_dir, priority="interactive"):
+        return self._enqueue("images", [user_id, project_number, floor_number, image_base_name, images_dir, priority], priority)
+
+    def submit_batch(self, user_id, project_number, floor_number, images_dirs, priority="bulk"):
+        return self._enqueue("batch", [user_id, project_number, floor_number, images_dirs, priority], priority)
+
+    def _enqueue(self, kind, args, priority):
+        future = Future()
+        job_id = self.store.enqueue((kind, args), priority)
+        with self._lock:
+            self._waiting[job_id] = (future, kind)
+        return future
+
+    def drain(self, timeout):
+        """Wait until every job this server waits for has finished or the timeout has passed. Returns True when all finished."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                waiting = len(self._waiting)
+            if waiting == 0:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Drain timed out after {timeout}s with {waiting} requests unfinished")
+                return False
+            time.sleep(0.5)
+
+    def executor_state(self):
+        """Return (queued, running, 0) for the jobs in the shared broker."""
+        counts = self.store.counts()
+        return counts["queued"], counts["running"], 0
+
+    def _run(self):
+        marked_at = time.monotonic()
+        while not self._stop.wait(self.poll_seconds):
+            with self._lock:
+                job_ids = list(self._waiting)
+            if time.monotonic() - marked_at >= self.wait_timeout / 3:
+                try:
+                    self.store.keep_waiting(job_ids)
+                    marked_at = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Could not mark queued jobs as waited for: {e}")
+            try:
+                finished = self.store.take_finished(job_ids)
+            except Exception as e:
+                logger.error(f"Could not check queued jobs: {e}")
+                continue
+            for job_id, (status, result, error) in finished.items():
+                with self._lock:
+                    future, kind = self._waiting.pop(job_id)
+                if status == "failed":
+                    future.set_exception(RuntimeError(error))
+                elif kind == "batch":
+                    future.set_result((result["processed"], result["failed"]))
                 else:
-                    logger.info(f"Image {image_name} was already processed.")
-                    processed_files.append(os.path.splitext(image_name)[0])
-        return processed_files
+                    future.set_result(result)
+
 
 class InferenceManager:
     """Handles image processing status and inference result storage."""
 
+    registry = None
+    registry_lock = threading.Lock()
+    result_log = None
+    result_log_lock = threading.Lock()
+
+    @classmethod
+    def get_registry(cls):
+        """Return the processed-image registry, creating it on first use."""
+        with cls.registry_lock:
+            if cls.registry is None:
+                cls.registry = create_processed_image_registry(
+                    PROCESSED_IMAGES_BACKEND, PROCESSED_IMAGES_DB, PROCESSED_IMAGES_FILE, REGISTRY_SINGLE_WRITER,
+                    REGISTRY_WRITE_MAX_BATCH, REGISTRY_WRITE_MAX_WAIT_MS
+                )
+            return cls.registry
+
+    @classmethod
+    def get_result_log(cls):
+        """Return the inference result log, creating it (and importing inference_results.json) on first use."""
+        with cls.result_log_lock:
+            if cls.result_log is None:
+                if JOB_BROKER == "sqlite":
+                    # With a shared broker the results are recorded next to the jobs, where every pod reaches them
+                    cls.result_log = SqliteResultLog(JOB_BROKER_DB)
+                else:
+                    cls.result_log = ResultLog(RESULTS_DIRECTORY, INFERENCE_RESULTS_FILE, RESULTS_SEGMENT_BYTES, RESULTS_COMPACT_RATIO, RESULTS_FSYNC)
+            return cls.result_log
+
     @staticmethod
+    @STORE_SECONDS.labels("registry", "read").time()
     def is_image_processed(user_id, project_number, floor_number, image_name):
         """Check if a specific image has already been processed."""
-        processed_images = FileManager.load_json_data(PROCESSED_IMAGES_FILE)
-        return (
-            user_id in processed_images and
-            project_number in processed_images[user_id] and
-            floor_number in processed_images[user_id][project_number] and
-            image_name in processed_images[user_id][project_number][floor_number]
-        )
+        return InferenceManager.get_registry().contains(user_id, project_number, floor_number, image_name)
 
     @staticmethod
+    @STORE_SECONDS.labels("registry", "write").time()
     def log_image_as_processed(user_id, project_number, floor_number, image_name):
         """Mark an image as processed by recording it."""
-        processed_images = FileManager.load_json_data(PROCESSED_IMAGES_FILE)
-        if user_id not in processed_images:
-            processed_images[user_id] = {}
-        if project_number not in processed_images[user_id]:
-            processed_images[user_id][project_number] = {}
-        floor_key = f"floor_{floor_number}"
-        if floor_key not in processed_images[user_id][project_number]:
-            processed_images[user_id][project_number][floor_key] = []
-        processed_images[user_id][project_number][floor_key].append(image_name)
-        FileManager.save_json_data(PROCESSED_IMAGES_FILE, processed_images)
+        InferenceManager.get_registry().add(user_id, project_number, floor_number, image_name)
 
     @staticmethod
-    def post_inference_results(user_id, project_number, floor_number, image_name):
-        """Prepare and return inference results for a specific image."""
-        image_base_name = os.path.splitext(image_name)[0]
-        image_folder = os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}", image_base_name)
+    @STORE_SECONDS.labels("registry", "write").time()
+    def log_images_as_processed(entries):
+        """Mark several (user_id, project_number, floor_number, image_name) entries as processed in one write."""
+        InferenceManager.get_registry().add_many(entries)
+
+    @staticmethod
+    @STORE_SECONDS.labels("registry", "write").time()
+    def forget_processed_images(entries):
+        """Remove (user_id, project_number, floor_number, image_name) entries from the registry once their files are deleted."""
+        InferenceManager.get_registry().remove_many(entries)
+
+    @staticmethod
+    def image_folder(user_id, project_number, floor_number, image_name):
+        """Return the folder holding the upload and the results of an image."""
+        return os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}", os.path.splitext(image_name)[0])
 
-        result_files = {
+    @staticmethod
+    def result_files(user_id, project_number, floor_number, image_name):
+        """Return the paths of the result files of an image, keyed by result type."""
+        image_base_name = os.path.splitext(image_name)[0]
+        image_folder = InferenceManager.image_folder(user_id, project_number, floor_number, image_name)
+        return {
             "detection_json": os.path.join(image_folder, 'json', 'detect', f"{image_base_name}_detection.json"),
             "oob_json": os.path.join(image_folder, 'json', 'oob', f"{image_base_name}_oob.json"),
             "segmentation_json": os.path.join(image_folder, 'json', 'segment', f"{image_base_name}_segment.json"),
@@ -160,34 +1158,88 @@ class InferenceManager:
             "cropped_image": os.path.join(image_folder, 'cropped', f"{image_base_name}.png"),
         }
 
-        encoded_files = {}
-        filenames = {}
-        for key, file_path in result_files.items():
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as file:
-                    encoded_files[key] = base64.b64encode(file.read()).decode('utf-8')
-                    filenames[key] = os.path.basename(file_path)
-            else:
-                logger.warning(f"File not found: {file_path}. Skipping {key}.")
-        if not encoded_files:
-            logger.error(f"No files were found for image {image_name}.")
-        InferenceManager.store_inference_results(user_id, project_number, floor_number, image_name, filenames)
+    @staticmethod
+    def write_result_manifest(user_id, project_number, floor_number, image_name):
+        """Describe the files in the RESULT_FOLDERS of an image's folder in its manifest and return the manifest."""
+        return write_result_manifest(
+            InferenceManager.image_folder(user_id, project_number, floor_number, image_name), image_name,
+            InferenceManager.result_files(user_id, project_number, floor_number, image_name), RESULT_FOLDERS, RESULT_MANIFEST_FILENAME
+        )
+
+    @staticmethod
+    def result_manifest(user_id, project_number, floor_number, image_name):
+        """Return the manifest of an image's results, or None when its folder does not exist."""
+        return read_result_manifest(
+            InferenceManager.image_folder(user_id, project_number, floor_number, image_name), image_name,
+            InferenceManager.result_files(user_id, project_number, floor_number, image_name), RESULT_FOLDERS, RESULT_MANIFEST_FILENAME
+        )
+
+    @staticmethod
+    def result_manifests(user_id, project_number, floor_number, image_names):
+        """Return the result manifests of several images of a floor, keyed by image name."""
+        return {image_name: InferenceManager.result_manifest(user_id, project_number, floor_number, image_name) for image_name in image_names}
+
+    @staticmethod
+    def manifest_filenames(manifest):
+        """Return the file names of the result types listed in a manifest, keyed by result type."""
+        filenames = {entry["key"]: os.path.basename(entry["path"]) for entry in manifest["files"] if "key" in entry}
+        if manifest["missing"]:
+            logger.warning(f"No {', '.join(manifest['missing'])} in the results of image {manifest['image_name']}.")
+        if not filenames:
+            logger.error(f"No files were found for image {manifest['image_name']}.")
+        return filenames
+
+    @staticmethod
+    def manifest_zip_entries(user_id, project_number, floor_number, manifest):
+        """Return the (file path, name in the ZIP) entries of every file in a manifest."""
+        image_folder = InferenceManager.image_folder(user_id, project_number, floor_number, manifest["image_name"])
+        user_directory = os.path.join(BASE_UPLOAD_DIRECTORY, user_id)
+        return [
+            (os.path.join(image_folder, entry["path"]), os.path.join(user_id, os.path.relpath(os.path.join(image_folder, entry["path"]), user_directory)))
+            for entry in manifest["files"]
+        ]
+
+    @staticmethod
+    def post_inference_results(user_id, project_number, floor_number, image_name, manifest=None):
+        """Record the inference results of a specific image, listed in its manifest, and return their summary."""
+        manifest = manifest or InferenceManager.result_manifest(user_id, project_number, floor_number, image_name)
+        InferenceManager.store_inference_results(user_id, project_number, floor_number, image_name, InferenceManager.manifest_filenames(manifest))
         return {"message": "Inference results ready", "user_id": user_id, "project_number": project_number, "floor_number": floor_number, "image_name": image_name}
 
+    @staticmethod
+    def post_batch_inference_results(user_id, project_number, floor_number, image_names, manifests=None):
+        """Record the inference results of the images of a batch upload with one result log commit and return their summaries."""
+        records = []
+        for image_name in image_names:
+            manifest = (manifests or {}).get(image_name) or InferenceManager.result_manifest(user_id, project_number, floor_number, image_name)
+            filenames = InferenceManager.manifest_filenames(manifest)
+            records.append({
+                "project_number": project_number,
+                "floor_number": floor_number,
+                "image_name": image_name,
+                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "filenames": filenames
+            })
+        InferenceManager.get_result_log().append_many(user_id, records)
+        InferenceManager.trim_result_log(user_id)
+        return [{"user_id": user_id, "project_number": project_number, "floor_number": floor_number, "image_name": image_name} for image_name in image_names]
+
     @staticmethod
     def store_inference_results(user_id, project_number, floor_number, image_name, filenames):
-        """Store inference results for the user."""
-        inference_results = FileManager.load_json_data(INFERENCE_RESULTS_FILE)
-        if user_id not in inference_results:
-            inference_results[user_id] = []
-        inference_results[user_id].append({
+        """Append the inference results of an image to the user's result log."""
+        InferenceManager.get_result_log().append(user_id, {
             "project_number": project_number,
             "floor_number": floor_number,
             "image_name": image_name,
             "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "filenames": filenames
         })
-        FileManager.save_json_data(INFERENCE_RESULTS_FILE, inference_results)
+        InferenceManager.trim_result_log(user_id)
+
+    @staticmethod
+    def trim_result_log(user_id):
+        """Drop the results of user_id beyond the newest RESULTS_KEEP_PER_USER from the result log."""
+        InferenceManager.get_result_log().trim(user_id, RESULTS_KEEP_PER_USER, RESULTS_TRIM_STEP)
 
 @app.post("/receive_data")
 async def upload_file(
@@ -195,9 +1247,16 @@ async def upload_file(
     images: UploadFile = File(...),
 ):
     """Handle file uploads, process them, and dynamically handle extra form fields."""
-    image_processor = ImageProcessor()
-
+    image_folder = None
     try:
+        # Refuse uploads on worker pods, until the models are ready and once the server is draining
+        if SERVER_ROLE == "worker":
+            raise HTTPException(status_code=503, detail="This server only runs queued jobs, send uploads to the API service")
+        if draining.is_set():
+            raise HTTPException(status_code=503, detail="Server is shutting down, please retry later", headers={"Retry-After": "30"})
+        if upload_processor is None:
+            raise HTTPException(status_code=503, detail="Models are loading, please retry later", headers={"Retry-After": "10"})
+
         # Parse all form data dynamically
         form_data = await request.form()
 
@@ -216,6 +1275,7 @@ async def upload_file(
         
         if extra_fields:
             logger.info(f"Received extra fields: {extra_fields}")
+        priority = FairScheduler.priority_of(extra_fields.get(SCHEDULER_PRIORITY_FIELD), "interactive", SCHEDULER_PRIORITY_FIELD)
 
         # Continue with image upload and processing
         user_directory = os.path.join(BASE_UPLOAD_DIRECTORY, user_id)
@@ -226,52 +1286,40 @@ async def upload_file(
         original_filename, file_extension = os.path.splitext(images.filename)
         image_folder = os.path.join(floor_directory, original_filename)
         FileManager.create_directory(image_folder)
+        if artifact_retention is not None:
+            # A re-upload reuses the folder of the earlier one, which must not be swept while it is processed
+            await asyncio.to_thread(artifact_retention.touch, image_folder)
 
         original_img_directory = os.path.join(image_folder, "original_img")
         FileManager.create_directory(original_img_directory)
         file_location = os.path.join(original_img_directory, f"{original_filename}{file_extension}")
 
         # Save the uploaded image file
-        with open(file_location, "wb") as file:
-            file.write(await images.read())
+        await FileManager.save_upload_file(images, file_location)
 
-        # Process the image in a separate thread
-        future = image_processor.executor.submit(image_processor.process_images, user_id, project_number, floor_number, original_filename, original_img_directory)
-        processed_files = future.result()
+        # Process the image in the shared worker pool, or on a worker pod, without blocking the event loop
+        future = upload_processor.submit(user_id, project_number, floor_number, original_filename, original_img_directory, priority)
+        processed_files = await asyncio.wrap_future(future)
 
         if original_filename not in processed_files:
             raise HTTPException(status_code=500, detail="File processing failed")
 
+        # The result manifest lists the files of the image, so neither the result record nor the ZIP probes the folder
+        image_name = f"{original_filename}{file_extension}"
+        manifest = await asyncio.to_thread(InferenceManager.result_manifest, user_id, project_number, floor_number, image_name)
+
         # Prepare the response data
-        response_data = InferenceManager.post_inference_results(user_id, project_number, floor_number, f"{original_filename}{file_extension}")
-
-        # Track the new files created during this request
-        new_files_to_zip = []
-
-        # Only include files that were processed during the current request in the ZIP
-        for processed_file in processed_files:
-            json_path = os.path.join(floor_directory, processed_file, 'json')
-            image_path = os.path.join(floor_directory, processed_file, 'images')
-            cropped_path = os.path.join(floor_directory, processed_file, 'cropped')
-            original_img_path = os.path.join(floor_directory, processed_file, 'original_img')
-
-            # Add relevant files to the list for zipping
-            for folder in [json_path, image_path, cropped_path, original_img_path]:  # Now includes original images folder
-                for root, dirs, files in os.walk(folder):
-                    for file in files:
-                        full_path = os.path.join(root, file)
-                        new_files_to_zip.append(full_path)  # Track files created in this request
-
-        # Create a ZIP archive of only the newly processed files, including original images
-        zip_filename = f"{user_id}_{project_number}_floor_{floor_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
-        zip_file_path = os.path.join(BASE_UPLOAD_DIRECTORY, zip_filename)
+        response_data = await asyncio.to_thread(InferenceManager.post_inference_results, user_id, project_number, floor_number, image_name, manifest)
 
-        with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-            for file_path in new_files_to_zip:
-                rel_path = os.path.relpath(file_path, os.path.join(BASE_UPLOAD_DIRECTORY, user_id))
-                zipf.write(file_path, arcname=os.path.join(user_id, rel_path))
+        # Stream a ZIP archive of only the newly processed files, including original images
+        zip_filename = f"{user_id}_{project_number}_floor_{floor_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
+        zip_entries = InferenceManager.manifest_zip_entries(user_id, project_number, floor_number, manifest)
 
-        return FileResponse(zip_file_path, media_type='application/zip', filename=zip_filename)
+        return StreamingResponse(
+            ZipStreamer.stream(zip_entries),
+            media_type='application/zip',
+            headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'}
+        )
     
     except HTTPException as e:
         logger.error(f"HTTP Error: {e.detail}")
@@ -279,21 +1327,302 @@ async def upload_file(
     except Exception as e:
         logger.error(f"Error during file upload and processing: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # The folder is recorded with its final size once processing no longer writes to it
+        if artifact_retention is not None and image_folder is not None:
+            await asyncio.to_thread(artifact_retention.record, image_folder, user_id, project_number, floor_number)
+
+@app.post("/receive_batch")
+async def upload_batch(
+    request: Request,
+    images: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+):
+    """
+    Handle a batch upload of many images of one floor, sent as several 'images' files and/or one ZIP 'archive'.
+    Each image gets its own folder as with /receive_data, but the batch is processed together through the worker
+    pool, its results are recorded in one write, and a single ZIP holding the results of every processed image and
+    a batch_summary.json of the failed ones is returned.
+    """
+    images = images or []
+    image_folders = []
+    try:
+        # Refuse uploads on worker pods, until the models are ready and once the server is draining
+        if SERVER_ROLE == "worker":
+            raise HTTPException(status_code=503, detail="This server only runs queued jobs, send uploads to the API service")
+        if draining.is_set():
+            raise HTTPException(status_code=503, detail="Server is shutting down, please retry later", headers={"Retry-After": "30"})
+        if upload_processor is None:
+            raise HTTPException(status_code=503, detail="Models are loading, please retry later", headers={"Retry-After": "10"})
+
+        # Parse all form data dynamically
+        form_data = await request.form()
+        user_id = form_data.get('user_id')
+        project_number = form_data.get('project_number')
+        floor_number = form_data.get('floor_number')
+        if not all([user_id, project_number, floor_number]):
+            missing_fields = [field for field in ['user_id', 'project_number', 'floor_number'] if form_data.get(field) is None]
+            raise HTTPException(status_code=400, detail=f"Missing required fields: {', '.join(missing_fields)}")
+        extra_fields = {key: value for key, value in form_data.items() if key not in {'user_id', 'project_number', 'floor_number', 'images', 'archive'}}
+        if extra_fields:
+            logger.info(f"Received extra fields: {extra_fields}")
+        priority = FairScheduler.priority_of(extra_fields.get(SCHEDULER_PRIORITY_FIELD), "bulk", SCHEDULER_PRIORITY_FIELD)
+
+        if not images and archive is None:
+            raise HTTPException(status_code=400, detail="Send the images as 'images' files or as a ZIP 'archive'")
+        if len(images) > BATCH_UPLOAD_MAX_IMAGES:
+            raise HTTPException(status_code=413, detail=f"A batch can hold at most {BATCH_UPLOAD_MAX_IMAGES} images")
+        image_names = [os.path.basename(upload.filename) for upload in images]
+        unsupported = [image_name for image_name in image_names if not image_name.lower().endswith(IMAGE_EXTENSIONS)]
+        if unsupported:
+            raise HTTPException(status_code=400, detail=f"Unsupported image files: {', '.join(unsupported)}")
+
+        floor_directory = os.path.join(BASE_UPLOAD_DIRECTORY, user_id, project_number, f"floor_{floor_number}")
+        FileManager.create_directory(floor_directory)
+        staging_directory = tempfile.mkdtemp(prefix=".batch_", dir=floor_directory)
+        try:
+            staged_files = []
+            for upload, image_name in zip(images, image_names):
+                staged_path = os.path.join(staging_directory, image_name)
+                await FileManager.save_upload_file(upload, staged_path)
+                staged_files.append((image_name, staged_path))
+            if archive is not None:
+                archive_path = os.path.join(staging_directory, ".archive.zip")
+                await FileManager.save_upload_file(archive, archive_path)
+                archive_directory = os.path.join(staging_directory, "archive")
+                FileManager.create_directory(archive_directory)
+                archive_names = await asyncio.to_thread(FileManager.extract_archive_images, archive_path, archive_directory, BATCH_UPLOAD_MAX_IMAGES - len(images))
+                staged_files.extend((image_name, os.path.join(archive_directory, image_name)) for image_name in archive_names)
+            if not staged_files:
+                raise HTTPException(status_code=400, detail="The batch holds no images")
+            # An image's folder is named after it without the extension, so two images may not share that name
+            duplicates = duplicate_base_names([image_name for image_name, _ in staged_files])
+            if duplicates:
+                raise HTTPException(status_code=400, detail=f"Every image in a batch needs a different name: {', '.join(duplicates)}")
+
+            # Give every image the folder /receive_data would have used for it
+            for image_name, staged_path in staged_files:
+                image_folder = os.path.join(floor_directory, os.path.splitext(image_name)[0])
+                FileManager.create_directory(os.path.join(image_folder, "original_img"))
+                image_folders.append(image_folder)
+                if artifact_retention is not None:
+                    await asyncio.to_thread(artifact_retention.touch, image_folder)
+                os.replace(staged_path, os.path.join(image_folder, "original_img", image_name))
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+        uploaded_names = [image_name for image_name, _ in staged_files]
+
+        # Process every image of the batch in the shared worker pool without blocking the event loop
+        future = upload_processor.submit_batch(user_id, project_number, floor_number,
+                                              [os.path.join(image_folder, "original_img") for image_folder in image_folders], priority)
+        processed_files, failed = await asyncio.wrap_future(future)
+        processed_names = [image_name for image_name in uploaded_names if os.path.splitext(image_name)[0] in processed_files]
+        if not processed_names:
+            raise HTTPException(status_code=500, detail="File processing failed for every image of the batch")
+
+        manifests = await asyncio.to_thread(InferenceManager.result_manifests, user_id, project_number, floor_number, processed_names)
+        await asyncio.to_thread(InferenceManager.post_batch_inference_results, user_id, project_number, floor_number, processed_names, manifests)
+
+        # Stream one ZIP archive with the files of every processed image, listed in their manifests, and a summary of the batch
+        zip_entries = []
+        for image_name in processed_names:
+            zip_entries.extend(InferenceManager.manifest_zip_entries(user_id, project_number, floor_number, manifests[image_name]))
+        summary = {
+            "user_id": user_id,
+            "project_number": project_number,
+            "floor_number": floor_number,
+            "processed": processed_names,
+            "failed": {image_name: str(error) for image_name, error in failed.items()},
+        }
+        zip_entries.append((json.dumps(summary, indent=4).encode("utf-8"), "batch_summary.json"))
+        zip_filename = f"{user_id}_{project_number}_floor_{floor_number}_batch_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
+
+        return StreamingResponse(
+            ZipStreamer.stream(zip_entries),
+            media_type='application/zip',
+            headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'}
+        )
+
+    except HTTPException as e:
+        logger.error(f"HTTP Error: {e.detail}")
+        raise
+    except Exception as e:
+        logger.error(f"Error during batch upload and processing: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # The folders are recorded with their final size once processing no longer writes to them
+        if artifact_retention is not None:
+            for image_folder in image_folders:
+                await asyncio.to_thread(artifact_retention.record, image_folder, user_id, project_number, floor_number)
+
+def loaded_image_processor():
+    """Return the ImageProcessor, or raise 404 on an API pod, which runs no inference, and 503 while the models load."""
+    if SERVER_ROLE == "api":
+        raise HTTPException(status_code=404, detail="This server runs no inference")
+    if image_processor is None:
+        raise HTTPException(status_code=503, detail="The models are not loaded yet")
+    return image_processor
+
+@app.get("/batching_stats")
+async def batching_stats():
+    """Return batch size and queue wait statistics of the image micro-batcher."""
+    return loaded_image_processor().batcher.stats()
+
+@app.get("/scheduler_stats")
+async def scheduler_stats():
+    """Return the queued and running requests of each priority class and their queue-time SLO misses."""
+    return loaded_image_processor().executor.stats()
+
+@app.get("/pipeline_stats")
+async def pipeline_stats():
+    """Return per-stage latency and queue depth of the staged inference pipeline."""
+    processor = loaded_image_processor()
+    if processor.pipeline is None:
+        raise HTTPException(status_code=404, detail="Staged pipeline is not enabled")
+    return processor.pipeline.stats()
+
+@app.get("/retention_stats")
+async def retention_stats():
+    """Return the size of the upload tree and what the retention sweeper of this process deleted."""
+    if artifact_retention is None:
+        raise HTTPException(status_code=404, detail="Retention is not enabled")
+    return await asyncio.to_thread(artifact_retention.stats)
+
+@app.get("/registry_stats")
+async def registry_stats():
+    """Return how the processed-image registry writes of this process were merged by its writer thread."""
+    registry = InferenceManager.get_registry()
+    if not isinstance(registry, SingleWriterRegistry):
+        raise HTTPException(status_code=404, detail="The registry has no single writer")
+    return registry.stats()
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Return hit/miss counters and size of the inference result cache. Counters are kept per process."""
+    processor = loaded_image_processor()
+    if processor.result_cache is None:
+        raise HTTPException(status_code=404, detail="Result cache is not enabled")
+    return await asyncio.to_thread(processor.result_cache.stats)
+
+class ServerStateCollector:
+    """Reports the executor, micro-batcher, pipeline and cache state of the ImageProcessor when /metrics is scraped."""
+
+    def collect(self):
+        if artifact_retention is not None:
+            retention_stats = artifact_retention.stats()
+            yield GaugeMetricFamily("floorplan_artifact_folders", "Request folders in the upload tree", value=retention_stats["folders"])
+            yield GaugeMetricFamily("floorplan_artifact_size_bytes", "Size of the upload tree", value=retention_stats["size_bytes"])
+
+        processor = image_processor or upload_processor
+        if processor is None:
+            return
+        queued, active, max_workers = processor.executor_state()
+        yield GaugeMetricFamily("floorplan_executor_queue_depth", "Requests waiting for an executor worker", value=queued)
+        yield GaugeMetricFamily("floorplan_executor_active_workers", "Requests being processed", value=active)
+        yield GaugeMetricFamily("floorplan_executor_max_workers", "Size of the executor", value=max_workers)
+        if image_processor is None:
+            return  # API pods run no inference
+
+        scheduler_stats = image_processor.executor.stats()
+        scheduler_queued = GaugeMetricFamily("floorplan_scheduler_queued", "Requests waiting for an executor worker, by priority class", labels=["priority"])
+        scheduler_running = GaugeMetricFamily("floorplan_scheduler_running", "Requests being processed, by priority class", labels=["priority"])
+        for priority, values in scheduler_stats["classes"].items():
+            scheduler_queued.add_metric([priority], values["queued"])
+            scheduler_running.add_metric([priority], values["running"])
+        yield scheduler_queued
+        yield scheduler_running
+
+        batcher_stats = image_processor.batcher.stats()
+        yield CounterMetricFamily("floorplan_batcher_batches", "Batches run by the micro-batcher", value=batcher_stats["batches"])
+        yield CounterMetricFamily("floorplan_batcher_items", "Images run by the micro-batcher", value=batcher_stats["items"])
+        yield CounterMetricFamily(
+            "floorplan_batcher_queue_wait_seconds", "Total time images waited for their batch",
+            value=batcher_stats["queue_wait_ms_total"] / 1000
+        )
+
+        if image_processor.pipeline is not None:
+            pipeline_stats = image_processor.pipeline.stats()
+            queue_depth = GaugeMetricFamily("floorplan_pipeline_queue_depth", "Items waiting for each pipeline stage", labels=["stage"])
+            for stage_name, depth in pipeline_stats["queue_depth"].items():
+                queue_depth.add_metric([stage_name], depth)
+            yield queue_depth
+            step_seconds = CounterMetricFamily("floorplan_pipeline_step_seconds", "Total time spent in each pipeline step", labels=["step"])
+            step_runs = CounterMetricFamily("floorplan_pipeline_step_runs", "Pipeline step runs by outcome", labels=["step", "outcome"])
+            for step_name, values in pipeline_stats["steps"].items():
+                step_seconds.add_metric([step_name], values["latency_ms_total"] / 1000)
+                step_runs.add_metric([step_name, "ok"], values["count"] - values["errors"])
+                step_runs.add_metric([step_name, "error"], values["errors"])
+            yield step_seconds
+            yield step_runs
+
+        if image_processor.result_cache is not None:
+            cache_stats = image_processor.result_cache.stats()
+            lookups = CounterMetricFamily("floorplan_result_cache_lookups", "Result cache lookups", labels=["outcome"])
+            lookups.add_metric(["hit"], cache_stats["hits"])
+            lookups.add_metric(["miss"], cache_stats["misses"])
+            yield lookups
+            yield GaugeMetricFamily("floorplan_result_cache_entries", "Images in the result cache", value=cache_stats["entries"])
+            yield GaugeMetricFamily("floorplan_result_cache_size_bytes", "Size of the result cache", value=cache_stats["size_bytes"])
+
+register_state_collector(ServerStateCollector())
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request counts and latencies, inference stage timings, queue and store state."""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Merge the samples every worker process wrote to the shared directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(ServerStateCollector())
+    # The collectors read the upload tree and the result cache
+    return Response(content=await asyncio.to_thread(generate_latest, registry), media_type=CONTENT_TYPE_LATEST)
+
+# Health check endpoints
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness probe: the process is serving requests and its startup has not failed. Stays up while loading and draining."""
+    if startup_error is not None:
+        return health_response("failed", 503, error=str(startup_error))
+    return health_response("alive")
+
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness probe: the models are warmed up, the server is not draining and the queue is below READINESS_MAX_QUEUED_REQUESTS.
+    API pods load no models, and worker pods stay ready however long the queue they work off is.
+    """
+    queued = (await asyncio.to_thread(upload_processor.executor_state))[0] if upload_processor is not None else 0
+    reasons = []
+    if (image_processor if SERVER_ROLE != "api" else upload_processor) is None:
+        reasons.append("models are loading")
+    if draining.is_set():
+        reasons.append("server is draining")
+    if SERVER_ROLE != "worker" and queued > READINESS_MAX_QUEUED_REQUESTS:
+        reasons.append(f"{queued} requests are queued")
+    if reasons:
+        return health_response("not ready", 503, reasons=reasons, queued_requests=queued)
+    return health_response("ready", queued_requests=queued)
+
+@app.post("/drain")
+async def start_drain():
+    """
+    Stop taking uploads ahead of a shutdown: readiness fails and /receive_data returns 503 while running requests finish.
+    Meant for a Kubernetes preStop hook.
+    """
+    draining.set()
+    processor = upload_processor or image_processor
+    in_flight = sum(processor.executor_state()[:2]) if processor is not None else 0
+    logger.info(f"Draining with {in_flight} requests in flight")
+    return {"status": "draining", "requests_in_flight": in_flight}
 
-# Health check endpoint
 @app.get("/health")
 async def health_check():
-    """Endpoint for checking the health status of the server."""
-    return {"status": "healthy"}
-
-# Manage server startup and shutdown
-@asynccontextmanager
-async def lifespan(app):
-    """Manage the server's startup and shutdown events."""
-    logger.info("Server starting up")
-    yield
-    logger.info("Server shutting down")
+    """Endpoint for checking the health status of the server; kept for existing checks, see /health/live and /health/ready."""
+    if startup_error is not None:
+        return health_response("failed", 503, error=str(startup_error))
+    return health_response("healthy")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port= your port)
+    uvicorn.run(app, host="0.0.0.0", port=8000, timeout_graceful_shutdown=SHUTDOWN_CONNECTION_TIMEOUT_SECONDS)
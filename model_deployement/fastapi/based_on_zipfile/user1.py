@@ -12,6 +12,9 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 RECEIVED_ZIP_DIR = os.path.join(SCRIPT_DIR, "received_zip")
 os.makedirs(RECEIVED_ZIP_DIR, exist_ok=True)  # Ensure the directory exists
 
+# Size of the pieces the ZIP response is written to disk in, so it is never held in memory at once
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 # Predefined user data
 USER_DATA = {
     "user2":
@@ -43,28 +46,29 @@ def send_data(user_id, project_data, floor_number):
 
             # Send the POST request to the remote server with a timeout
             print(f"Sending data for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number}...")
-            response = requests.post(REMOTE_SERVER_URL, files=files, data=payload, timeout=120)
-
-            # Handle the response from the server
-            if response.status_code == 200:
-                content_type = response.headers.get('Content-Type')
-                if content_type == 'application/zip':
-                    # If the server sends back a ZIP file, save it
-                    zip_filename = f"{user_id}.zip"  # Only the user_id in the zip file name
-                    zip_filepath = os.path.join(RECEIVED_ZIP_DIR, zip_filename)
+            # Stream the response so a large ZIP is written to disk chunk by chunk
+            with requests.post(REMOTE_SERVER_URL, files=files, data=payload, timeout=120, stream=True) as response:
+                # Handle the response from the server
+                if response.status_code == 200:
+                    content_type = response.headers.get('Content-Type')
+                    if content_type == 'application/zip':
+                        # If the server sends back a ZIP file, save it
+                        zip_filename = f"{user_id}.zip"  # Only the user_id in the zip file name
+                        zip_filepath = os.path.join(RECEIVED_ZIP_DIR, zip_filename)
 
-                    with open(zip_filepath, "wb") as f:
-                        f.write(response.content)
+                        with open(zip_filepath, "wb") as f:
+                            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
 
-                    print(f"Received ZIP file saved as {zip_filepath}")
+                        print(f"Received ZIP file saved as {zip_filepath}")
 
 
+                    else:
+                        # Unexpected content type, log and handle the error
+                        print(f"Unexpected response content type: {content_type}. Expected a ZIP file.")
+                        print(f"Response content: {response.text}")
                 else:
-                    # Unexpected content type, log and handle the error
-                    print(f"Unexpected response content type: {content_type}. Expected a ZIP file.")
-                    print(f"Response content: {response.text}")
-            else:
-                print(f"Failed to upload data for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number}. Server responded with: {response.status_code} - {response.text}")
+                    print(f"Failed to upload data for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number}. Server responded with: {response.status_code} - {response.text}")
     
     except FileNotFoundError as e:
         print(f"File error for {user_id}, Project: {project_data['project_number']}, Floor: {floor_number}: {str(e)}")
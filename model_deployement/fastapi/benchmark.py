@@ -0,0 +1,338 @@
+"""
+Load-generation and latency benchmark for the FastAPI servers.
+
+The server under test (based_on_url or based_on_zipfile) is started in a subprocess with a stub
+FloorPlanProcessor that sleeps for a configurable fake inference time and writes placeholder outputs,
+so the numbers show the serving overhead (bookkeeping, encoding, zipping) separately from model cost.
+N virtual users then upload unique images for a fixed duration, and throughput and p50/p95/p99 latency
+per endpoint are written as JSON.
+
+    python benchmark.py --server url --users 16 --duration 60 --inference-ms 200 --output url.json
+    python benchmark.py --server zipfile --users 8 --duration 60 --set INFERENCE_PIPELINE=staged
+
+--set overrides a server_engine constant before startup; constants already bound as default
+arguments at import time are not affected.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import shutil
+import signal
+import struct
+import zlib
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIRECTORIES = {
+    "url": os.path.join(SCRIPT_DIR, "based_on_url"),
+    "zipfile": os.path.join(SCRIPT_DIR, "based_on_zipfile")
+}
+DEFAULT_PORT = 8765
+SERVER_START_TIMEOUT = 120
+JOB_POLL_INTERVAL = 0.05
+REQUEST_TIMEOUT = 300
+PERCENTILES = (50, 95, 99)
+
+# Written into the benchmark work directory as src/utils/processor.py, so the server's
+# `from src.utils.processor import FloorPlanProcessor` picks up the stub, also in spawned workers
+STUB_PROCESSOR_SOURCE = '''
+import os
+import json
+import time
+import shutil
+
+# Fake inference time per image, split evenly over the four model stages
+INFERENCE_SECONDS = float(os.environ.get("BENCHMARK_INFERENCE_MS", "0")) / 1000
+
+class FloorPlanProcessor:
+    """Stand-in for the real processor: sleeps instead of running models and writes placeholder outputs."""
+
+    def __init__(self, config):
+        self.config = config
+
+    @staticmethod
+    def _stem(image_name):
+        return os.path.splitext(image_name)[0]
+
+    @staticmethod
+    def _write_json(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def crop_background(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        time.sleep(INFERENCE_SECONDS / 4)
+        original_path = os.path.join(os.path.dirname(crop_image_dir), "original_img", image_name)
+        os.makedirs(crop_image_dir, exist_ok=True)
+        shutil.copyfile(original_path, os.path.join(crop_image_dir, f"{self._stem(image_name)}.png"))
+        self._write_json(os.path.join(save_json_dir, "crop", f"{self._stem(image_name)}.json"), {"bbox": [0, 0, 1, 1]})
+
+    def segment(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        time.sleep(INFERENCE_SECONDS / 4)
+        self._write_json(os.path.join(save_json_dir, "segment", f"{self._stem(image_name)}_segment.json"), {"segments": []})
+
+    def detect(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        time.sleep(INFERENCE_SECONDS / 4)
+        self._write_json(os.path.join(save_json_dir, "detect", f"{self._stem(image_name)}_detection.json"), {"detections": []})
+
+    def detect_oob(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        time.sleep(INFERENCE_SECONDS / 4)
+        self._write_json(os.path.join(save_json_dir, "oob", f"{self._stem(image_name)}_oob.json"), {"oob": []})
+        os.makedirs(save_image_dir, exist_ok=True)
+        shutil.copyfile(os.path.join(crop_image_dir, f"{self._stem(image_name)}.png"), os.path.join(save_image_dir, image_name))
+
+    def process_image(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        for stage in (self.crop_background, self.segment, self.detect, self.detect_oob):
+            stage(image_name, crop_image_dir, save_json_dir, save_image_dir)
+'''
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+# 1x1 white PNG; every upload appends random bytes after it so the result cache never hits
+PNG_HEADER = (
+    b"\x89PNG\r\n\x1a\n"
+    + png_chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    + png_chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff"))
+    + png_chunk(b"IEND", b"")
+)
+
+def parse_overrides(assignments):
+    """Turn NAME=VALUE strings into a dict, reading each value as JSON when possible."""
+    overrides = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition("=")
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+def serve(server, port, workdir, overrides):
+    """Run one server_engine with the stub processor; used as the benchmark's server subprocess."""
+    import uvicorn
+
+    package_directory = os.path.join(workdir, "src", "utils")
+    os.makedirs(package_directory, exist_ok=True)
+    for init_path in (os.path.join(workdir, "src", "__init__.py"), os.path.join(package_directory, "__init__.py")):
+        open(init_path, "w").close()
+    with open(os.path.join(package_directory, "processor.py"), "w") as f:
+        f.write(STUB_PROCESSOR_SOURCE)
+    warmup_image = os.path.join(workdir, "warmup.png")
+    with open(warmup_image, "wb") as f:
+        f.write(PNG_HEADER)
+
+    # Relative paths in the server (registry, result log, cache, logs) land in the work directory
+    os.chdir(workdir)
+    sys.path[:0] = [workdir, SERVER_DIRECTORIES[server]]
+    import server_engine
+
+    server_engine.BASE_UPLOAD_DIRECTORY = os.path.join(workdir, "receive_data")
+    server_engine.WARMUP_IMAGE_PATH = warmup_image
+    for name, value in overrides.items():
+        if not hasattr(server_engine, name):
+            raise SystemExit(f"server_engine has no setting {name}")
+        setattr(server_engine, name, value)
+    # Bound the wait for open connections (such as /events streams) on shutdown, as the servers' __main__ does
+    uvicorn.run(server_engine.app, host="127.0.0.1", port=port, log_level="warning",
+                timeout_graceful_shutdown=server_engine.SHUTDOWN_CONNECTION_TIMEOUT_SECONDS)
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+class LatencyRecorder:
+    """Collects request latencies and failures per endpoint."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok=True):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration):
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            summary = {
+                "count": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_per_s": round(len(values) / duration, 3),
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3)
+            }
+            for percent in PERCENTILES:
+                summary[f"p{percent}_ms"] = round(percentile(values, percent) * 1000, 3)
+            endpoints[endpoint] = summary
+        return endpoints
+
+class VirtualUser:
+    """One simulated client that uploads images back to back until the deadline."""
+
+    def __init__(self, index, server, client, recorder, image_bytes):
+        self.user_id = f"bench_user_{index}"
+        self.server = server
+        self.client = client
+        self.recorder = recorder
+        self.image_bytes = image_bytes
+        self.completed = 0
+
+    async def timed(self, endpoint, method, url, **kwargs):
+        """Send one request and record its latency under endpoint; the body is read completely."""
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except Exception:
+            self.recorder.record(endpoint, time.perf_counter() - started, ok=False)
+            raise
+        self.recorder.record(endpoint, time.perf_counter() - started, ok=response.status_code < 400)
+        return response
+
+    def upload_payload(self):
+        image_name = f"{uuid.uuid4().hex}.png"
+        image = PNG_HEADER + os.urandom(max(self.image_bytes - len(PNG_HEADER), 0))
+        data = {"user_id": self.user_id, "project_number": "BENCH", "floor_number": "1", "date": time.strftime("%Y-%m-%d")}
+        return data, {"images": (image_name, image, "image/png")}
+
+    async def run_url_round(self):
+        """Upload, wait for the job, then page, download and acknowledge the results."""
+        data, files = self.upload_payload()
+        started = time.perf_counter()
+        response = await self.timed("POST /receive_data", "POST", "/receive_data", data=data, files=files)
+        if response.status_code != 202:
+            return False
+        result_url = response.json()["result_url"]
+        while True:
+            response = await self.timed("GET /jobs/{job_id}/result", "GET", result_url)
+            if response.status_code != 202:
+                break
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        if response.status_code != 200:
+            return False
+        self.recorder.record("upload to job result", time.perf_counter() - started)
+
+        response = await self.timed("GET /get_inference_results/{user_id}", "GET", f"/get_inference_results/{self.user_id}")
+        if response.status_code != 200:
+            return True
+        page = response.json()
+        for result in page["results"]:
+            for file_info in result["files"].values():
+                if isinstance(file_info, dict):
+                    await self.timed("GET /files/...", "GET", file_info["url"])
+        await self.timed("POST /ack_inference_results/{user_id}", "POST", f"/ack_inference_results/{self.user_id}",
+                         data={"cursor": page["next_cursor"]})
+        return True
+
+    async def run_zipfile_round(self):
+        """Upload and read the whole ZIP response."""
+        data, files = self.upload_payload()
+        response = await self.timed("POST /receive_data", "POST", "/receive_data", data=data, files=files)
+        return response.status_code == 200
+
+    async def run(self, deadline):
+        run_round = self.run_url_round if self.server == "url" else self.run_zipfile_round
+        while time.monotonic() < deadline:
+            try:
+                if await run_round():
+                    self.completed += 1
+            except Exception:
+                await asyncio.sleep(0.1)  # Already recorded as an error; avoid a hot loop if the server is down
+
+async def wait_until_ready(client, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            if (await client.get("/health/ready")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server did not become ready within {SERVER_START_TIMEOUT} seconds")
+
+async def run_load(args, process):
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        await wait_until_ready(client, process)
+        recorder = LatencyRecorder()
+        users = [VirtualUser(index, args.server, client, recorder, args.image_bytes) for index in range(args.users)]
+        started = time.monotonic()
+        await asyncio.gather(*(user.run(started + args.duration) for user in users))
+        elapsed = time.monotonic() - started
+    completed = sum(user.completed for user in users)
+    return {
+        "server": args.server,
+        "config": {
+            "users": args.users,
+            "duration_s": args.duration,
+            "inference_ms": args.inference_ms,
+            "image_bytes": args.image_bytes,
+            "overrides": parse_overrides(args.set)
+        },
+        "elapsed_s": round(elapsed, 3),
+        "images_completed": completed,
+        "images_per_s": round(completed / elapsed, 3),
+        "endpoints": recorder.report(elapsed)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a FastAPI server with a stub FloorPlanProcessor.")
+    parser.add_argument("--server", choices=sorted(SERVER_DIRECTORIES), default="url")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load after the server is ready")
+    parser.add_argument("--inference-ms", type=float, default=100, help="Fake inference time per image")
+    parser.add_argument("--image-bytes", type=int, default=256 * 1024, help="Size of each uploaded image")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Override a server_engine setting")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the server's uploads, logs and stores")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.server, args.port, args.workdir, parse_overrides(args.set))
+        return
+
+    workdir = tempfile.mkdtemp(prefix=f"benchmark_{args.server}_")
+    command = [sys.executable, os.path.abspath(__file__), "--serve", "--server", args.server,
+               "--port", str(args.port), "--workdir", workdir]
+    for assignment in args.set:
+        command += ["--set", assignment]
+    env = dict(os.environ, BENCHMARK_INFERENCE_MS=str(args.inference_ms))
+    process = subprocess.Popen(command, env=env)
+    try:
+        report = asyncio.run(run_load(args, process))
+    finally:
+        # SIGINT lets uvicorn run the lifespan shutdown like a normal stop
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Export the floor-plan models to ONNX, optionally quantize them to INT8, and check the exports against PyTorch.
+
+Every .pt checkpoint is exported next to itself as <name>.onnx, and as <name>.int8.onnx with --int8 (dynamic
+quantization of the weights). These are the files the servers load when PROCESSOR_CONFIG sets
+'inference_backend': 'onnx'. Each export then runs on the same images as the PyTorch model. The report lists,
+per model and variant, how far the raw network outputs drift, how closely the final predictions match
+(reproduced boxes, box IoU, score drift, mask IoU) and the median inference time for every thread count:
+
+    python export_onnx.py ./models/best_crop.pt ./models/best_segmentation.pt ./models/best_detection.pt \\
+        ./models/best_oob.pt --int8 --images ./img --threads 1 2 4 --report onnx_report.json
+
+The fastest thread count of the variant you deploy goes into 'onnx_intra_op_threads'. Without --images the
+models run on random noise, which checks the export but says little about accuracy.
+"""
+import os
+import json
+import math
+import argparse
+import statistics
+
+# Applies the thread settings to ONNX Runtime sessions the way the servers do for the onnx backend
+from floorplan_serving import configure_onnx_runtime
+
+DEFAULT_IMAGE_SIZE = 640
+DEFAULT_RUNS = 5
+WARMUP_RUNS = 2
+RANDOM_IMAGES = 4
+# Predictions match when they have the same class and their boxes overlap by at least this IoU
+MATCH_IOU = 0.5
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+def export_model(model_path, image_size, int8, dynamic):
+    """Export a checkpoint to ONNX (and INT8) next to it and return {variant: path}."""
+    from ultralytics import YOLO
+
+    base_path = os.path.splitext(model_path)[0]
+    # ultralytics writes the export next to the weights as <name>.onnx
+    variants = {"onnx": YOLO(model_path).export(format="onnx", imgsz=image_size, dynamic=dynamic, simplify=True)}
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # ONNX Runtime's CPU ConvInteger kernel only takes unsigned 8-bit weights
+        quantize_dynamic(variants["onnx"], f"{base_path}.int8.onnx", weight_type=QuantType.QUInt8)
+        variants["onnx-int8"] = f"{base_path}.int8.onnx"
+    return variants
+
+def load_images(images_directory, image_size):
+    """Return the images of a directory as BGR arrays, or a few random ones when no directory is given."""
+    import cv2
+    import numpy as np
+
+    if not images_directory:
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8) for _ in range(RANDOM_IMAGES)]
+    images = []
+    for name in sorted(os.listdir(images_directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(images_directory, name))
+            if image is not None:
+                images.append(image)
+    if not images:
+        raise SystemExit(f"No images found in {images_directory}")
+    return images
+
+def predict(model, images, args):
+    """Run every image once; returns the ultralytics Results in image order."""
+    # rect=False letterboxes every backend to the same square input, so the outputs are comparable
+    return [model.predict(image, imgsz=args.image_size, conf=args.conf, rect=False, verbose=False)[0] for image in images]
+
+def prediction_arrays(result):
+    """Return (boxes, classes, scores, masks, probs) of one result as numpy arrays; missing parts are None."""
+    boxes = result.obb if getattr(result, "obb", None) is not None else result.boxes
+    masks = result.masks.data.cpu().numpy() > 0.5 if result.masks is not None else None
+    probs = result.probs.data.cpu().numpy() if result.probs is not None else None
+    if boxes is None:
+        return None, None, None, masks, probs
+    return boxes.xyxy.cpu().numpy(), boxes.cls.cpu().numpy(), boxes.conf.cpu().numpy(), masks, probs
+
+def box_iou(box, other):
+    inter_w = min(box[2], other[2]) - max(box[0], other[0])
+    inter_h = min(box[3], other[3]) - max(box[1], other[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    intersection = inter_w * inter_h
+    union = (box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1]) - intersection
+    return float(intersection / union)
+
+def compare_raw_outputs(model_path, onnx_path, image_size):
+    """
+    Feed one random input to the PyTorch network and the ONNX Runtime session and compare their first output
+    (the raw predictions before NMS). Returns the largest and the mean absolute difference.
+    """
+    import numpy as np
+    import onnxruntime
+    import torch
+    from ultralytics import YOLO
+
+    network = YOLO(model_path).model.float().eval().fuse(verbose=False)
+    inputs = torch.rand(1, 3, image_size, image_size, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        outputs = network(inputs)
+    # Detection heads return (predictions, extras) and segmentation heads nest that once more
+    while isinstance(outputs, (list, tuple)):
+        outputs = outputs[0]
+    reference = outputs.numpy()
+    session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+    candidate = session.run(None, {session.get_inputs()[0].name: inputs.numpy()})[0]
+    difference = np.abs(reference - candidate)
+    return {"max_abs_diff": float(difference.max()), "mean_abs_diff": float(difference.mean()),
+            "max_abs_output": float(np.abs(reference).max())}
+
+def compare_predictions(reference_results, candidate_results):
+    """
+    Compare a variant's predictions with the PyTorch ones. Every reference box, highest score first, is paired
+    with the best unpaired candidate box of the same class at MATCH_IOU or more.
+    """
+    reference_count = candidate_count = 0
+    box_ious, score_diffs, mask_ious, prob_diffs = [], [], [], []
+    top1_agreement = []
+    for reference, candidate in zip(reference_results, candidate_results):
+        ref_boxes, ref_classes, ref_scores, ref_masks, ref_probs = prediction_arrays(reference)
+        boxes, classes, scores, masks, probs = prediction_arrays(candidate)
+        if ref_probs is not None and probs is not None:
+            prob_diffs.append(float(abs(ref_probs - probs).max()))
+            top1_agreement.append(int(ref_probs.argmax() == probs.argmax()))
+        if ref_boxes is None or boxes is None:
+            continue
+        reference_count += len(ref_boxes)
+        candidate_count += len(boxes)
+        unpaired = set(range(len(boxes)))
+        for i in sorted(range(len(ref_boxes)), key=lambda i: -ref_scores[i]):
+            best, best_iou = None, MATCH_IOU
+            for j in unpaired:
+                if classes[j] == ref_classes[i]:
+                    iou = box_iou(ref_boxes[i], boxes[j])
+                    if iou >= best_iou:
+                        best, best_iou = j, iou
+            if best is None:
+                continue
+            unpaired.discard(best)
+            box_ious.append(best_iou)
+            score_diffs.append(float(abs(ref_scores[i] - scores[best])))
+            if ref_masks is not None and masks is not None and ref_masks.shape[1:] == masks.shape[1:]:
+                union = (ref_masks[i] | masks[best]).sum()
+                mask_ious.append(float((ref_masks[i] & masks[best]).sum() / union) if union else 1.0)
+
+    def mean(values):
+        return round(statistics.fmean(values), 4) if values else None
+
+    return {
+        "reference_boxes": reference_count,
+        "candidate_boxes": candidate_count,
+        "matched_boxes": len(box_ious),
+        # Share of the PyTorch boxes the variant reproduces, and share of its boxes PyTorch also found
+        "recall": round(len(box_ious) / reference_count, 4) if reference_count else None,
+        "precision": round(len(box_ious) / candidate_count, 4) if candidate_count else None,
+        "mean_box_iou": mean(box_ious),
+        "max_score_diff": round(max(score_diffs), 4) if score_diffs else None,
+        "mean_mask_iou": mean(mask_ious),
+        "top1_agreement": mean(top1_agreement),
+        "max_prob_diff": round(max(prob_diffs), 4) if prob_diffs else None
+    }
+
+def time_inference(model, images, args):
+    """Return the median and p95 model time in ms, from the inference time ultralytics measures per image."""
+    for _ in range(WARMUP_RUNS):
+        predict(model, images[:1], args)
+    timings = sorted(result.speed["inference"] for _ in range(args.runs) for result in predict(model, images, args))
+    p95 = timings[max(math.ceil(0.95 * len(timings)), 1) - 1]
+    return {"median_ms": round(statistics.median(timings), 3), "p95_ms": round(p95, 3)}
+
+def evaluate_model(model_path, images, args):
+    """Export one checkpoint, then compare and time PyTorch and each ONNX variant."""
+    import torch
+    from ultralytics import YOLO
+
+    variants = {"torch": model_path}
+    variants.update(export_model(model_path, args.image_size, args.int8, not args.static))
+    default_torch_threads = torch.get_num_threads()
+    reference_results = None
+    report = []
+    for variant, path in variants.items():
+        entry = {"variant": variant, "path": path, "size_bytes": os.path.getsize(path), "parity": None, "timings": {}}
+        for threads in args.threads:
+            if variant == "torch":
+                torch.set_num_threads(threads or default_torch_threads)
+            else:
+                configure_onnx_runtime(threads, args.inter_op_threads)
+            # A fresh model per setting, so the ONNX Runtime session is created with these threads
+            model = YOLO(path)
+            if variant == "torch" and reference_results is None:
+                reference_results = predict(model, images, args)
+            elif variant != "torch" and entry["parity"] is None:
+                entry["parity"] = compare_predictions(reference_results, predict(model, images, args))
+                entry["parity"].update(compare_raw_outputs(model_path, path, args.image_size))
+            entry["timings"][str(threads)] = time_inference(model, images, args)
+        report.append(entry)
+    torch.set_num_threads(default_torch_threads)
+    return {"model": model_path, "variants": report}
+
+def print_report(models):
+    print(f"{'model':<28} {'variant':<10} {'MB':>7} {'max Δ':>9} {'recall':>7} {'box IoU':>8} {'mask IoU':>9} {'score Δ':>8} "
+          f"{'best ms':>9} {'threads':>8} {'speedup':>8}")
+    for model in models:
+        torch_best = None
+        for entry in model["variants"]:
+            threads, timing = min(entry["timings"].items(), key=lambda item: item[1]["median_ms"])
+            if entry["variant"] == "torch":
+                torch_best = timing["median_ms"]
+            parity = entry["parity"] or {}
+
+            def cell(key, spec=".3f"):
+                return "-" if parity.get(key) is None else format(parity[key], spec)
+
+            speedup = f"{torch_best / timing['median_ms']:.2f}x" if torch_best and timing["median_ms"] else "-"
+            print(f"{os.path.basename(model['model']):<28} {entry['variant']:<10} {entry['size_bytes'] / 1e6:>7.1f} "
+                  f"{cell('max_abs_diff', '.2e'):>9} {cell('recall'):>7} {cell('mean_box_iou'):>8} {cell('mean_mask_iou'):>9} {cell('max_score_diff'):>8} "
+                  f"{timing['median_ms']:>9.1f} {threads:>8} {speedup:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the floor-plan models to ONNX and report parity and speed against PyTorch.")
+    parser.add_argument("models", nargs="+", help=".pt checkpoints, e.g. the *_model_path files of PROCESSOR_CONFIG")
+    parser.add_argument("--int8", action="store_true", help="Also write an INT8 dynamically quantized export")
+    parser.add_argument("--static", action="store_true", help="Export with a fixed input size instead of dynamic axes")
+    parser.add_argument("--images", help="Directory of sample floor plans; random images are used when omitted")
+    parser.add_argument("--image-size", type=int, default=DEFAULT_IMAGE_SIZE)
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold of the compared predictions")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0],
+                        help="Intra-op thread counts to time (ONNX Runtime sessions and torch); 0 uses the library default")
+    parser.add_argument("--inter-op-threads", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="Timed passes over the images per setting")
+    parser.add_argument("--report", help="Write the full report as JSON to this file")
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.image_size)
+    models = [evaluate_model(model_path, images, args) for model_path in args.models]
+    print_report(models)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "image_size": args.image_size,
+                "images": len(images),
+                "conf": args.conf,
+                "inter_op_threads": args.inter_op_threads,
+                "models": models
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
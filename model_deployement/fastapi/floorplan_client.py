@@ -0,0 +1,256 @@
+"""
+Asyncio client for submitting floor plans to a server_engine /receive_data endpoint in bulk.
+
+All requests share one pooled keep-alive HTTP connection pool, at most `concurrency` uploads are in flight,
+failed requests are retried with exponential backoff, and every upload carries an Idempotency-Key derived
+from its ids and image contents so a retry never queues the same image twice.
+Works with both servers: queued jobs (based_on_url) are followed until they finish, ZIP responses
+(based_on_zipfile) are saved under the results directory.
+
+Submit a whole directory tree laid out as <user_id>/<project_number>/<floor_number>/<image>:
+
+    python floorplan_client.py ./floor_plans --server http://server-ip:8000 --concurrency 16
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import mimetypes
+from datetime import datetime
+
+import httpx
+
+DEFAULT_CONCURRENCY = 8
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 1.0
+RETRY_BACKOFF_MAX_SECONDS = 60.0
+# Statuses worth retrying: queue full, and gateway or server restarts
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+REQUEST_TIMEOUT = 120
+JOB_POLL_INTERVAL = 2
+JOB_POLL_TIMEOUT = 600
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+class SubmissionError(Exception):
+    """Raised when a floor plan could not be submitted or its job failed."""
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def normalize_floor(floor_number):
+    """Return the floor number without the 'floor_' prefix the servers add to folder names."""
+    floor = str(floor_number)
+    return floor[len("floor_"):] if floor.startswith("floor_") else floor
+
+def iter_floor_plans(root_directory, user_id=None):
+    """
+    Yield (user_id, project_number, floor_number, image_path) for every image under
+    root_directory/<user_id>/<project_number>/<floor_number>/. With user_id, root_directory is one user's folder.
+    """
+    user_directories = [(user_id, root_directory)] if user_id else [
+        (name, os.path.join(root_directory, name)) for name in sorted(os.listdir(root_directory))
+    ]
+    for user, user_directory in user_directories:
+        if not os.path.isdir(user_directory):
+            continue
+        for project_number in sorted(os.listdir(user_directory)):
+            project_directory = os.path.join(user_directory, project_number)
+            if not os.path.isdir(project_directory):
+                continue
+            for floor_name in sorted(os.listdir(project_directory)):
+                floor_directory = os.path.join(project_directory, floor_name)
+                if not os.path.isdir(floor_directory):
+                    continue
+                for image_name in sorted(os.listdir(floor_directory)):
+                    if image_name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield user, project_number, normalize_floor(floor_name), os.path.join(floor_directory, image_name)
+
+def floor_plans_from_user_data(user_data):
+    """
+    Turn the USER_DATA dict of the user scripts into (user_id, project_number, floor_number, image_path) tuples.
+    Accepts both layouts: a list of projects with a list of floors, or one project with a single floor.
+    """
+    floor_plans = []
+    for user_id, projects in user_data.items():
+        for project in projects if isinstance(projects, list) else [projects]:
+            floors = project["floor_numbers"]
+            for floor_number in floors if isinstance(floors, list) else [floors]:
+                floor_plans.append((user_id, project["project_number"], str(floor_number), project["images_name"]))
+    return floor_plans
+
+class FloorPlanClient:
+    """
+    Submits floor plans over one pooled keep-alive connection, at most `concurrency` at a time.
+    Use as `async with FloorPlanClient(server_url) as client: await client.submit(...)`.
+    """
+
+    def __init__(self, server_url, concurrency=DEFAULT_CONCURRENCY, max_retries=MAX_RETRIES,
+                 timeout=REQUEST_TIMEOUT, results_directory="received_results"):
+        self.max_retries = max_retries
+        self.results_directory = results_directory
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client = httpx.AsyncClient(
+            base_url=server_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    @staticmethod
+    def _retry_delay(attempt, response=None):
+        """Exponential backoff with jitter, or the server's Retry-After when it sent one."""
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        delay = min(RETRY_BACKOFF_SECONDS * 2 ** attempt, RETRY_BACKOFF_MAX_SECONDS)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def submit(self, user_id, project_number, floor_number, image_path):
+        """
+        Upload one image and wait for its result.
+        Returns the job result (queued-job server) or the path of the saved ZIP (ZIP server).
+        """
+        loop = asyncio.get_running_loop()
+        image_digest = await loop.run_in_executor(None, file_sha256, image_path)
+        idempotency_key = hashlib.sha256(
+            f"{user_id}/{project_number}/{floor_number}/{os.path.basename(image_path)}/{image_digest}".encode("utf-8")
+        ).hexdigest()
+        data = {
+            "user_id": user_id,
+            "project_number": project_number,
+            "floor_number": floor_number,
+            "date": datetime.now().strftime("%Y-%m-%d")
+        }
+        content_type = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with open(image_path, "rb") as image_file:
+                        files = {"images": (os.path.basename(image_path), image_file, content_type)}
+                        request = self._client.build_request(
+                            "POST", "/receive_data", data=data, files=files, headers={"Idempotency-Key": idempotency_key}
+                        )
+                        response = await self._client.send(request, stream=True)
+                    try:
+                        if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                            delay = self._retry_delay(attempt, response)
+                        elif response.status_code == 202:
+                            await response.aread()
+                            job = response.json()
+                            break
+                        elif response.status_code == 200 and response.headers.get("content-type") == "application/zip":
+                            return await self._save_zip(response, user_id, project_number, floor_number, image_path)
+                        else:
+                            await response.aread()
+                            raise SubmissionError(f"{image_path}: server responded with {response.status_code} - {response.text}")
+                    finally:
+                        await response.aclose()
+                except httpx.TransportError as e:
+                    if attempt >= self.max_retries:
+                        raise SubmissionError(f"{image_path}: {e!r}") from e
+                    delay = self._retry_delay(attempt)
+                await asyncio.sleep(delay)
+        # Follow the queued job without holding a concurrency slot
+        return await self._wait_for_job(job["result_url"], image_path)
+
+    async def _wait_for_job(self, result_url, image_path):
+        deadline = time.monotonic() + JOB_POLL_TIMEOUT
+        attempt = 0
+        while time.monotonic() < deadline:
+            try:
+                response = await self._client.get(result_url)
+            except httpx.TransportError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise SubmissionError(f"{image_path}: {e!r}") from e
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code != 202 and response.status_code not in RETRYABLE_STATUS_CODES:
+                raise SubmissionError(f"{image_path}: job failed with {response.status_code} - {response.text}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        raise SubmissionError(f"{image_path}: job did not finish within {JOB_POLL_TIMEOUT} seconds")
+
+    async def _save_zip(self, response, user_id, project_number, floor_number, image_path):
+        directory = os.path.join(self.results_directory, user_id, project_number, f"floor_{floor_number}")
+        os.makedirs(directory, exist_ok=True)
+        zip_path = os.path.join(directory, f"{os.path.splitext(os.path.basename(image_path))[0]}.zip")
+        with open(f"{zip_path}.part", "wb") as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(f"{zip_path}.part", zip_path)
+        return zip_path
+
+    async def submit_many(self, floor_plans):
+        """
+        Submit (user_id, project_number, floor_number, image_path) tuples concurrently.
+        Returns one (floor_plan, result, error) tuple per input, in order.
+        """
+        async def run(floor_plan):
+            try:
+                return floor_plan, await self.submit(*floor_plan), None
+            except Exception as e:
+                return floor_plan, None, e
+        return await asyncio.gather(*(run(floor_plan) for floor_plan in floor_plans))
+
+async def submit_all(server_url, floor_plans, concurrency=DEFAULT_CONCURRENCY, max_retries=MAX_RETRIES,
+                     results_directory="received_results"):
+    """Submit every floor plan, print a summary and return the (floor_plan, result, error) tuples."""
+    floor_plans = list(floor_plans)
+    started = time.monotonic()
+    async with FloorPlanClient(server_url, concurrency, max_retries, results_directory=results_directory) as client:
+        outcomes = await client.submit_many(floor_plans)
+    elapsed = time.monotonic() - started
+    failures = [(floor_plan, error) for floor_plan, _, error in outcomes if error is not None]
+    for floor_plan, error in failures:
+        print(f"Failed: {floor_plan}: {error}")
+    rate = len(floor_plans) / elapsed if elapsed else 0.0
+    print(f"Submitted {len(floor_plans) - len(failures)}/{len(floor_plans)} floor plans in {elapsed:.1f}s ({rate:.1f}/s)")
+    return outcomes
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit a directory tree of floor plans to the inference server.")
+    parser.add_argument("root", help="Directory laid out as <user_id>/<project_number>/<floor_number>/<image>")
+    parser.add_argument("--server", required=True, help="Server URL, e.g. http://server-ip:8000")
+    parser.add_argument("--user", help="Treat root as the folder of this single user")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES)
+    parser.add_argument("--results-dir", default="received_results", help="Where ZIP responses are saved")
+    parser.add_argument("--report", help="Write a JSON line per floor plan with its outcome to this file")
+    args = parser.parse_args()
+
+    floor_plans = list(iter_floor_plans(args.root, args.user))
+    print(f"Found {len(floor_plans)} floor plans under {args.root}")
+    outcomes = asyncio.run(submit_all(args.server, floor_plans, args.concurrency, args.retries, args.results_dir))
+    if args.report:
+        with open(args.report, "w") as f:
+            for floor_plan, result, error in outcomes:
+                f.write(json.dumps({
+                    "floor_plan": floor_plan,
+                    "result": result,
+                    "error": str(error) if error else None
+                }) + "\n")
+    sys.exit(1 if any(error for _, _, error in outcomes) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2231 @@
+"""
+Serving machinery shared by the two FloorPlanProcessor servers (based_on_url and based_on_zipfile).
+
+Both server_engine.py files import this module and pass their own settings when they create the objects below:
+the Prometheus metrics, the processed-image registries, the result logs, the fair-share scheduler, the
+micro-batcher and staged pipeline, the result cache, the retention sweeper of the upload tree and tiled inference.
+"""
+import os
+import json
+import asyncio
+import bisect
+import hashlib
+import itertools
+import mimetypes
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+from urllib.parse import quote, unquote
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from prometheus_client import REGISTRY, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Priority classes of the scheduler and the micro-batcher, highest first
+PRIORITY_CLASSES = ("interactive", "bulk")
+
+# Prometheus metrics served on /metrics by both servers. In process mode, point PROMETHEUS_MULTIPROC_DIR at an empty
+# directory before startup so the inference timings recorded in the worker processes are included.
+REQUEST_COUNT = Counter("floorplan_http_requests_total", "HTTP requests by route and status code", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram("floorplan_http_request_duration_seconds", "Time until the response starts, by route", ["method", "route"])
+INFERENCE_STAGE_SECONDS = Histogram(
+    "floorplan_inference_stage_seconds", "Time spent in each FloorPlanProcessor stage", ["stage"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+UPLOAD_BYTES = Counter("floorplan_upload_bytes_total", "Bytes of uploaded images saved to disk")
+TILES_PROCESSED = Counter("floorplan_tiles_total", "Tiles of large floor plans run through the models")
+RETENTION_DELETED_BYTES = Counter("floorplan_retention_deleted_bytes_total", "Bytes of request folders deleted by the retention sweeper")
+ENCODE_SECONDS = Histogram("floorplan_encode_seconds", "Time spent encoding result files for transfer", ["format"])
+SCHEDULER_QUEUE_SECONDS = Histogram(
+    "floorplan_scheduler_queue_seconds", "Time jobs and requests waited for an executor worker, by priority class", ["priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, 600, 1800, 3600)
+)
+SCHEDULER_SLO_MISSES = Counter(
+    "floorplan_scheduler_slo_misses_total", "Jobs and requests that waited longer than the queue-time SLO of their class", ["priority"]
+)
+STORE_SECONDS = Histogram(
+    "floorplan_store_operation_seconds", "Time spent in the result and processed-image stores", ["store", "operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+
+# Collector of the server's queue, cache and retention state, registered by register_state_collector
+state_collector = None
+
+
+def register_state_collector(collector):
+    """Register the collector a server reports its state with, replacing the one registered before (e.g. on a reload)."""
+    global state_collector
+    if state_collector is not None:
+        REGISTRY.unregister(state_collector)
+    REGISTRY.register(collector)
+    state_collector = collector
+
+
+async def record_request_metrics(request, call_next):
+    """HTTP middleware that counts every request and times it under its route template."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        REQUEST_COUNT.labels(request.method, route_path, status).inc()
+        REQUEST_LATENCY.labels(request.method, route_path).observe(time.perf_counter() - started)
+
+
+def health_response(status, status_code=200, **fields):
+    """Return the answer of a health probe, {"status": status, **fields}, with status_code (503 when failing)."""
+    return JSONResponse(content={"status": status, **fields}, status_code=status_code)
+
+
+@STORE_SECONDS.labels("json", "read").time()
+def load_json_data(filename):
+    """Load JSON data from a file."""
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+@STORE_SECONDS.labels("json", "write").time()
+def save_json_data(filename, data):
+    """Save JSON data to a file, replacing it at once so readers never load a partly written file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_path, filename)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def normalize_floor(floor_number):
+    """Return the floor number without the 'floor_' prefix used in folder names."""
+    floor = str(floor_number)
+    return floor[len("floor_"):] if floor.startswith("floor_") else floor
+
+
+class ProcessedImageRegistry(ABC):
+    """Interface for the store that remembers which images were already processed."""
+
+    @abstractmethod
+    def contains(self, user_id, project_number, floor_number, image_name):
+        """Tell whether an image was recorded as processed."""
+
+    @abstractmethod
+    def add_many(self, entries):
+        """Record several (user_id, project_number, floor_number, image_name) entries at once."""
+
+    def add(self, user_id, project_number, floor_number, image_name):
+        self.add_many([(user_id, project_number, floor_number, image_name)])
+
+    @abstractmethod
+    def remove_many(self, entries):
+        """Forget several (user_id, project_number, floor_number, image_name) entries, e.g. once their files are deleted."""
+
+    def apply(self, added, removed):
+        """Record the added entries and forget the removed ones; backends override this to do both in one write."""
+        if removed:
+            self.remove_many(removed)
+        if added:
+            self.add_many(added)
+
+    def close(self):
+        pass
+
+
+class JsonProcessedImageRegistry(ProcessedImageRegistry):
+    """Legacy registry that keeps everything in a single nested JSON file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def contains(self, user_id, project_number, floor_number, image_name):
+        processed_images = load_json_data(self.filename)
+        floor_key = f"floor_{normalize_floor(floor_number)}"
+        return image_name in processed_images.get(user_id, {}).get(project_number, {}).get(floor_key, [])
+
+    def add_many(self, entries):
+        with self._lock:
+            processed_images = load_json_data(self.filename)
+            for user_id, project_number, floor_number, image_name in entries:
+                floor_key = f"floor_{normalize_floor(floor_number)}"
+                images = processed_images.setdefault(user_id, {}).setdefault(project_number, {}).setdefault(floor_key, [])
+                if image_name not in images:
+                    images.append(image_name)
+            save_json_data(self.filename, processed_images)
+
+    def remove_many(self, entries):
+        with self._lock:
+            processed_images = load_json_data(self.filename)
+            for user_id, project_number, floor_number, image_name in entries:
+                floor_key = f"floor_{normalize_floor(floor_number)}"
+                images = processed_images.get(user_id, {}).get(project_number, {}).get(floor_key, [])
+                if image_name in images:
+                    images.remove(image_name)
+            save_json_data(self.filename, processed_images)
+
+    def apply(self, added, removed):
+        with self._lock:
+            processed_images = load_json_data(self.filename)
+            for user_id, project_number, floor_number, image_name in removed:
+                floor_key = f"floor_{normalize_floor(floor_number)}"
+                images = processed_images.get(user_id, {}).get(project_number, {}).get(floor_key, [])
+                if image_name in images:
+                    images.remove(image_name)
+            for user_id, project_number, floor_number, image_name in added:
+                floor_key = f"floor_{normalize_floor(floor_number)}"
+                images = processed_images.setdefault(user_id, {}).setdefault(project_number, {}).setdefault(floor_key, [])
+                if image_name not in images:
+                    images.append(image_name)
+            save_json_data(self.filename, processed_images)
+
+
+class SqliteProcessedImageRegistry(ProcessedImageRegistry):
+    """
+    Registry backed by SQLite in WAL mode, keyed on (user_id, project_number, floor, image).
+    Lookups hit the primary key index, so they do not depend on the size of the history.
+    """
+
+    def __init__(self, db_path, legacy_json_file=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_images ("
+            "user_id TEXT NOT NULL, project_number TEXT NOT NULL, floor TEXT NOT NULL, image TEXT NOT NULL, "
+            "processed_at TEXT NOT NULL, PRIMARY KEY (user_id, project_number, floor, image)) WITHOUT ROWID"
+        )
+        if legacy_json_file:
+            self._migrate_from_json(legacy_json_file)
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def contains(self, user_id, project_number, floor_number, image_name):
+        row = self._connection().execute(
+            "SELECT 1 FROM processed_images WHERE user_id=? AND project_number=? AND floor=? AND image=?",
+            (user_id, project_number, normalize_floor(floor_number), image_name)
+        ).fetchone()
+        return row is not None
+
+    def add_many(self, entries):
+        processed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            (user_id, project_number, normalize_floor(floor_number), image_name, processed_at)
+            for user_id, project_number, floor_number, image_name in entries
+        ]
+        if not rows:
+            return
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR IGNORE INTO processed_images VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove_many(self, entries):
+        rows = [
+            (user_id, project_number, normalize_floor(floor_number), image_name)
+            for user_id, project_number, floor_number, image_name in entries
+        ]
+        if rows:
+            self._connection().executemany(
+                "DELETE FROM processed_images WHERE user_id=? AND project_number=? AND floor=? AND image=?", rows
+            )
+
+    def apply(self, added, removed):
+        processed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "DELETE FROM processed_images WHERE user_id=? AND project_number=? AND floor=? AND image=?",
+                [(user_id, project_number, normalize_floor(floor_number), image_name) for user_id, project_number, floor_number, image_name in removed]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO processed_images VALUES (?, ?, ?, ?, ?)",
+                [(user_id, project_number, normalize_floor(floor_number), image_name, processed_at) for user_id, project_number, floor_number, image_name in added]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _migrate_from_json(self, legacy_json_file):
+        """Import the legacy processed_images.json once, then rename it so it is not imported again."""
+        if not os.path.exists(legacy_json_file):
+            return
+        processed_images = load_json_data(legacy_json_file)
+        entries = [
+            (user_id, project_number, floor_key, image_name)
+            for user_id, projects in processed_images.items()
+            for project_number, floors in projects.items()
+            for floor_key, images in floors.items()
+            for image_name in images
+        ]
+        self.add_many(entries)
+        try:
+            os.replace(legacy_json_file, f"{legacy_json_file}.migrated")
+        except FileNotFoundError:
+            pass  # Another worker finished the migration first
+        logger.info(f"Migrated {len(entries)} processed image entries from {legacy_json_file} to {self.db_path}")
+
+
+class SingleWriterRegistry(ProcessedImageRegistry):
+    """
+    Registry that funnels every write through one writer thread.
+    Writes queued while the writer is busy or within its batching window are merged, the last write of an entry
+    winning, and applied to the backend at once. add_many and remove_many return once their write is applied,
+    so the request that made a change reads it back; lookups go straight to the backend.
+    """
+
+    def __init__(self, backend, max_batch_size=256, max_wait_ms=5):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def contains(self, user_id, project_number, floor_number, image_name):
+        return self.backend.contains(user_id, project_number, floor_number, image_name)
+
+    def add_many(self, entries):
+        self._write(entries, True)
+
+    def remove_many(self, entries):
+        self._write(entries, False)
+
+    def apply(self, added, removed):
+        self._write([(entry, True) for entry in added] + [(entry, False) for entry in removed])
+
+    def close(self):
+        """Apply the writes still queued, then stop the writer thread."""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+
+    def stats(self):
+        """Return how many writes were merged into each applied batch."""
+        if self._writer is None:
+            return {"batches": 0, "items": 0}
+        return self._writer.stats()
+
+    def _write(self, entries, present=None):
+        changes = [(entry, present) for entry in entries] if present is not None else list(entries)
+        if not changes:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                # Started on first use, so importing a server starts no threads
+                self._writer = MicroBatcher(self._apply_batch, self.max_batch_size, self.max_wait_ms, name="registry-writer")
+            future = self._writer.submit(changes)
+        future.result()
+
+    def _apply_batch(self, batch):
+        merged = {}
+        for changes in batch:
+            for (user_id, project_number, floor_number, image_name), present in changes:
+                key = (user_id, project_number, normalize_floor(floor_number), image_name)
+                merged.pop(key, None)
+                merged[key] = present
+        self.backend.apply(
+            [key for key, present in merged.items() if present],
+            [key for key, present in merged.items() if not present]
+        )
+        return [None] * len(batch)
+
+
+def create_processed_image_registry(backend, db_path, json_file, single_writer=True, max_batch_size=256, max_wait_ms=5):
+    """
+    Create the processed-image registry: "sqlite" keeps it in db_path (importing a legacy json_file once),
+    "json" in json_file. With single_writer its writes go through one writer thread.
+    """
+    if backend == "sqlite":
+        registry = SqliteProcessedImageRegistry(db_path, legacy_json_file=json_file)
+    elif backend == "json":
+        registry = JsonProcessedImageRegistry(json_file)
+    else:
+        raise ValueError(f"Unknown processed images backend: {backend}")
+    return SingleWriterRegistry(registry, max_batch_size, max_wait_ms) if single_writer else registry
+
+
+async def save_upload_file(upload, destination, max_bytes, chunk_size=1024 * 1024):
+    """
+    Stream an uploaded file to disk in chunks of chunk_size so memory use does not depend on the file size.
+    The max_bytes limit is enforced while streaming; a partial file is removed when the upload is rejected.
+    The chunks are written from a thread so a slow disk does not stall the event loop.
+    """
+    written = 0
+    try:
+        with open(destination, "wb") as file:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {max_bytes} bytes")
+                await asyncio.to_thread(file.write, chunk)
+    except Exception:
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise
+    UPLOAD_BYTES.inc(written)
+    return written
+
+
+def extract_archive_images(archive_path, destination, max_images, max_bytes, extensions=('.png', '.jpg', '.jpeg'), chunk_size=1024 * 1024):
+    """
+    Extract the images of an uploaded ZIP archive into destination and return their file names.
+    Folders inside the archive are flattened, which also keeps every entry inside destination; the number of
+    images and their extracted size are limited, whatever the archive's headers claim.
+    """
+    try:
+        archive = zipfile.ZipFile(archive_path)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="The archive is not a valid ZIP file")
+    with archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(extensions)
+            # Skip the resource forks macOS adds to archives
+            and not os.path.basename(info.filename).startswith("._") and not info.filename.startswith("__MACOSX/")
+        ]
+        if len(members) > max_images:
+            raise HTTPException(status_code=413, detail=f"A batch can hold at most {max_images} images")
+        image_names = []
+        extracted = 0
+        for info in members:
+            image_name = os.path.basename(info.filename)
+            if image_name in image_names:
+                raise HTTPException(status_code=400, detail=f"The archive holds more than one image named {image_name}")
+            with archive.open(info) as source, open(os.path.join(destination, image_name), "wb") as target:
+                for chunk in iter(lambda: source.read(chunk_size), b""):
+                    extracted += len(chunk)
+                    if extracted > max_bytes:
+                        raise HTTPException(status_code=413, detail=f"The extracted images exceed the limit of {max_bytes} bytes")
+                    target.write(chunk)
+            image_names.append(image_name)
+    UPLOAD_BYTES.inc(extracted)
+    return image_names
+
+
+def duplicate_base_names(image_names):
+    """Return the sorted names, without extension, that more than one of image_names shares, e.g. plan.png and plan.jpg."""
+    base_names = [os.path.splitext(image_name)[0] for image_name in image_names]
+    return sorted({base_name for base_name in base_names if base_names.count(base_name) > 1})
+
+
+@STORE_SECONDS.labels("manifest", "write").time()
+def write_result_manifest(image_folder, image_name, result_files, folders, filename):
+    """
+    Describe every file under the given folders of an image's folder in its manifest (saved there as filename)
+    and return the manifest. Files are listed with their path relative to the image folder, size, SHA-256 and
+    content type, and the result_files (result type -> path) with their key; the result types the processor
+    did not write are listed as missing.
+    """
+    keys = {os.path.relpath(file_path, image_folder): key for key, file_path in result_files.items()}
+    files = []
+    for folder in folders:
+        for root, dirs, names in os.walk(os.path.join(image_folder, folder)):
+            dirs.sort()
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                relative_path = os.path.relpath(file_path, image_folder)
+                entry = {
+                    "path": relative_path,
+                    "size": os.path.getsize(file_path),
+                    "sha256": ResultCache.hash_file(file_path),
+                    "content_type": mimetypes.guess_type(name)[0] or "application/octet-stream"
+                }
+                if relative_path in keys:
+                    entry["key"] = keys[relative_path]
+                files.append(entry)
+    found = {entry["key"] for entry in files if "key" in entry}
+    manifest = {
+        "image_name": image_name,
+        "created_at": time.time(),
+        "files": files,
+        "missing": [key for key in keys.values() if key not in found]
+    }
+    save_json_data(os.path.join(image_folder, filename), manifest)
+    return manifest
+
+
+@STORE_SECONDS.labels("manifest", "read").time()
+def read_result_manifest(image_folder, image_name, result_files, folders, filename):
+    """
+    Return the manifest of an image's results, writing it first for folders processed before manifests existed.
+    Returns None when the image folder does not exist.
+    """
+    try:
+        with open(os.path.join(image_folder, filename)) as f:
+            manifest = json.load(f)
+        if manifest.get("image_name") == image_name:
+            return manifest
+    except (FileNotFoundError, ValueError):
+        pass
+    if not os.path.isdir(image_folder):
+        return None  # Never processed, or removed by retention
+    return write_result_manifest(image_folder, image_name, result_files, folders, filename)
+
+
+class ResultLog:
+    """
+    Pending inference results, kept per user in an append-only JSON-lines log split into segments.
+    Each result gets the next per-user sequence number, so the pending results of a user always have
+    consecutive numbers. Clients read pages after a cursor (the last sequence number they have seen) and
+    acknowledge a cursor once the results are saved; only acknowledged results are removed.
+    The segment and byte offset of every pending line is kept in memory, so a page read only touches the lines of that page.
+
+    A user's log is a directory of segment files, each named after the sequence number it started at. Appends go to
+    the newest segment until it reaches segment_bytes. Segments whose results are all acknowledged are
+    deleted, and an older segment of which more than compact_ratio is acknowledged is compacted down to its
+    pending lines. With fsync an append returns once its line is on disk; appends that arrive while one fsync
+    runs are made durable together by the next one (group commit).
+    """
+
+    ACK_FILE = "ack.json"
+
+    def __init__(self, directory, legacy_json_file=None, segment_bytes=4 * 1024 * 1024, compact_ratio=0.5, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._users = {}
+        # Group commit: appends are numbered, and files written since the last fsync are synced by one appender for all
+        self._commit = threading.Condition()
+        self._written = 0
+        self._durable = 0
+        self._syncing = False
+        self._unsynced = set()
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            if filename.endswith(".jsonl"):
+                self._migrate_single_file_log(unquote(filename[:-len(".jsonl")]))
+        for filename in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, filename)):
+                self._load(unquote(filename))
+        if legacy_json_file:
+            self._migrate_from_json(legacy_json_file)
+
+    def _user_directory(self, user_id):
+        return os.path.join(self.directory, quote(user_id, safe=""))
+
+    def _segment_path(self, user_id, segment):
+        return os.path.join(self._user_directory(user_id), f"{segment:012d}.jsonl")
+
+    def _load(self, user_id):
+        """Build the offset index of a user's log; a line cut short by a crash is truncated away."""
+        state = {"acked": 0, "next_seq": 1, "seqs": [], "locations": [], "segments": {}, "compacting": False}
+        user_directory = self._user_directory(user_id)
+        try:
+            with open(os.path.join(user_directory, self.ACK_FILE)) as f:
+                state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        filenames = sorted(os.listdir(user_directory)) if os.path.isdir(user_directory) else []
+        for filename in filenames:
+            path = os.path.join(user_directory, filename)
+            if filename.endswith(".compact"):
+                os.remove(path)  # Left behind by an interrupted compaction
+            if not filename.endswith(".jsonl"):
+                continue
+            segment = int(filename[:-len(".jsonl")])
+            info = {"size": 0, "first_seq": None, "last_seq": None}
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        seq = json.loads(line)["seq"]
+                    except (ValueError, KeyError):
+                        break
+                    if seq > state["acked"]:
+                        state["seqs"].append(seq)
+                        state["locations"].append((segment, info["size"]))
+                    state["next_seq"] = max(state["next_seq"], seq + 1)
+                    info["first_seq"] = info["first_seq"] or seq
+                    info["last_seq"] = seq
+                    info["size"] += len(line)
+            if info["size"] < os.path.getsize(path):
+                logger.warning(f"Truncating damaged tail of {path} at byte {info['size']}")
+                os.truncate(path, info["size"])
+            if info["last_seq"] is None:
+                os.remove(path)
+            else:
+                state["segments"][segment] = info
+        self._users[user_id] = state
+        return state
+
+    def _save_ack_state(self, user_id, state):
+        ack_path = os.path.join(self._user_directory(user_id), self.ACK_FILE)
+        with open(f"{ack_path}.tmp", "w") as f:
+            json.dump({"acked": state["acked"], "next_seq": state["next_seq"]}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f"{ack_path}.tmp", ack_path)
+        if self.fsync:
+            self._fsync_path(self._user_directory(user_id))
+
+    @staticmethod
+    def _fsync_path(path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return  # A segment deleted once acknowledged
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, user_id, record):
+        """Append a result to the newest segment of user_id; returns its sequence number and its commit ticket."""
+        with self._lock:
+            state = self._users.get(user_id) or self._load(user_id)
+            seq = state["next_seq"]
+            line = (json.dumps(dict(record, seq=seq)) + "\n").encode("utf-8")
+            segments = state["segments"]
+            segment = next(reversed(segments), None)
+            if segment is None or segments[segment]["size"] >= self.segment_bytes:
+                segment = seq
+                segments[segment] = {"size": 0, "first_seq": seq, "last_seq": seq}
+                os.makedirs(self._user_directory(user_id), exist_ok=True)
+                # The new file's directory entry has to reach the disk as well
+                self._unsynced.update((self.directory, self._user_directory(user_id)))
+            path = self._segment_path(user_id, segment)
+            with open(path, "ab") as f:
+                f.write(line)
+            info = segments[segment]
+            state["seqs"].append(seq)
+            state["locations"].append((segment, info["size"]))
+            info["size"] += len(line)
+            info["last_seq"] = seq
+            state["next_seq"] = seq + 1
+            self._unsynced.add(path)
+            self._written += 1
+            return seq, self._written
+
+    def _wait_durable(self, ticket):
+        """
+        Return once the append with this ticket is on disk. If no fsync is running, this appender syncs every
+        file written so far, which commits the appends of the other waiting threads too.
+        """
+        with self._commit:
+            while self._durable < ticket and self._syncing:
+                self._commit.wait()
+            if self._durable >= ticket:
+                return
+            self._syncing = True
+        synced = False
+        try:
+            with self._lock:
+                written = self._written
+                paths, self._unsynced = self._unsynced, set()
+            try:
+                with STORE_SECONDS.labels("result_log", "fsync").time():
+                    for path in paths:
+                        self._fsync_path(path)
+                synced = True
+            except BaseException:
+                with self._lock:
+                    self._unsynced |= paths
+                raise
+        finally:
+            with self._commit:
+                self._syncing = False
+                if synced:
+                    self._durable = max(self._durable, written)
+                self._commit.notify_all()
+
+    @STORE_SECONDS.labels("result_log", "append").time()
+    def append(self, user_id, record):
+        """Append a result for user_id and return its sequence number."""
+        seq, ticket = self._write(user_id, record)
+        if self.fsync:
+            self._wait_durable(ticket)
+        return seq
+
+    @STORE_SECONDS.labels("result_log", "append").time()
+    def append_many(self, user_id, records):
+        """Append several results for user_id, made durable by a single commit, and return their sequence numbers."""
+        written = [self._write(user_id, record) for record in records]
+        if self.fsync and written:
+            self._wait_durable(written[-1][1])
+        return [seq for seq, _ in written]
+
+    @STORE_SECONDS.labels("result_log", "read").time()
+    def read(self, user_id, cursor=None, limit=50):
+        """Return up to limit pending results with a sequence number above cursor."""
+        with self._lock:
+            state = self._users.get(user_id)
+            acked = state["acked"] if state else 0
+            cursor = acked if cursor is None else max(cursor, acked)
+            results = []
+            if state and state["seqs"]:
+                start = bisect.bisect_right(state["seqs"], cursor)
+                # Pending lines are contiguous within a segment, so each segment of the page is read from its first offset on
+                for segment, locations in itertools.groupby(state["locations"][start:start + limit], key=lambda location: location[0]):
+                    locations = list(locations)
+                    with open(self._segment_path(user_id, segment), "rb") as f:
+                        f.seek(locations[0][1])
+                        results.extend(json.loads(f.readline()) for _ in locations)
+            last_seq = state["seqs"][-1] if state and state["seqs"] else cursor
+        next_cursor = results[-1]["seq"] if results else cursor
+        return {
+            "results": results,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+            "last_seq": last_seq,
+            "has_more": next_cursor < last_seq
+        }
+
+    @STORE_SECONDS.labels("result_log", "ack").time()
+    def ack(self, user_id, cursor):
+        """
+        Remove the results of user_id up to and including cursor and return how many were removed.
+        Segments left without pending results are deleted, and the oldest one is compacted once most of it is acknowledged.
+        """
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None:
+                return 0
+            cursor = min(cursor, state["next_seq"] - 1)
+            if cursor <= state["acked"]:
+                return 0
+            removed = bisect.bisect_right(state["seqs"], cursor)
+            del state["seqs"][:removed]
+            del state["locations"][:removed]
+            state["acked"] = cursor
+            # Persist the cursor first: after a crash, lines at or below it are skipped when the log is reloaded,
+            # and the sequence numbers of deleted segments are not handed out again
+            self._save_ack_state(user_id, state)
+            for segment, info in list(state["segments"].items()):
+                if info["last_seq"] > cursor:
+                    break
+                os.remove(self._segment_path(user_id, segment))
+                del state["segments"][segment]
+            segment = self._compaction_candidate(state)
+        if segment is not None:
+            self._compact(user_id, segment)
+        return removed
+
+    def trim(self, user_id, keep, slack=0):
+        """
+        Acknowledge all but the newest keep pending results of user_id once more than keep + slack are pending,
+        and return how many were removed. Bounds the log of a server whose clients never acknowledge; slack
+        lets the removals happen in batches instead of one acknowledgement per append.
+        """
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None or len(state["seqs"]) <= keep + slack:
+                return 0
+            cursor = state["seqs"][-keep - 1]
+        return self.ack(user_id, cursor)
+
+    def _compaction_candidate(self, state):
+        """
+        Return the oldest segment when it is no longer written to and more than compact_ratio of it is
+        acknowledged. Compacting copies at most the unacknowledged rest, so its cost is covered by the acknowledgements.
+        """
+        segments = state["segments"]
+        if len(segments) < 2 or state["compacting"]:
+            return None
+        segment = next(iter(segments))
+        info = segments[segment]
+        acked_lines = state["acked"] - info["first_seq"] + 1
+        if acked_lines <= (info["last_seq"] - info["first_seq"] + 1) * self.compact_ratio:
+            return None
+        state["compacting"] = True
+        return segment
+
+    @STORE_SECONDS.labels("result_log", "compact").time()
+    def _compact(self, user_id, segment):
+        """Replace an old segment with a copy of its pending lines; the copy is made without holding the lock."""
+        path = self._segment_path(user_id, segment)
+        with self._lock:
+            state = self._users[user_id]
+            start_seq = state["acked"] + 1
+            start = state["locations"][0][1] if state["locations"] and state["locations"][0][0] == segment else None
+        compact_path = None
+        try:
+            if start is None:
+                return
+            # Old segments are not appended to, so the tail can be copied while appends and reads go on
+            fd, compact_path = tempfile.mkstemp(suffix=".compact", dir=self._user_directory(user_id))
+            with os.fdopen(fd, "wb") as target:
+                with open(path, "rb") as source:
+                    source.seek(start)
+                    shutil.copyfileobj(source, target)
+                target.flush()
+                os.fsync(target.fileno())
+            with self._lock:
+                if segment not in state["segments"]:
+                    return  # Acknowledged in full meanwhile
+                os.replace(compact_path, path)
+                compact_path = None
+                # Lines acknowledged meanwhile stay in the copy and are skipped when the log is reloaded
+                info = state["segments"][segment]
+                info["size"] -= start
+                info["first_seq"] = start_seq
+                for index, (location_segment, offset) in enumerate(state["locations"]):
+                    if location_segment != segment:
+                        break
+                    state["locations"][index] = (segment, offset - start)
+        except FileNotFoundError:
+            pass  # The segment was deleted while it was copied
+        finally:
+            if compact_path is not None and os.path.exists(compact_path):
+                os.remove(compact_path)
+            with self._lock:
+                state["compacting"] = False
+
+    def users_with_pending_results(self):
+        with self._lock:
+            return [user_id for user_id, state in self._users.items() if state["seqs"]]
+
+    def _migrate_single_file_log(self, user_id):
+        """Move a log kept as one <user>.jsonl file with a <user>.ack cursor into a segmented user directory."""
+        base_path = os.path.join(self.directory, quote(user_id, safe=""))
+        os.makedirs(base_path, exist_ok=True)
+        if os.path.exists(f"{base_path}.ack"):
+            os.replace(f"{base_path}.ack", os.path.join(base_path, self.ACK_FILE))
+        # Segment 0 sorts before every segment started later
+        os.replace(f"{base_path}.jsonl", self._segment_path(user_id, 0))
+
+    def _migrate_from_json(self, legacy_json_file):
+        """Import the pending results of the legacy inference_results.json once, then rename it."""
+        if not os.path.exists(legacy_json_file):
+            return
+        inference_results = load_json_data(legacy_json_file)
+        count = 0
+        ticket = 0
+        for user_id, results in inference_results.items():
+            for result in results:
+                _, ticket = self._write(user_id, result)
+                count += 1
+        # One fsync for the whole import
+        if self.fsync and ticket:
+            self._wait_durable(ticket)
+        os.replace(legacy_json_file, f"{legacy_json_file}.migrated")
+        logger.info(f"Migrated {count} pending inference results from {legacy_json_file} to {self.directory}")
+
+
+class SqliteResultLog:
+    """
+    Pending inference results kept in the shared broker database, for servers that run as API and worker pods.
+    Offers the appends, pages and acknowledgements of ResultLog with the same per-user sequence numbers.
+    Every result also gets a row id that grows across users, which API pods follow to push to /events the
+    results that workers record.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        # AUTOINCREMENT keeps the ids of acknowledged rows from being reused, so followers never miss a result
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, seq INTEGER NOT NULL, record TEXT NOT NULL, "
+            "UNIQUE (user_id, seq))"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS result_cursors (user_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL, acked INTEGER NOT NULL)")
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    @STORE_SECONDS.labels("result_log", "append").time()
+    def append(self, user_id, record):
+        """Append a result for user_id and return its sequence number."""
+        return self.append_many(user_id, [record])[0]
+
+    @STORE_SECONDS.labels("result_log", "append").time()
+    def append_many(self, user_id, records):
+        """Append several results for user_id in one transaction and return their sequence numbers."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next_seq, acked FROM result_cursors WHERE user_id=?", (user_id,)).fetchone()
+            next_seq, acked = row if row is not None else (1, 0)
+            seqs = list(range(next_seq, next_seq + len(records)))
+            conn.executemany(
+                "INSERT INTO results (user_id, seq, record) VALUES (?, ?, ?)",
+                [(user_id, seq, json.dumps(dict(record, seq=seq))) for seq, record in zip(seqs, records)]
+            )
+            conn.execute("INSERT OR REPLACE INTO result_cursors VALUES (?, ?, ?)", (user_id, next_seq + len(records), acked))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return seqs
+
+    @STORE_SECONDS.labels("result_log", "read").time()
+    def read(self, user_id, cursor=None, limit=50):
+        """Return up to limit pending results with a sequence number above cursor."""
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT acked FROM result_cursors WHERE user_id=?", (user_id,)).fetchone()
+            acked = row[0] if row is not None else 0
+            cursor = acked if cursor is None else max(cursor, acked)
+            results = [
+                json.loads(record) for record, in conn.execute(
+                    "SELECT record FROM results WHERE user_id=? AND seq>? ORDER BY seq LIMIT ?", (user_id, cursor, limit)
+                )
+            ]
+            last_seq = conn.execute("SELECT MAX(seq) FROM results WHERE user_id=?", (user_id,)).fetchone()[0]
+        finally:
+            conn.execute("COMMIT")
+        last_seq = cursor if last_seq is None else last_seq
+        next_cursor = results[-1]["seq"] if results else cursor
+        return {
+            "results": results,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+            "last_seq": last_seq,
+            "has_more": next_cursor < last_seq
+        }
+
+    @STORE_SECONDS.labels("result_log", "ack").time()
+    def ack(self, user_id, cursor):
+        """Remove the results of user_id up to and including cursor and return how many were removed."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next_seq, acked FROM result_cursors WHERE user_id=?", (user_id,)).fetchone()
+            removed = 0
+            if row is not None:
+                cursor = min(cursor, row[0] - 1)
+                if cursor > row[1]:
+                    removed = conn.execute("DELETE FROM results WHERE user_id=? AND seq<=?", (user_id, cursor)).rowcount
+                    conn.execute("UPDATE result_cursors SET acked=? WHERE user_id=?", (cursor, user_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return removed
+
+    def trim(self, user_id, keep, slack=0):
+        """Acknowledge all but the newest keep pending results of user_id once more than keep + slack are pending, like ResultLog.trim."""
+        row = self._connection().execute("SELECT next_seq, acked FROM result_cursors WHERE user_id=?", (user_id,)).fetchone()
+        # Pending results have consecutive sequence numbers, so their count follows from the two cursors
+        if row is None or row[0] - 1 - row[1] <= keep + slack:
+            return 0
+        return self.ack(user_id, row[0] - 1 - keep)
+
+    def users_with_pending_results(self):
+        return [user_id for user_id, in self._connection().execute("SELECT DISTINCT user_id FROM results")]
+
+    def last_change_id(self):
+        """Return the row id of the newest result."""
+        return self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0]
+
+    def changes_since(self, change_id, limit=1000):
+        """Return (row id, user_id, record) of up to limit results recorded after change_id."""
+        return [
+            (row_id, user_id, json.loads(record)) for row_id, user_id, record in self._connection().execute(
+                "SELECT id, user_id, record FROM results WHERE id>? ORDER BY id LIMIT ?", (change_id, limit)
+            )
+        ]
+
+
+def claim_sqlite_job(conn, worker, lease_seconds, priorities=PRIORITY_CLASSES, reap=None):
+    """
+    Claim the oldest claimable job of the highest of priorities in a SQLite job broker's jobs table for worker and
+    return (job_id, task, priority), or None when there is none. A job is claimable once its task is set and it is
+    queued, or running under a lease that ran out. The claim is one write transaction, so each job goes to one
+    worker; reap(conn, now) is called in it first to delete the jobs no one waits for any more.
+    """
+    now = time.time()
+    ranks = [PRIORITY_CLASSES.index(priority) for priority in priorities]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if reap is not None:
+            reap(conn, now)
+        row = conn.execute(
+            "SELECT job_id, task, priority FROM jobs WHERE task IS NOT NULL AND "
+            f"(status='queued' OR (status='running' AND lease_until < ?)) AND priority IN ({', '.join('?' * len(ranks))}) "
+            "ORDER BY priority, created_at LIMIT 1",
+            (now, *ranks)
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status='running', worker=?, lease_until=?, updated_at=? WHERE job_id=?",
+                (worker, now + lease_seconds, now, row[0])
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return (row[0], json.loads(row[1]), PRIORITY_CLASSES[row[2]]) if row is not None else None
+
+
+class FairScheduler:
+    """
+    Executor for jobs that shares its workers fairly instead of in arrival order.
+    Jobs are queued per priority class, then per user, then per project. A free worker takes the next job
+    of the highest class that may run: users of a class take turns, and so do the projects of a user, skipping users
+    that already run max_running_per_user requests of that class. Bulk requests never use the last
+    reserved_interactive workers. Queue times are recorded per class, with the ones over the class's entry in
+    queue_slo_seconds counted as SLO misses.
+    """
+
+    def __init__(self, max_workers, reserved_interactive=1, max_running_per_user=2, queue_slo_seconds=None, name="scheduler"):
+        self.max_workers = max_workers
+        # At least one worker is left to bulk requests
+        self.bulk_workers = max(max_workers - reserved_interactive, 1)
+        self.max_running_per_user = max_running_per_user
+        self.queue_slo_seconds = dict(queue_slo_seconds or {})
+        self._condition = threading.Condition()
+        # priority -> user_id -> project_number -> deque of requests, in turn order
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self._queued = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        # (priority, user_id) -> running requests
+        self._running_per_user = {}
+        self._counts = {priority: {"started": 0, "slo_misses": 0} for priority in PRIORITY_CLASSES}
+        self._closed = False
+        self._name = name
+        # The worker threads start with the first request, like those of a ThreadPoolExecutor
+        self._threads = []
+
+    @staticmethod
+    def priority_of(priority, default, field="priority"):
+        """Return the priority class sent in the given form field, or default without one."""
+        priority = priority or default
+        if priority not in PRIORITY_CLASSES:
+            raise HTTPException(status_code=400, detail=f"Unknown {field} '{priority}', use one of: {', '.join(PRIORITY_CLASSES)}")
+        return priority
+
+    def submit(self, fn, *args, user_id=None, project_number=None, priority="interactive"):
+        """Queue fn(*args) for user_id and project_number in a priority class and return its Future."""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Scheduler is shut down")
+            if not self._threads:
+                self._threads = [threading.Thread(target=self._run, name=f"{self._name}-{index}", daemon=True) for index in range(self.max_workers)]
+                for thread in self._threads:
+                    thread.start()
+            projects = self._queues[priority].setdefault(user_id, OrderedDict())
+            projects.setdefault(project_number, deque()).append((fn, args, future, time.monotonic()))
+            self._queued[priority] += 1
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """Stop taking requests; the workers exit once the queued ones have run, or were cancelled with cancel_futures."""
+        with self._condition:
+            self._closed = True
+            if cancel_futures:
+                for priority, users in self._queues.items():
+                    for projects in users.values():
+                        for requests in projects.values():
+                            for _, _, future, _ in requests:
+                                future.cancel()
+                    users.clear()
+                    self._queued[priority] = 0
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _next_request(self):
+        """Take the next request that may run, or return None. Called with the condition held."""
+        for priority in PRIORITY_CLASSES:
+            if priority == "bulk" and self._running["bulk"] >= self.bulk_workers:
+                continue
+            users = self._queues[priority]
+            for user_id, projects in users.items():
+                if self._running_per_user.get((priority, user_id), 0) >= self.max_running_per_user:
+                    continue
+                project_number, requests = next(iter(projects.items()))
+                request = requests.popleft()
+                # Move the user and the project to the back of their turn order
+                if requests:
+                    projects.move_to_end(project_number)
+                else:
+                    del projects[project_number]
+                if projects:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                self._queued[priority] -= 1
+                return priority, user_id, request
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    scheduled = self._next_request()
+                    if scheduled is not None:
+                        break
+                    if self._closed and sum(self._queued.values()) == 0:
+                        return
+                    self._condition.wait()
+                priority, user_id, (fn, args, future, queued_at) = scheduled
+                self._running[priority] += 1
+                self._running_per_user[(priority, user_id)] = self._running_per_user.get((priority, user_id), 0) + 1
+                waited = time.monotonic() - queued_at
+                self._counts[priority]["started"] += 1
+                slo_missed = priority in self.queue_slo_seconds and waited > self.queue_slo_seconds[priority]
+                if slo_missed:
+                    self._counts[priority]["slo_misses"] += 1
+            SCHEDULER_QUEUE_SECONDS.labels(priority).observe(waited)
+            if slo_missed:
+                SCHEDULER_SLO_MISSES.labels(priority).inc()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running[priority] -= 1
+                    self._running_per_user[(priority, user_id)] -= 1
+                    if self._running_per_user[(priority, user_id)] == 0:
+                        del self._running_per_user[(priority, user_id)]
+                    # A finished request may unblock a capped user or the bulk class, which any worker can pick up
+                    self._condition.notify_all()
+
+    def stats(self):
+        """Return the queued and running requests of each priority class and the users waiting in it."""
+        with self._condition:
+            return {
+                "max_workers": self.max_workers,
+                "bulk_workers": self.bulk_workers,
+                "max_running_per_user": self.max_running_per_user,
+                "classes": {
+                    priority: {
+                        "queued": self._queued[priority],
+                        "running": self._running[priority],
+                        "waiting_users": len(self._queues[priority]),
+                        "queue_slo_seconds": self.queue_slo_seconds.get(priority),
+                        **self._counts[priority]
+                    }
+                    for priority in PRIORITY_CLASSES
+                }
+            }
+
+
+def onnx_model_path(model_path, quantization=None):
+    """Return where export_onnx.py writes the ONNX export of a .pt checkpoint."""
+    base_path = os.path.splitext(model_path)[0]
+    return f"{base_path}.int8.onnx" if quantization == "int8" else f"{base_path}.onnx"
+
+
+def configure_onnx_runtime(intra_op_threads, inter_op_threads):
+    """
+    Apply the thread settings to ONNX Runtime sessions created without session options.
+    The processor's model loader (ultralytics) creates the sessions without taking any options, and only on the
+    first prediction, so onnxruntime.InferenceSession is replaced by a subclass that fills them in for the rest
+    of the process. This is a global side effect: every session created later without options in this process
+    gets these settings, whoever creates it, and calling this again replaces them.
+    """
+    import onnxruntime
+
+    untuned_session = getattr(onnxruntime.InferenceSession, "untuned_session", onnxruntime.InferenceSession)
+
+    class TunedInferenceSession(untuned_session):
+        def __init__(self, path_or_bytes, sess_options=None, *args, **kwargs):
+            if sess_options is None:
+                sess_options = onnxruntime.SessionOptions()
+                sess_options.intra_op_num_threads = intra_op_threads
+                sess_options.inter_op_num_threads = inter_op_threads
+                # Inter-op threads are only used when independent graph nodes may run in parallel
+                sess_options.execution_mode = (onnxruntime.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1
+                                               else onnxruntime.ExecutionMode.ORT_SEQUENTIAL)
+                sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            super().__init__(path_or_bytes, sess_options, *args, **kwargs)
+
+    TunedInferenceSession.untuned_session = untuned_session
+    onnxruntime.InferenceSession = TunedInferenceSession
+
+
+def resolve_processor_config(config, default_intra_op_threads=0):
+    """
+    Return the configuration the FloorPlanProcessor is built with. For the onnx backend the model paths
+    point at the ONNX exports, which ultralytics runs with ONNX Runtime, and the thread settings are applied
+    with configure_onnx_runtime; default_intra_op_threads is used when config leaves onnx_intra_op_threads at 0.
+    """
+    backend = config.get('inference_backend', 'torch')
+    if backend == 'torch':
+        return config
+    if backend != 'onnx':
+        raise ValueError(f"Unknown inference backend: {backend}")
+    quantization = config.get('onnx_quantization')
+    resolved = dict(config)
+    for name, value in config.items():
+        if name.endswith('_model_path'):
+            resolved[name] = onnx_model_path(value, quantization)
+        elif name.endswith('_model_paths'):
+            resolved[name] = [onnx_model_path(path, quantization) for path in value]
+    missing = [path for name, value in resolved.items() if name.endswith(('_model_path', '_model_paths'))
+               for path in (value if isinstance(value, list) else [value]) if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"ONNX models not found: {', '.join(missing)}; export them with export_onnx.py")
+    intra_op_threads = config.get('onnx_intra_op_threads', 0) or default_intra_op_threads
+    configure_onnx_runtime(intra_op_threads, config.get('onnx_inter_op_threads', 1))
+    return resolved
+
+
+class MicroBatcher:
+    """
+    Collect items submitted from concurrent requests and hand them to a handler in batches.
+    A batch is closed when it holds max_batch_size items, or once its oldest item has waited max_wait_ms
+    and no more items are queued. Queued items of a higher priority class go into the next batch first, and a batch
+    only holds items of one class, so the items of a lower one do not hold back its results.
+    The handler receives the list of items and returns one result per item; a result that is an
+    exception is raised to the caller that submitted that item.
+    """
+
+    def __init__(self, handler, max_batch_size=8, max_wait_ms=20, name="micro-batcher"):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # Entries are (priority rank, sequence number, entry) so items of a class keep their order
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "items": 0,
+            "batch_size_counts": {},
+            "queue_wait_ms_total": 0.0,
+            "queue_wait_ms_max": 0.0
+        }
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, priority="interactive"):
+        """Queue an item in a priority class and return a Future that resolves once its batch has run."""
+        future = Future()
+        self._queue.put((PRIORITY_CLASSES.index(priority), next(self._sequence), (item, future, time.monotonic())))
+        return future
+
+    def close(self):
+        """Run whatever is still queued, then stop the batching thread."""
+        self._queue.put((len(PRIORITY_CLASSES), next(self._sequence), None))
+        self._thread.join()
+
+    def stats(self):
+        """Return batch size and queue wait statistics."""
+        with self._stats_lock:
+            stats = dict(self._stats, batch_size_counts=dict(self._stats["batch_size_counts"]))
+        stats["avg_batch_size"] = stats["items"] / stats["batches"] if stats["batches"] else 0.0
+        stats["avg_queue_wait_ms"] = stats["queue_wait_ms_total"] / stats["items"] if stats["items"] else 0.0
+        return stats
+
+    def _collect(self):
+        """Block for the first item, then gather more until the batch is full or the window closes."""
+        first = self._queue.get()
+        if first[2] is None:
+            return None
+        batch = [first[2]]
+        deadline = first[2][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # Items that queued up while the previous batch ran join this one even once its window has closed
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry[2] is None or entry[0] != first[0]:
+                self._queue.put(entry)  # Stop, or start the next batch with the other class, once this batch has run
+                break
+            batch.append(entry[2])
+        return batch
+
+    def _record(self, batch_size, waits_ms):
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["items"] += batch_size
+            counts = self._stats["batch_size_counts"]
+            counts[batch_size] = counts.get(batch_size, 0) + 1
+            self._stats["queue_wait_ms_total"] += sum(waits_ms)
+            self._stats["queue_wait_ms_max"] = max([self._stats["queue_wait_ms_max"]] + waits_ms)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            started = time.monotonic()
+            self._record(len(batch), [(started - submitted) * 1000 for _, _, submitted in batch])
+            try:
+                results = self.handler([item for item, _, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+def run_image_batch(processor, items, executor):
+    """
+    MicroBatcher handler for a processor that provides process_batch(items): run every model stage over the
+    whole batch at once. A single item, or a batch whose call fails, is run with process_image, one item per
+    executor thread, so the images still run concurrently.
+    """
+    if len(items) > 1:
+        try:
+            processor.process_batch(items)
+            return [None] * len(items)
+        except Exception as e:
+            logger.warning(f"Batch of {len(items)} images failed, retrying one by one: {e}")
+    futures = [executor.submit(processor.process_image, *item) for item in items]
+    return [future.exception() for future in futures]
+
+
+class StagedPipeline:
+    """
+    Run items through a sequence of stages, each with its own worker threads and bounded input queue,
+    so different items occupy different stages at the same time. A stage may hold several steps that
+    run in parallel on the same item, e.g. segmentation, detection and OOB on the cropped plan.
+    Stages are given as (stage_name, [(step_name, fn), ...]) and every step is called as fn(item).
+    """
+
+    def __init__(self, stages, workers_per_stage=1, queue_size=16):
+        self.stages = stages
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._parallel = [
+            ThreadPoolExecutor(max_workers=workers_per_stage * len(steps), thread_name_prefix=f"pipeline-{stage_name}")
+            for stage_name, steps in stages
+        ]
+        self._stats_lock = threading.Lock()
+        self._step_stats = {
+            step_name: {"count": 0, "errors": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+            for _, steps in stages for step_name, _ in steps
+        }
+        self._workers_per_stage = workers_per_stage
+        self._threads = []
+        for index, (stage_name, _) in enumerate(stages):
+            for worker in range(workers_per_stage):
+                thread = threading.Thread(target=self._run_stage, args=(index,), name=f"pipeline-{stage_name}-{worker}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item):
+        """
+        Queue an item at the first stage and return a Future that resolves after the last stage.
+        Blocks while the first stage's queue is full.
+        """
+        future = Future()
+        self._queues[0].put((item, future))
+        return future
+
+    def close(self):
+        """Let the queued items drain through every stage, then stop the stage workers."""
+        for index, stage_queue in enumerate(self._queues):
+            for _ in range(self._workers_per_stage):
+                stage_queue.put(None)
+            for thread in self._threads[index * self._workers_per_stage:(index + 1) * self._workers_per_stage]:
+                thread.join()
+            self._parallel[index].shutdown(wait=True)
+
+    def stats(self):
+        """Return per-step latency and per-stage queue depth."""
+        with self._stats_lock:
+            steps = {name: dict(values) for name, values in self._step_stats.items()}
+        for values in steps.values():
+            values["avg_latency_ms"] = values["latency_ms_total"] / values["count"] if values["count"] else 0.0
+        queue_depth = {stage_name: stage_queue.qsize() for (stage_name, _), stage_queue in zip(self.stages, self._queues)}
+        return {"steps": steps, "queue_depth": queue_depth}
+
+    def _run_step(self, step_name, fn, item):
+        started = time.monotonic()
+        try:
+            return fn(item)
+        except Exception:
+            with self._stats_lock:
+                self._step_stats[step_name]["errors"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self._stats_lock:
+                values = self._step_stats[step_name]
+                values["count"] += 1
+                values["latency_ms_total"] += elapsed_ms
+                values["latency_ms_max"] = max(values["latency_ms_max"], elapsed_ms)
+
+    def _run_stage(self, index):
+        _, steps = self.stages[index]
+        stage_queue = self._queues[index]
+        while True:
+            entry = stage_queue.get()
+            if entry is None:
+                return
+            item, future = entry
+            try:
+                if len(steps) == 1:
+                    self._run_step(steps[0][0], steps[0][1], item)
+                else:
+                    for step_future in [self._parallel[index].submit(self._run_step, step_name, fn, item) for step_name, fn in steps]:
+                        step_future.result()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if index + 1 < len(self._queues):
+                self._queues[index + 1].put((item, future))
+            else:
+                future.set_result(None)
+
+
+# Files each stage method writes for an image <stem>.<ext>, relative to the crop_image_dir and save_json_dir of its item
+STAGE_OUTPUTS = {
+    "crop": ("crop_image_dir", "{stem}.png"),
+    "segmentation": ("save_json_dir", os.path.join("segment", "{stem}_segment.json")),
+    "detection": ("save_json_dir", os.path.join("detect", "{stem}_detection.json")),
+    "oob": ("save_json_dir", os.path.join("oob", "{stem}_oob.json")),
+}
+
+
+def check_stage_methods(processor, stage_methods, image_path=None):
+    """
+    Check that the processor can run an image stage by stage, as the staged pipeline and tiled inference do, and
+    return the problems found (none when it can). stage_methods maps the crop, segmentation, detection and oob
+    stages to processor methods, each called like process_image(image_name, crop_image_dir, save_json_dir,
+    save_image_dir), run in this order on the same item, and expected to write the files of STAGE_OUTPUTS that
+    process_image writes; the later stages read the cropped plan written by the crop.
+    Every stage runs once on image_path, or on a blank page when it is None, in a throwaway folder.
+    """
+    missing = [name for name in stage_methods.values() if not callable(getattr(processor, name, None))]
+    if missing:
+        return [f"no {name} method" for name in missing]
+    folder = tempfile.mkdtemp(prefix="stage_check_")
+    try:
+        original_img_directory = os.path.join(folder, "original_img")
+        directories = {name: os.path.join(folder, name) for name in ("crop_image_dir", "save_json_dir", "save_image_dir")}
+        for directory in (original_img_directory, *directories.values()):
+            os.makedirs(directory)
+        image_name = "stage_check.png"
+        if image_path:
+            shutil.copy(image_path, os.path.join(original_img_directory, image_name))
+        else:
+            import cv2
+            import numpy as np
+            cv2.imwrite(os.path.join(original_img_directory, image_name), np.full((1024, 1024, 3), 255, dtype=np.uint8))
+        item = (image_name, directories["crop_image_dir"], directories["save_json_dir"], directories["save_image_dir"])
+        problems = []
+        for stage in ("crop", "segmentation", "detection", "oob"):
+            try:
+                getattr(processor, stage_methods[stage])(*item)
+            except Exception as e:
+                problems.append(f"{stage_methods[stage]} failed: {e}")
+                break
+            directory, pattern = STAGE_OUTPUTS[stage]
+            output = os.path.join(directories[directory], pattern.format(stem="stage_check"))
+            if not os.path.isfile(output):
+                problems.append(f"{stage_methods[stage]} did not write {os.path.relpath(output, folder)}")
+        return problems
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class ResultCache:
+    """
+    On-disk cache of inference outputs keyed by the SHA-256 of the uploaded image and of the model files,
+    so the same floor plan is processed once no matter its file name or who uploaded it.
+    Output file names are stored with the image's base name replaced by NAME_TOKEN and renamed on restore.
+    Entries are evicted least recently used first once the cache holds more than max_bytes.
+    """
+
+    NAME_TOKEN = "%IMAGE%"
+
+    def __init__(self, directory, max_bytes, model_fingerprint):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.model_fingerprint = model_fingerprint
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread, reopening it after a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.directory, "index.db"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def hash_file(path):
+        """Return the SHA-256 of a file, read in chunks."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def fingerprint_models(config):
+        """Hash the model files and class lists of a processor config into a single model version."""
+        digest = hashlib.sha256()
+        for name in sorted(config):
+            value = config[name]
+            if name.endswith("_model_path"):
+                value = ResultCache.hash_file(value) if os.path.exists(value) else "missing"
+            elif name.endswith("_model_paths"):
+                value = [ResultCache.hash_file(path) if os.path.exists(path) else "missing" for path in value]
+            digest.update(json.dumps([name, value]).encode())
+        return digest.hexdigest()
+
+    def key_for(self, image_path):
+        """Return the cache key of an image for the current models."""
+        return hashlib.sha256(f"{self.model_fingerprint}:{self.hash_file(image_path)}".encode()).hexdigest()
+
+    def _entry_directory(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def stats(self):
+        """Return hit/miss counters and the current size of the cache."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = stats["hits"] + stats["misses"]
+        stats.update(entries=entries, size_bytes=size, max_bytes=self.max_bytes, hit_ratio=stats["hits"] / lookups if lookups else 0.0)
+        return stats
+
+    def restore(self, key, image_name, image_folder):
+        """Copy the cached outputs for key into image_folder under image_name. Returns False on a miss."""
+        entry_directory = self._entry_directory(key)
+        image_stem = os.path.splitext(image_name)[0]
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM entries WHERE key=?", (key,)).fetchone() is None or not os.path.isdir(entry_directory):
+            self._count("misses")
+            return False
+        try:
+            for root, _, files in os.walk(entry_directory):
+                for name in files:
+                    source = os.path.join(root, name)
+                    relative_path = os.path.relpath(source, entry_directory).replace(self.NAME_TOKEN, image_stem)
+                    destination = os.path.join(image_folder, relative_path)
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    # A copy, not a hard link: the processor overwrites its outputs in place when the image
+                    # name is processed again, which would otherwise change the cached entry as well
+                    shutil.copy2(source, destination)
+        except OSError as e:
+            # The entry was evicted while it was being restored
+            logger.warning(f"Could not restore cached results {key}: {e}")
+            self._count("misses")
+            return False
+        conn.execute("UPDATE entries SET last_used=? WHERE key=?", (time.time(), key))
+        self._count("hits")
+        return True
+
+    def store(self, key, image_name, image_folder, output_dirs):
+        """Copy the outputs written for image_name under output_dirs into the cache and evict old entries."""
+        entry_directory = self._entry_directory(key)
+        image_stem = os.path.splitext(image_name)[0]
+        staging_directory = f"{entry_directory}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        for output_dir in output_dirs:
+            for root, _, files in os.walk(output_dir):
+                for name in files:
+                    if not (name.startswith(image_stem + "_") or name.startswith(image_stem + ".")):
+                        continue
+                    source = os.path.join(root, name)
+                    relative_path = os.path.relpath(source, image_folder)
+                    relative_path = os.path.join(os.path.dirname(relative_path), name.replace(image_stem, self.NAME_TOKEN, 1))
+                    destination = os.path.join(staging_directory, relative_path)
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    shutil.copy2(source, destination)
+                    size += os.path.getsize(destination)
+        if size == 0:
+            return
+        try:
+            os.replace(staging_directory, entry_directory)
+        except OSError:
+            # Another request stored the same content first
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            return
+        self._connection().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time()))
+        self._count("stores")
+        self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM entries WHERE key=?", (key,))
+                shutil.rmtree(self._entry_directory(key), ignore_errors=True)
+                total -= size
+                self._count("evictions")
+
+
+class ArtifactRetention:
+    """
+    Keeps the upload tree under base_directory within the retention limits.
+    Every request folder (<user>/<project>/floor_<n>/<image>) is recorded with its owner and size in a SQLite index
+    when its request finishes, so sweeps pick what to delete with indexed queries instead of walking the tree.
+    Result ZIPs that older versions of the server saved next to the tree are indexed and swept as well.
+    A background thread sweeps every sweep_interval_seconds: folders unused for max_age_seconds go first, then the
+    oldest folders of each user above max_user_bytes, then the oldest folders overall while the tree holds more than
+    max_total_bytes (None disables a limit). Folders used in the last min_age_seconds are always kept, so requests
+    in flight never lose their files.
+    """
+
+    def __init__(self, base_directory, db_path, on_delete=None, max_age_seconds=30 * 24 * 60 * 60, max_user_bytes=None,
+                 max_total_bytes=None, min_age_seconds=60 * 60, sweep_interval_seconds=10 * 60):
+        self.base_directory = base_directory
+        self.db_path = db_path
+        # Called with the (user_id, project_number, floor_number, image_name) entries of every deleted folder
+        self.on_delete = on_delete
+        self.max_age_seconds = max_age_seconds
+        self.max_user_bytes = max_user_bytes
+        self.max_total_bytes = max_total_bytes
+        self.min_age_seconds = min_age_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"sweeps": 0, "deleted": 0, "deleted_bytes": 0, "last_sweep": None}
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, user_id TEXT NOT NULL, project_number TEXT NOT NULL, "
+            "floor TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used)")
+        conn.execute("CREATE INDEX IF NOT EXISTS artifacts_user ON artifacts (user_id, last_used)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _connection(self):
+        """Return the SQLite connection owned by the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention-sweeper", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @staticmethod
+    def _size_of(path):
+        """Return the bytes used by the files of a folder (only the folder itself is walked)."""
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    @STORE_SECONDS.labels("artifacts", "write").time()
+    def record(self, path, user_id, project_number, floor_number):
+        """Record a request folder with its current size, or refresh it when it is already indexed."""
+        if not os.path.isdir(path):
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+            (os.path.relpath(path, self.base_directory), user_id, project_number, normalize_floor(floor_number), self._size_of(path), time.time())
+        )
+
+    @STORE_SECONDS.labels("artifacts", "write").time()
+    def touch(self, path):
+        """Mark an indexed folder as used now, so it is kept while a new upload to it is processed."""
+        self._connection().execute("UPDATE artifacts SET last_used=? WHERE path=?", (time.time(), os.path.relpath(path, self.base_directory)))
+
+    def stats(self):
+        """Return the size of the indexed tree and what the sweeps of this process deleted."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        folders, size, users = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(DISTINCT user_id) FROM artifacts"
+        ).fetchone()
+        stats.update(folders=folders, size_bytes=size, users=users)
+        return stats
+
+    def _run(self):
+        try:
+            self._index_existing_folders()
+        except Exception as e:
+            logger.error(f"Indexing the existing upload tree failed: {e}")
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Retention sweep failed: {e}")
+            self._stop.wait(self.sweep_interval_seconds)
+
+    def _index_existing_folders(self):
+        """
+        Index the request folders written before the index existed, dated by their modification time.
+        This runs once; it is the only walk over the whole tree.
+        """
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM meta WHERE name='indexed_existing'").fetchone() is not None:
+            return
+        rows = []
+        for user in self._subdirectories(self.base_directory):
+            for project in self._subdirectories(user.path):
+                for floor in self._subdirectories(project.path):
+                    for folder in self._subdirectories(floor.path):
+                        rows.append((os.path.relpath(folder.path, self.base_directory), user.name, project.name,
+                                     normalize_floor(floor.name), self._size_of(folder.path), folder.stat().st_mtime))
+        # Per-request ZIPs of older versions, which have no owner
+        try:
+            with os.scandir(self.base_directory) as entries:
+                rows.extend((entry.name, "", "", "", entry.stat().st_size, entry.stat().st_mtime)
+                            for entry in entries if entry.is_file() and entry.name.endswith(".zip"))
+        except FileNotFoundError:
+            pass  # No upload has been saved yet
+        # Folders recorded by requests in the meantime are kept as they are
+        conn.executemany("INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('indexed_existing', ?)", (str(time.time()),))
+        logger.info(f"Indexed {len(rows)} existing request folders and ZIPs under {self.base_directory}")
+
+    @staticmethod
+    def _subdirectories(path):
+        try:
+            with os.scandir(path) as entries:
+                return [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return []
+
+    @STORE_SECONDS.labels("artifacts", "sweep").time()
+    def sweep(self):
+        """Delete what the retention limits no longer allow and return the number of folders deleted."""
+        conn = self._connection()
+        now = time.time()
+        protected_since = now - self.min_age_seconds
+        deleted = 0
+        if self.max_age_seconds is not None:
+            cutoff = min(now - self.max_age_seconds, protected_since)
+            rows = conn.execute("SELECT path, user_id, project_number, floor, size FROM artifacts WHERE last_used < ? ORDER BY last_used", (cutoff,)).fetchall()
+            deleted += sum(self._delete(row, cutoff) for row in rows)
+        if self.max_user_bytes is not None:
+            over_limit = conn.execute(
+                "SELECT user_id, SUM(size) FROM artifacts GROUP BY user_id HAVING SUM(size) > ?", (self.max_user_bytes,)
+            ).fetchall()
+            for user_id, total in over_limit:
+                rows = conn.execute(
+                    "SELECT path, user_id, project_number, floor, size FROM artifacts WHERE user_id=? AND last_used < ? ORDER BY last_used",
+                    (user_id, protected_since)
+                )
+                deleted += self._delete_until(rows, total, self.max_user_bytes, protected_since)
+        if self.max_total_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+            if total > self.max_total_bytes:
+                rows = conn.execute(
+                    "SELECT path, user_id, project_number, floor, size FROM artifacts WHERE last_used < ? ORDER BY last_used",
+                    (protected_since,)
+                )
+                deleted += self._delete_until(rows, total, self.max_total_bytes, protected_since)
+        with self._stats_lock:
+            self._stats["sweeps"] += 1
+            self._stats["last_sweep"] = now
+        if deleted:
+            logger.info(f"Retention sweep deleted {deleted} request folders")
+        return deleted
+
+    def _delete_until(self, rows, total, limit, used_before):
+        """Delete folders from rows, oldest first, until total is within limit."""
+        deleted = 0
+        for row in rows.fetchall():
+            if total <= limit:
+                break
+            if self._delete(row, used_before):
+                total -= row[4]
+                deleted += 1
+        return deleted
+
+    def _delete(self, row, used_before):
+        """Delete one indexed folder (or ZIP) unless it was used again after used_before. Returns True when it was deleted."""
+        path, user_id, project_number, floor, size = row
+        # Removing the row first, and only if it is still old, keeps a folder that a request just reused
+        # and lets only one sweeper delete the files when several server processes sweep
+        if self._connection().execute("DELETE FROM artifacts WHERE path=? AND last_used < ?", (path, used_before)).rowcount != 1:
+            return False
+        folder = os.path.join(self.base_directory, path)
+        try:
+            image_names = os.listdir(os.path.join(folder, "original_img"))
+        except (FileNotFoundError, NotADirectoryError):
+            image_names = []
+        if os.path.isdir(folder):
+            shutil.rmtree(folder, ignore_errors=True)
+        elif os.path.exists(folder):
+            os.remove(folder)
+        if self.on_delete is not None and image_names:
+            self.on_delete([(user_id, project_number, floor, image_name) for image_name in image_names])
+        RETENTION_DELETED_BYTES.inc(size)
+        with self._stats_lock:
+            self._stats["deleted"] += 1
+            self._stats["deleted_bytes"] += size
+        return True
+
+
+class TiledInference:
+    """
+    Runs segmentation and detection on large floor plans tile by tile, so the models only ever see one
+    tile_size tile instead of the whole scan. The plan is cropped as usual, cut into tiles that overlap by
+    overlap pixels, and the tiles run in parallel on worker threads, or on the worker processes in
+    process mode, which cut their tiles from the decoded plan in shared memory. Each tile owns the core of its
+    area, up to the middle of the overlap with its neighbours: detections from all tiles are merged with a
+    cross-tile NMS, and segment polygons are cut to their tile's core and stitched back together across seams.
+    When the segmentation or detection stage renders a result image of each tile, the tile cores are stitched
+    into the result image of the plan, images/<image_name>. Otherwise that image is whatever OOB on the full plan
+    renders, and the result manifest lists it as missing when OOB renders none.
+
+    Tile JSON files are read with the field names of schema, completed by OUTPUT_SCHEMA and overridden by the
+    OUTPUT_SCHEMA dict of the processor when it declares one: the segment and detection objects are listed under
+    the "segments" and "detections" keys (None for a JSON that is a bare list), and each object has a "class"
+    and either a "box" [x1, y1, x2, y2] and a "score" (detections) or a list of [x, y] "points" (segments).
+    Other fields of each object are carried over. A tile JSON without these fields raises ValueError instead of
+    being merged wrongly. stage_methods maps the crop, segmentation, detection and oob stages to the processor
+    methods running them.
+    """
+
+    # The "class" and "score" fields may be None when the processor writes none; the "width" and "height" image
+    # size fields, set to the size of the whole plan in the merged files, are only replaced when present
+    OUTPUT_SCHEMA = {
+        "segments": "segments", "detections": "detections", "class": "class_name", "box": "bbox", "score": "score",
+        "points": "points", "width": "width", "height": "height"
+    }
+    # Boxes this close to an inner tile edge were cut by the tile and lose against complete ones in the NMS
+    EDGE_MARGIN = 2
+    # Processor of the current worker process, running the stages and tiles sent to it in process mode
+    worker_processor = None
+
+    def __init__(self, processor, stage_methods, tile_size=1536, overlap=256, min_image_size=4096, workers=2,
+                 nms_iou=0.5, nms_containment=0.8, process_pool=None, schema=None):
+        if not 0 <= overlap < tile_size:
+            raise ValueError("The tile overlap must be smaller than the tile size")
+        self.processor = processor
+        self.schema = {**self.OUTPUT_SCHEMA, **(schema or {}), **(getattr(processor, "OUTPUT_SCHEMA", None) or {})}
+        self.stage_methods = dict(stage_methods)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.min_image_size = min_image_size
+        self.nms_iou = nms_iou
+        self.nms_containment = nms_containment
+        self.process_pool = process_pool
+        self.executor = process_pool or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile")
+
+    def settings(self):
+        """Return the tiling settings that change inference results, for the result cache fingerprint."""
+        return {"tile_size": self.tile_size, "overlap": self.overlap, "min_image_size": self.min_image_size,
+                "nms_iou": self.nms_iou, "nms_containment": self.nms_containment}
+
+    def close(self):
+        # The process pool belongs to the server and is shut down with it
+        if self.process_pool is None:
+            self.executor.shutdown(wait=True)
+
+    def _submit_stage(self, stage, item):
+        """Run one processor stage on an item in the tile threads or a worker process and return its Future."""
+        if self.process_pool is not None:
+            return self.process_pool.submit(TiledInference._run_stage_in_worker, self.stage_methods[stage], item)
+        return self.executor.submit(getattr(self.processor, self.stage_methods[stage]), *item)
+
+    @staticmethod
+    def _run_stage_in_worker(method_name, item):
+        getattr(TiledInference.worker_processor, method_name)(*item)
+
+    def wants(self, item):
+        """Tell whether an image is large enough to tile, from the header of its original (the crop only shrinks it)."""
+        # Pillow ships with ultralytics and reads the size without decoding the image
+        from PIL import Image
+
+        image_name, crop_image_dir = item[0], item[1]
+        original_path = os.path.join(os.path.dirname(crop_image_dir), "original_img", image_name)
+        try:
+            with Image.open(original_path) as image:
+                return max(image.size) >= self.min_image_size
+        except OSError:
+            return False
+
+    def submit(self, item):
+        """Process an item in the calling thread and return a completed Future, like the other inference paths."""
+        future = Future()
+        try:
+            future.set_result(self.process(item))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def process(self, item):
+        """
+        Crop the plan, run segmentation and detection per tile, write the merged JSON files and the stitched result
+        image, and run OOB on the full plan.
+        """
+        import cv2
+        import numpy as np
+
+        image_name, crop_image_dir, save_json_dir, save_image_dir = item
+        image_base_name = os.path.splitext(image_name)[0]
+        self._submit_stage("crop", item).result()
+        # OOB only needs the cropped plan, so it runs alongside the tiles
+        oob = self._submit_stage("oob", item)
+        image = cv2.imread(os.path.join(crop_image_dir, f"{image_base_name}.png"), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            oob.result()
+            raise ValueError(f"Could not read the cropped plan of {image_name}")
+        height, width = image.shape[:2]
+        if max(height, width) < self.min_image_size:
+            # The crop removed enough margin to fit the models without tiling
+            del image
+            for future in [self._submit_stage(stage, item) for stage in ("segmentation", "detection")] + [oob]:
+                future.result()
+            return
+
+        tiles = [
+            {"name": f"{image_base_name}_tile_{row}_{col}.png", "x": x, "y": y, "w": w, "h": h,
+             "core": (core_x0, core_y0, core_x1, core_y1)}
+            for row, (y, h, core_y0, core_y1) in enumerate(self._axis(height))
+            for col, (x, w, core_x0, core_x1) in enumerate(self._axis(width))
+        ]
+        tile_folder = tempfile.mkdtemp(prefix=f"tiles_{image_base_name}_", dir=os.path.dirname(crop_image_dir))
+        shared_image = None
+        try:
+            tile_dirs = tuple(os.path.join(tile_folder, name) for name in ("cropped", "json", "images"))
+            for directory in tile_dirs:
+                os.makedirs(directory, exist_ok=True)
+            if self.process_pool is None:
+                futures = [
+                    self.executor.submit(self._cut_and_run_tile, self.processor, image, tile, tile_dirs, self.stage_methods)
+                    for tile in tiles
+                ]
+            else:
+                # The workers read their tiles from one shared copy of the decoded plan instead of pickled pixels
+                shared_image = shared_memory.SharedMemory(create=True, size=image.nbytes)
+                np.ndarray(image.shape, dtype=image.dtype, buffer=shared_image.buf)[:] = image
+                image_ref = (shared_image.name, image.shape, image.dtype.str)
+                futures = [
+                    self.process_pool.submit(TiledInference._run_tile_in_worker, image_ref, tile, tile_dirs, self.stage_methods)
+                    for tile in tiles
+                ]
+            del image
+            results = [future.result() for future in futures]
+            oob.result()
+            # Written after OOB, which renders on the full plan, so the tile renders of the models are not lost
+            stitched = self._stitch_result_image(tiles, tile_dirs[2], width, height, os.path.join(save_image_dir, image_name))
+        finally:
+            if shared_image is not None:
+                shared_image.close()
+                shared_image.unlink()
+            shutil.rmtree(tile_folder, ignore_errors=True)
+        TILES_PROCESSED.inc(len(tiles))
+
+        segments = self._stitch_segments([(tile, segment_data) for tile, segment_data, _ in results])
+        detections = self._merge_detections([(tile, detection_data) for tile, _, detection_data in results], width, height)
+        self._write_json(os.path.join(save_json_dir, 'segment', f"{image_base_name}_segment.json"), results[0][1], "segments", segments, width, height)
+        self._write_json(os.path.join(save_json_dir, 'detect', f"{image_base_name}_detection.json"), results[0][2], "detections", detections, width, height)
+        if not stitched:
+            logger.info(f"The tiles of {image_name} rendered no result image; keeping the one OOB rendered, if any")
+        logger.info(f"Processed {image_name} ({width}x{height}) as {len(tiles)} tiles")
+
+    def _axis(self, length):
+        """Return (start, size, core_start, core_end) of each tile along one side of the plan."""
+        if length <= self.tile_size:
+            return [(0, length, 0, length)]
+        step = self.tile_size - self.overlap
+        starts = list(range(0, length - self.tile_size, step)) + [length - self.tile_size]
+        # Neighbouring cores meet in the middle of the overlap between the two tiles
+        bounds = [0] + [(start + self.tile_size + next_start) // 2 for start, next_start in zip(starts, starts[1:])] + [length]
+        return [(start, self.tile_size, bounds[i], bounds[i + 1]) for i, start in enumerate(starts)]
+
+    @staticmethod
+    def _stitch_result_image(tiles, tile_image_dir, width, height, path):
+        """
+        Paste the core of the result image each tile rendered, images/<tile name> in its tile folder, into a
+        result image of the whole plan at path. Returns False, writing nothing, unless every tile rendered one.
+        """
+        import cv2
+        import numpy as np
+
+        canvas = None
+        for tile in tiles:
+            tile_path = os.path.join(tile_image_dir, tile["name"])
+            rendered = cv2.imread(tile_path, cv2.IMREAD_COLOR) if os.path.isfile(tile_path) else None
+            if rendered is None or rendered.shape[:2] != (tile["h"], tile["w"]):
+                return False
+            if canvas is None:
+                canvas = np.zeros((height, width, 3), dtype=rendered.dtype)
+            core_x0, core_y0, core_x1, core_y1 = tile["core"]
+            canvas[core_y0:core_y1, core_x0:core_x1] = rendered[
+                core_y0 - tile["y"]:core_y1 - tile["y"], core_x0 - tile["x"]:core_x1 - tile["x"]
+            ]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not cv2.imwrite(path, canvas):
+            raise ValueError(f"Could not write the stitched result image {path}")
+        return True
+
+    @staticmethod
+    def _write_tile(image, tile, tile_crop_dir):
+        """Write one tile of the decoded plan where the processor reads its cropped image."""
+        import cv2
+
+        cv2.imwrite(os.path.join(tile_crop_dir, tile["name"]), image[tile["y"]:tile["y"] + tile["h"], tile["x"]:tile["x"] + tile["w"]])
+
+    @staticmethod
+    def _cut_and_run_tile(processor, image, tile, tile_dirs, stage_methods):
+        TiledInference._write_tile(image, tile, tile_dirs[0])
+        return TiledInference._run_tile(processor, tile, tile_dirs, stage_methods)
+
+    @staticmethod
+    def _run_tile_in_worker(image_ref, tile, tile_dirs, stage_methods):
+        """Cut a tile from the plan in shared memory and run it on the models of this worker process."""
+        import numpy as np
+
+        name, shape, dtype = image_ref
+        shared_image = shared_memory.SharedMemory(name=name)
+        image = None
+        try:
+            image = np.ndarray(shape, dtype=dtype, buffer=shared_image.buf)
+            TiledInference._write_tile(image, tile, tile_dirs[0])
+        finally:
+            # The view has to be released before the block can be closed
+            del image
+            shared_image.close()
+        return TiledInference._run_tile(TiledInference.worker_processor, tile, tile_dirs, stage_methods)
+
+    @staticmethod
+    def _run_tile(processor, tile, tile_dirs, stage_methods):
+        """Run segmentation and detection on one tile and return (tile, segment JSON, detection JSON)."""
+        tile_item = (tile["name"],) + tile_dirs
+        getattr(processor, stage_methods["segmentation"])(*tile_item)
+        getattr(processor, stage_methods["detection"])(*tile_item)
+        tile_base_name = os.path.splitext(tile["name"])[0]
+        with open(os.path.join(tile_dirs[1], 'segment', f"{tile_base_name}_segment.json")) as f:
+            segment_data = json.load(f)
+        with open(os.path.join(tile_dirs[1], 'detect', f"{tile_base_name}_detection.json")) as f:
+            detection_data = json.load(f)
+        return tile, segment_data, detection_data
+
+    def _objects(self, data, kind):
+        """Return the list of "segments" or "detections" objects in a tile JSON, as named by the schema."""
+        list_key = self.schema[kind]
+        objects = data if list_key is None else data.get(list_key) if isinstance(data, dict) else None
+        if not isinstance(objects, list) or not all(isinstance(obj, dict) for obj in objects):
+            found = f"keys {sorted(data)}" if isinstance(data, dict) else type(data).__name__
+            raise ValueError(
+                f"The tile {kind} JSON has no list of objects under {list_key!r} (found {found}); "
+                f"set the tiling schema to the processor's output fields"
+            )
+        return objects
+
+    def _field(self, obj, field):
+        """Return (key, value) of a schema field of a tile object; a missing field raises ValueError."""
+        key = self.schema[field]
+        if key is None:
+            return None, None
+        if key not in obj:
+            raise ValueError(
+                f"A tile object has no {field} field {key!r} (fields {sorted(obj)}); "
+                f"set the tiling schema to the processor's output fields"
+            )
+        return key, obj[key]
+
+    def _write_json(self, path, tile_data, kind, objects, width, height):
+        """Write objects in the layout of tile_data: a plain list, or the tile's dict with its object list and size replaced."""
+        if self.schema[kind] is not None:
+            data = dict(tile_data)
+            data[self.schema[kind]] = objects
+            for field, size in (("width", width), ("height", height)):
+                if self.schema[field] in data:
+                    data[self.schema[field]] = size
+        else:
+            data = objects
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    def _merge_detections(self, tile_results, width, height):
+        """
+        Shift tile detections to plan coordinates and drop duplicates found by neighbouring tiles: per class,
+        complete boxes win over boxes cut by a tile edge, then higher scores win. A box is a duplicate when its
+        IoU with a kept box from another tile reaches nms_iou, or when nms_containment of the smaller
+        box lies inside the other (a fixture cut in half by one tile and seen whole by the next).
+        """
+        candidates = []
+        for index, (tile, data) in enumerate(tile_results):
+            for obj in self._objects(data, "detections"):
+                box_key, box = self._field(obj, "box")
+                if not isinstance(box, (list, tuple)) or len(box) < 4:
+                    raise ValueError(f"A tile detection box {box_key!r} is not [x1, y1, x2, y2]: {box!r}")
+                x1, y1, x2, y2 = box[0] + tile["x"], box[1] + tile["y"], box[2] + tile["x"], box[3] + tile["y"]
+                cut = (
+                    (tile["x"] > 0 and x1 <= tile["x"] + self.EDGE_MARGIN)
+                    or (tile["y"] > 0 and y1 <= tile["y"] + self.EDGE_MARGIN)
+                    or (tile["x"] + tile["w"] < width and x2 >= tile["x"] + tile["w"] - self.EDGE_MARGIN)
+                    or (tile["y"] + tile["h"] < height and y2 >= tile["y"] + tile["h"] - self.EDGE_MARGIN)
+                )
+                score = self._field(obj, "score")[1] or 0
+                shifted = dict(obj)
+                shifted[box_key] = [x1, y1, x2, y2] + list(box[4:])
+                candidates.append((cut, -score, index, self._field(obj, "class")[1], (x1, y1, x2, y2), shifted))
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        kept = []
+        for cut, _, index, class_name, box, obj in candidates:
+            if not any(
+                kept_index != index and kept_class == class_name and self._is_duplicate(box, kept_box)
+                for kept_index, kept_class, kept_box, _ in kept
+            ):
+                kept.append((index, class_name, box, obj))
+        return [obj for _, _, _, obj in kept]
+
+    def _is_duplicate(self, box, other):
+        inter_w = min(box[2], other[2]) - max(box[0], other[0])
+        inter_h = min(box[3], other[3]) - max(box[1], other[1])
+        if inter_w <= 0 or inter_h <= 0:
+            return False
+        intersection = inter_w * inter_h
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        other_area = (other[2] - other[0]) * (other[3] - other[1])
+        return (intersection / (area + other_area - intersection) >= self.nms_iou
+                or intersection / min(area, other_area) >= self.nms_containment)
+
+    def _stitch_segments(self, tile_results):
+        """
+        Shift tile segments to plan coordinates, keeping from each tile only what lies in its core.
+        Polygons inside the core are kept as they are; polygons crossing it are clipped, and the clipped pieces
+        of the same class that meet at a seam are joined and re-traced on a mask covering only that object.
+        """
+        import cv2
+        import numpy as np
+
+        segments = []
+        pieces = []  # (tile index, class name, template object, points key, flat, contour, bounding box)
+        for index, (tile, data) in enumerate(tile_results):
+            core_x0, core_y0, core_x1, core_y1 = tile["core"]
+            for obj in self._objects(data, "segments"):
+                points_key, points = self._field(obj, "points")
+                if not points:
+                    continue
+                flat = not isinstance(points[0], (list, tuple))
+                polygon = np.asarray(points).reshape(-1, 2) + (tile["x"], tile["y"])
+                x0, y0 = polygon.min(axis=0)
+                x1, y1 = polygon.max(axis=0)
+                if x0 >= core_x0 and y0 >= core_y0 and x1 < core_x1 and y1 < core_y1:
+                    segments.append(self._segment(obj, points_key, flat, polygon))
+                    continue
+                # Clip the polygon to the core on a mask the size of its overlap with the core
+                left, top = max(int(x0), core_x0), max(int(y0), core_y0)
+                right, bottom = min(int(np.ceil(x1)) + 1, core_x1), min(int(np.ceil(y1)) + 1, core_y1)
+                if left >= right or top >= bottom:
+                    continue
+                mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+                cv2.fillPoly(mask, [np.round(polygon - (left, top)).astype(np.int32)], 1)
+                contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                for contour in contours:
+                    contour = contour.reshape(-1, 2) + (left, top)
+                    pieces.append((index, self._field(obj, "class")[1], obj, points_key, flat, contour,
+                                   (*contour.min(axis=0), *contour.max(axis=0))))
+
+        # Join pieces of the same class from different tiles whose boxes touch across a seam
+        parents = list(range(len(pieces)))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, (index, class_name, *_, box) in enumerate(pieces):
+            for j in range(i + 1, len(pieces)):
+                other_index, other_class, *_, other_box = pieces[j]
+                if (other_index != index and other_class == class_name
+                        and box[0] <= other_box[2] + 1 and other_box[0] <= box[2] + 1
+                        and box[1] <= other_box[3] + 1 and other_box[1] <= box[3] + 1):
+                    parents[find(i)] = find(j)
+        groups = {}
+        for i in range(len(pieces)):
+            groups.setdefault(find(i), []).append(pieces[i])
+
+        for group in groups.values():
+            # The largest piece supplies the fields carried over to the stitched polygon
+            _, _, obj, points_key, flat, _, _ = max(group, key=lambda piece: cv2.contourArea(piece[5].astype(np.float32)))
+            if len(group) == 1:
+                segments.append(self._segment(obj, points_key, flat, group[0][5]))
+                continue
+            left = min(piece[6][0] for piece in group)
+            top = min(piece[6][1] for piece in group)
+            right = max(piece[6][2] for piece in group) + 1
+            bottom = max(piece[6][3] for piece in group) + 1
+            mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+            for piece in group:
+                cv2.fillPoly(mask, [(piece[5] - (left, top)).astype(np.int32)], 1)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                segments.append(self._segment(obj, points_key, flat, contour.reshape(-1, 2) + (left, top)))
+        return segments
+
+    @staticmethod
+    def _segment(obj, points_key, flat, polygon):
+        """Copy a segment object with its points replaced by polygon, in the point layout of the original."""
+        segment = dict(obj)
+        points = polygon.tolist()
+        segment[points_key] = [value for point in points for value in point] if flat else points
+        return segment
@@ -0,0 +1,80 @@
+"""
+Fixtures for the tests of the FastAPI servers and of floorplan_serving.
+
+The servers import FloorPlanProcessor from src.utils.processor, so the benchmark's stub processor is written
+there. Each test loads its own copy of a server from its temporary directory, where the server's registries,
+result logs, caches and uploads land.
+"""
+import os
+import sys
+import time
+import itertools
+import importlib.util
+
+import pytest
+
+FASTAPI_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FASTAPI_DIRECTORY)
+
+import benchmark  # noqa: E402
+
+# Gives every loaded server module its own name, so loading a server twice never reuses the first one
+server_ids = itertools.count()
+
+
+def png_bytes(payload=b""):
+    """Return a 1x1 white PNG with payload appended, so different payloads give different uploads."""
+    return benchmark.PNG_HEADER + payload
+
+
+def wait_until_ready(client, timeout=30):
+    """Poll /health/ready of a started TestClient until the models are loaded."""
+    deadline = time.monotonic() + timeout
+    while client.get("/health/ready").status_code != 200:
+        if time.monotonic() > deadline:
+            raise TimeoutError("The server did not become ready")
+        time.sleep(0.05)
+
+
+@pytest.fixture(scope="session")
+def stub_processor(tmp_path_factory):
+    """Put the benchmark's stub FloorPlanProcessor on sys.path as src.utils.processor."""
+    root = tmp_path_factory.mktemp("stub_processor")
+    package_directory = root / "src" / "utils"
+    package_directory.mkdir(parents=True)
+    (root / "src" / "__init__.py").write_text("")
+    (package_directory / "__init__.py").write_text("")
+    (package_directory / "processor.py").write_text(benchmark.STUB_PROCESSOR_SOURCE)
+    sys.path.insert(0, str(root))
+    yield root
+    sys.path.remove(str(root))
+
+
+@pytest.fixture
+def load_server(stub_processor, tmp_path, monkeypatch):
+    """
+    Return a function that imports a fresh copy of a server ("url" or "zipfile") with its working directory
+    and upload tree under tmp_path. Keyword arguments override server_engine settings before startup.
+    """
+    loaded = []
+
+    def load(server, **settings):
+        monkeypatch.chdir(tmp_path)
+        name = f"server_engine_{server}_{next(server_ids)}"
+        path = os.path.join(benchmark.SERVER_DIRECTORIES[server], "server_engine.py")
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        loaded.append(name)
+        warmup_image = tmp_path / "warmup.png"
+        warmup_image.write_bytes(png_bytes())
+        module.BASE_UPLOAD_DIRECTORY = str(tmp_path / "receive_data")
+        module.WARMUP_IMAGE_PATH = str(warmup_image)
+        for setting, value in settings.items():
+            setattr(module, setting, value)
+        return module
+
+    yield load
+    for name in loaded:
+        sys.modules.pop(name, None)
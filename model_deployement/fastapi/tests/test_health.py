@@ -0,0 +1,33 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import wait_until_ready
+
+
+@pytest.mark.parametrize("server_name", ["url", "zipfile"])
+def test_both_servers_answer_the_probes_in_the_same_shape(load_server, server_name):
+    server = load_server(server_name)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        assert client.get("/health/live").json() == {"status": "alive"}
+        assert client.get("/health").json() == {"status": "healthy"}
+        assert client.get("/health/ready").json()["status"] == "ready"
+
+        assert client.post("/drain").json()["status"] == "draining"
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json()["status"] == "not ready"
+        assert response.json()["reasons"] == ["server is draining"]
+        # Liveness stays up while draining
+        assert client.get("/health/live").status_code == 200
+
+
+@pytest.mark.parametrize("server_name", ["url", "zipfile"])
+def test_a_failed_startup_fails_liveness(load_server, server_name):
+    server = load_server(server_name)
+    with TestClient(server.app) as client:
+        server.startup_error = RuntimeError("models missing")
+        for path in ("/health/live", "/health"):
+            response = client.get(path)
+            assert response.status_code == 503
+            assert response.json() == {"status": "failed", "error": "models missing"}
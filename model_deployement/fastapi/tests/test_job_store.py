@@ -0,0 +1,97 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import wait_until_ready
+
+
+def test_sqlite_jobs_are_claimable_only_once_enqueued(load_server, tmp_path):
+    server = load_server("url")
+    store = server.SqliteJobStore(str(tmp_path / "jobs.db"))
+    job_id, created = store.create("user", "project", "1", "a.png")
+    assert created and store.get(job_id)["status"] == "pending"
+    assert store.claim("worker") is None
+
+    store.enqueue(job_id, ("image", ["user"]), "interactive")
+    assert store.get(job_id)["status"] == "queued"
+    assert store.claim("worker") == (job_id, ["image", ["user"]], "interactive")
+
+
+def test_sqlite_pending_jobs_of_a_dead_upload_are_reaped(load_server, tmp_path):
+    server = load_server("url", JOB_QUEUE_MAX_SIZE=2)
+    db_path = str(tmp_path / "jobs.db")
+    store = server.SqliteJobStore(db_path)
+    orphan_id, _ = store.create("user", "project", "1", "a.png")
+    saved_id, _ = store.create("user", "project", "1", "b.png")
+    store.enqueue(saved_id, ("image", ["user"]), "interactive")
+    # Pending jobs hold a queue slot while their upload is saved
+    assert store.create("user", "project", "1", "c.png") == (None, False)
+
+    stale = time.time() - server.JOB_PENDING_TIMEOUT_SECONDS - 1
+    store._connection().execute("UPDATE jobs SET updated_at=? WHERE job_id IN (?, ?)", (stale, orphan_id, saved_id))
+    job_id, created = store.create("user", "project", "1", "c.png")
+    assert created
+    assert store.get(orphan_id) is None
+    assert store.get(saved_id)["status"] == "queued"
+
+    # A restart deletes the stale pending jobs as well
+    store._connection().execute("UPDATE jobs SET updated_at=? WHERE job_id=?", (stale, job_id))
+    server.SqliteJobStore(db_path)
+    assert store.get(job_id) is None
+
+
+def test_zipfile_api_pods_answer_inference_stats_with_404(load_server):
+    server = load_server("zipfile", SERVER_ROLE="api", JOB_BROKER="sqlite")
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        for path in ("/batching_stats", "/scheduler_stats", "/pipeline_stats", "/cache_stats"):
+            response = client.get(path)
+            assert response.status_code == 404, (path, response.text)
+            assert response.json()["detail"] == "This server runs no inference"
+
+
+def test_zipfile_jobs_no_api_pod_waits_for_are_not_run(load_server, tmp_path):
+    server = load_server("zipfile")
+    store = server.SqliteJobStore(str(tmp_path / "jobs.db"))
+    store.enqueue(("images", ["abandoned"]), "interactive")
+    waited_id = store.enqueue(("images", ["waited"]), "interactive")
+    stale = time.time() - server.JOB_WAIT_TIMEOUT_SECONDS - 1
+    store._connection().execute("UPDATE jobs SET waited_at=?, updated_at=?", (stale, stale))
+    store.keep_waiting([waited_id])
+
+    assert store.claim("worker") == (waited_id, ["images", ["waited"]], "interactive")
+    assert store.claim("worker") is None
+    assert store._connection().execute("SELECT job_id FROM jobs").fetchall() == [(waited_id,)]
+
+
+def test_zipfile_finished_jobs_left_behind_are_deleted_after_retention(load_server, tmp_path):
+    server = load_server("zipfile")
+    store = server.SqliteJobStore(str(tmp_path / "jobs.db"))
+    old_id = store.enqueue(("images", ["old"]), "interactive")
+    recent_id = store.enqueue(("images", ["recent"]), "interactive")
+    for job_id in (old_id, recent_id):
+        store.claim("worker")
+        store.finish(job_id, "worker", result=[job_id])
+    old = time.time() - server.JOB_RETENTION_SECONDS - 1
+    store._connection().execute("UPDATE jobs SET updated_at=? WHERE job_id=?", (old, old_id))
+
+    assert store.claim("worker") is None
+    assert store.take_finished([old_id, recent_id]) == {recent_id: ("done", [recent_id], None)}
+
+
+def test_zipfile_api_pod_shutdown_deletes_its_unclaimed_jobs(load_server, tmp_path):
+    server = load_server("zipfile")
+    store = server.SqliteJobStore(str(tmp_path / "jobs.db"))
+    waiter = server.BrokeredImageProcessor(store)
+    waiter.start()
+    claimed = waiter.submit("user", "project", "1", "a", "a/original_img")
+    unclaimed = waiter.submit("user", "project", "1", "b", "b/original_img")
+    claimed_id = store.claim("worker")[0]
+    waiter.shutdown()
+
+    for future in (claimed, unclaimed):
+        with pytest.raises(RuntimeError):
+            future.result(timeout=1)
+    # The running job finishes on its worker; only the unclaimed one is deleted
+    assert store._connection().execute("SELECT job_id, status FROM jobs").fetchall() == [(claimed_id, "running")]
@@ -0,0 +1,58 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+
+FORM = {"user_id": "user", "project_number": "project", "floor_number": "1", "date": "2026"}
+
+
+def upload(client, payload=b"plan", headers=None):
+    return client.post("/receive_data", data=FORM, files={"images": ("plan.png", png_bytes(payload), "image/png")}, headers=headers)
+
+
+def test_an_upload_is_accepted_as_a_job_and_its_result_served_once_done(load_server):
+    server = load_server("url", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        response = upload(client)
+        assert response.status_code == 202, response.text
+        job_id = response.json()["job_id"]
+        assert response.json()["status_url"] == f"/jobs/{job_id}"
+        assert response.json()["result_url"] == f"/jobs/{job_id}/result"
+
+        deadline = time.monotonic() + 30
+        while (job := client.get(f"/jobs/{job_id}").json())["status"] != "done":
+            assert job["status"] in ("pending", "queued", "running"), job
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert job["user_id"] == "user" and job["image_name"].startswith("plan_")
+        result = client.get(f"/jobs/{job_id}/result")
+        assert result.status_code == 200
+        assert result.json()["message"] == "Inference results ready"
+        assert result.json()["image_name"] == job["image_name"]
+
+        assert client.get("/jobs/unknown").status_code == 404
+        assert client.get("/jobs/unknown/result").status_code == 404
+
+
+def test_a_retried_upload_gets_the_job_of_its_idempotency_key(load_server):
+    server = load_server("url", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        first = upload(client, headers={"Idempotency-Key": "upload-1"})
+        retry = upload(client, headers={"Idempotency-Key": "upload-1"})
+        other = upload(client, b"other", headers={"Idempotency-Key": "upload-2"})
+    assert first.status_code == retry.status_code == other.status_code == 202
+    assert retry.json()["job_id"] == first.json()["job_id"]
+    assert retry.json()["message"] == "Upload already accepted"
+    assert other.json()["job_id"] != first.json()["job_id"]
+
+
+def test_a_full_job_queue_answers_429(load_server):
+    server = load_server("url", JOB_QUEUE_MAX_SIZE=0)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        response = upload(client)
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "30"
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from floorplan_serving import MicroBatcher, run_image_batch
+
+
+class BatchProcessor:
+    """Records the batches it is given; fails every batch when fail_batches is set."""
+
+    def __init__(self, fail_batches=False, image_barrier=None):
+        self.fail_batches = fail_batches
+        self.image_barrier = image_barrier
+        self.batches = []
+        self.images = []
+
+    def process_batch(self, items):
+        if self.fail_batches:
+            raise RuntimeError("batch failed")
+        self.batches.append([item[0] for item in items])
+
+    def process_image(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        if self.image_barrier is not None:
+            self.image_barrier.wait(timeout=5)
+        if image_name == "broken.png":
+            raise ValueError(image_name)
+        self.images.append(image_name)
+
+
+def item(image_name):
+    return (image_name, "cropped", "json", "images")
+
+
+def test_items_submitted_together_run_as_one_batch():
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def handler(items):
+        batches.append(items)
+        started.set()
+        release.wait(timeout=5)
+        return [None if value != "bad" else ValueError(value) for value in items]
+
+    batcher = MicroBatcher(handler, max_batch_size=3, max_wait_ms=1000)
+    try:
+        first = batcher.submit("first")
+        assert started.wait(timeout=5)
+        # Items queued while a batch runs join the next batch, bulk ones after the interactive ones
+        futures = [batcher.submit(value, priority) for value, priority in
+                   [("bulk", "bulk"), ("a", "interactive"), ("bad", "interactive"), ("b", "interactive")]]
+        release.set()
+        first.result(timeout=5)
+        futures[1].result(timeout=5)
+        with pytest.raises(ValueError):
+            futures[2].result(timeout=5)
+        futures[0].result(timeout=5)
+    finally:
+        batcher.close()
+
+    assert batches == [["first"], ["a", "bad", "b"], ["bulk"]]
+    stats = batcher.stats()
+    assert stats["batches"] == 3
+    assert stats["items"] == 5
+    assert stats["batch_size_counts"] == {1: 2, 3: 1}
+
+
+def test_a_batch_waits_at_most_max_wait_ms():
+    batcher = MicroBatcher(lambda items: [None] * len(items), max_batch_size=8, max_wait_ms=20)
+    try:
+        started = time.monotonic()
+        batcher.submit("only").result(timeout=5)
+        assert time.monotonic() - started < 2
+    finally:
+        batcher.close()
+    assert batcher.stats()["batch_size_counts"] == {1: 1}
+
+
+def test_run_image_batch_uses_process_batch():
+    processor = BatchProcessor()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert run_image_batch(processor, [item("a.png"), item("b.png")], executor) == [None, None]
+        # A single image needs no batch call
+        assert run_image_batch(processor, [item("c.png")], executor) == [None]
+    assert processor.batches == [["a.png", "b.png"]]
+    assert processor.images == ["c.png"]
+
+
+def test_a_failed_batch_is_retried_concurrently_one_image_per_thread():
+    # Every image waits for the other two, so the retry only finishes if all three run at once
+    processor = BatchProcessor(fail_batches=True, image_barrier=threading.Barrier(3))
+    items = [item("a.png"), item("broken.png"), item("b.png")]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = run_image_batch(processor, items, executor)
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], ValueError)
+    assert sorted(processor.images) == ["a.png", "b.png"]
@@ -0,0 +1,52 @@
+import pytest
+
+from floorplan_serving import onnx_model_path, resolve_processor_config
+
+
+class RecordingSession:
+    """Stands in for onnxruntime.InferenceSession and keeps the options it was created with."""
+
+    def __init__(self, path_or_bytes, sess_options=None, *args, **kwargs):
+        self.path = path_or_bytes
+        self.sess_options = sess_options
+
+
+def test_onnx_model_path():
+    assert onnx_model_path("models/best_crop.pt") == "models/best_crop.onnx"
+    assert onnx_model_path("models/best_crop.pt", "int8") == "models/best_crop.int8.onnx"
+
+
+def test_the_torch_backend_keeps_the_config():
+    config = {"inference_backend": "torch", "crop_model_path": "best_crop.pt"}
+    assert resolve_processor_config(config) is config
+    with pytest.raises(ValueError):
+        resolve_processor_config({"inference_backend": "tensorrt"})
+
+
+def test_the_onnx_backend_points_at_the_exports_and_tunes_new_sessions(tmp_path, monkeypatch):
+    onnxruntime = pytest.importorskip("onnxruntime")
+    monkeypatch.setattr(onnxruntime, "InferenceSession", RecordingSession)
+    for name in ("crop.int8.onnx", "a.int8.onnx", "b.int8.onnx"):
+        (tmp_path / name).write_bytes(b"")
+    config = {
+        "inference_backend": "onnx", "onnx_quantization": "int8", "onnx_inter_op_threads": 2,
+        "crop_model_path": str(tmp_path / "crop.pt"), "detection_model_paths": [str(tmp_path / "a.pt"), str(tmp_path / "b.pt")]
+    }
+
+    resolved = resolve_processor_config(config, default_intra_op_threads=3)
+    assert resolved["crop_model_path"] == str(tmp_path / "crop.int8.onnx")
+    assert resolved["detection_model_paths"] == [str(tmp_path / "a.int8.onnx"), str(tmp_path / "b.int8.onnx")]
+    session = onnxruntime.InferenceSession("model.onnx")
+    assert isinstance(session, RecordingSession)
+    assert session.sess_options.intra_op_num_threads == 3
+    assert session.sess_options.inter_op_num_threads == 2
+    # Resolving again replaces the settings instead of stacking another subclass
+    resolve_processor_config(dict(config, onnx_intra_op_threads=1))
+    assert onnxruntime.InferenceSession.untuned_session is RecordingSession
+    assert onnxruntime.InferenceSession("model.onnx").sess_options.intra_op_num_threads == 1
+
+
+def test_missing_onnx_exports_are_reported(tmp_path):
+    with pytest.raises(FileNotFoundError) as error:
+        resolve_processor_config({"inference_backend": "onnx", "crop_model_path": str(tmp_path / "crop.pt")})
+    assert "export_onnx.py" in str(error.value)
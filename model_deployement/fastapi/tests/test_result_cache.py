@@ -0,0 +1,34 @@
+import io
+import zipfile
+
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+
+
+def upload(client, image_name, content):
+    response = client.post(
+        "/receive_data",
+        data={"user_id": "user", "project_number": "project", "floor_number": "1"},
+        files={"images": (image_name, content, "image/png")}
+    )
+    assert response.status_code == 200, response.text
+    return zipfile.ZipFile(io.BytesIO(response.content))
+
+
+def test_cache_hit_is_not_changed_by_reprocessing_the_same_name(load_server):
+    server = load_server("zipfile")
+    first, second = png_bytes(b"first"), png_bytes(b"second")
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        upload(client, "A.png", first)
+        upload(client, "B.png", first)  # Cache hit, restored from A's entry
+        upload(client, "B.png", second)  # Cache miss, processed into the folder restored above
+        archive = upload(client, "C.png", first)  # Cache hit on A's entry again
+        hits = client.get("/cache_stats").json()["hits"]
+
+    # Entries are named user/project/floor_1/<image folder>/...
+    outputs = {name.split("/", 3)[-1]: archive.read(name) for name in archive.namelist()}
+    assert outputs["C/images/C.png"] == first
+    assert outputs["C/cropped/C.png"] == first
+    assert hits == 2
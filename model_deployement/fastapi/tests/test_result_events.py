@@ -0,0 +1,59 @@
+import asyncio
+
+
+def test_a_reconnecting_client_gets_the_events_it_missed(load_server):
+    server = load_server("url")
+    events = server.ResultEventBroker(buffer_size=10)
+
+    async def scenario():
+        subscription, backlog, latest_id = events.subscribe()
+        assert backlog is None and latest_id == events.event_id(0)
+        events.unsubscribe(subscription)
+        events.publish({"seq": 1})
+        events.publish({"seq": 2})
+        subscription, backlog, latest_id = events.subscribe(events.event_id(1))
+        assert backlog == [(2, {"seq": 2})] and latest_id == events.event_id(2)
+        events.unsubscribe(subscription)
+        # An ID of another boot cannot be resumed from
+        _, backlog, _ = events.subscribe("00000000:1")
+        assert backlog is None
+
+    asyncio.run(scenario())
+
+
+def test_events_that_left_the_buffer_make_the_client_resync(load_server):
+    server = load_server("url")
+    events = server.ResultEventBroker(buffer_size=2)
+
+    async def scenario():
+        for seq in range(4):
+            events.publish({"seq": seq})
+        _, backlog, _ = events.subscribe(events.event_id(1))
+        assert backlog is None
+        _, backlog, _ = events.subscribe(events.event_id(2))
+        assert [event_id for event_id, _ in backlog] == [3, 4]
+
+    asyncio.run(scenario())
+
+
+def test_a_subscriber_that_falls_behind_gets_a_resync(load_server):
+    server = load_server("url", RESULT_EVENT_BUFFER=2)
+    events = server.ResultEventBroker()
+
+    async def scenario():
+        subscription, _, _ = events.subscribe()
+        for seq in range(3):
+            events.publish({"seq": seq})
+        await asyncio.sleep(0)
+        event_queue = subscription[1]
+        assert event_queue.get_nowait() is server.ResultEventBroker.RESYNC
+        assert event_queue.empty()
+        events.unsubscribe(subscription)
+        assert events.subscriber_count() == 0
+
+    asyncio.run(scenario())
+
+
+def test_format_sse(load_server):
+    server = load_server("url")
+    assert server.format_sse("result", "abc:1", {"seq": 1}) == 'id: abc:1\nevent: result\ndata: {"seq": 1}\n\n'
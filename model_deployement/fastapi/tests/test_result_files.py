@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import quote
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+from floorplan_serving import read_result_manifest, write_result_manifest
+
+RESULT_FOLDERS = ("json", "images")
+MANIFEST_FILENAME = "manifest.json"
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_parse_range_header(load_server):
+    parse_range_header = load_server("url").parse_range_header
+    assert parse_range_header("bytes=0-9", 100) == (0, 9)
+    assert parse_range_header("bytes=90-", 100) == (90, 99)
+    assert parse_range_header("bytes=90-500", 100) == (90, 99)
+    assert parse_range_header("bytes=-10", 100) == (90, 99)
+    assert parse_range_header("bytes=-500", 100) == (0, 99)
+    # Headers that are not a single byte range are ignored and the whole file is sent
+    for header in ("items=0-9", "bytes=0-9,20-29", "bytes=a-b", "bytes=-"):
+        assert parse_range_header(header, 100) is None
+    for header in ("bytes=100-", "bytes=50-40"):
+        with pytest.raises(HTTPException) as error:
+            parse_range_header(header, 100)
+        assert error.value.status_code == 416
+        assert error.value.headers["Content-Range"] == "bytes */100"
+
+
+def test_manifest_round_trip(tmp_path):
+    image_folder = str(tmp_path / "plan")
+    detection = os.path.join(image_folder, "json", "detect", "plan_detection.json")
+    result_image = os.path.join(image_folder, "images", "plan.png")
+    write_file(detection, b'{"detections": []}')
+    write_file(result_image, b"png")
+    write_file(os.path.join(image_folder, "original_img", "plan.png"), b"not listed")
+    result_files = {"detection_json": detection, "result_image": result_image, "oob_json": os.path.join(image_folder, "json", "oob", "plan_oob.json")}
+
+    manifest = write_result_manifest(image_folder, "plan.png", result_files, RESULT_FOLDERS, MANIFEST_FILENAME)
+    assert manifest["files"] == [
+        {"path": os.path.join("json", "detect", "plan_detection.json"), "size": 18,
+         "sha256": hashlib.sha256(b'{"detections": []}').hexdigest(), "content_type": "application/json", "key": "detection_json"},
+        {"path": os.path.join("images", "plan.png"), "size": 3,
+         "sha256": hashlib.sha256(b"png").hexdigest(), "content_type": "image/png", "key": "result_image"},
+    ]
+    assert manifest["missing"] == ["oob_json"]
+    assert read_result_manifest(image_folder, "plan.png", result_files, RESULT_FOLDERS, MANIFEST_FILENAME) == manifest
+
+
+def test_a_missing_or_foreign_manifest_is_rewritten(tmp_path):
+    image_folder = str(tmp_path / "plan")
+    result_image = os.path.join(image_folder, "images", "plan.png")
+    write_file(result_image, b"png")
+    result_files = {"result_image": result_image}
+    manifest_path = os.path.join(image_folder, MANIFEST_FILENAME)
+
+    manifest = read_result_manifest(image_folder, "plan.png", result_files, RESULT_FOLDERS, MANIFEST_FILENAME)
+    assert [entry["key"] for entry in manifest["files"]] == ["result_image"]
+    with open(manifest_path) as f:
+        assert json.load(f) == manifest
+
+    with open(manifest_path, "w") as f:
+        json.dump({"image_name": "other.png", "files": [], "missing": []}, f)
+    assert read_result_manifest(image_folder, "plan.png", result_files, RESULT_FOLDERS, MANIFEST_FILENAME)["files"] == manifest["files"]
+    assert read_result_manifest(str(tmp_path / "removed"), "plan.png", result_files, RESULT_FOLDERS, MANIFEST_FILENAME) is None
+
+
+def process_upload(client, user_id, image_name, data):
+    """Upload an image, wait for its job and return the result files listed for it."""
+    response = client.post(
+        "/receive_data",
+        data={"user_id": user_id, "project_number": "project", "floor_number": "1", "date": "2026"},
+        files={"images": (image_name, data, "image/png")}
+    )
+    assert response.status_code == 202, response.text
+    deadline = time.monotonic() + 30
+    while client.get(f"/jobs/{response.json()['job_id']}").json()["status"] != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    return client.get(f"/get_inference_results/{quote(user_id, safe='')}").json()["results"][-1]["files"]
+
+
+def test_result_files_are_served_from_the_manifest(load_server):
+    server = load_server("url", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        files = process_upload(client, "user", "plan.png", png_bytes(b"plan"))
+        original = files["original_image"]
+        download = client.get(original["url"])
+        assert download.status_code == 200
+        assert download.content == png_bytes(b"plan")
+        assert download.headers["etag"] == original["etag"] == f'"{hashlib.sha256(download.content).hexdigest()}"'
+        assert int(download.headers["content-length"]) == original["size"]
+
+        assert client.get(original["url"], headers={"If-None-Match": original["etag"]}).status_code == 304
+        partial = client.get(original["url"], headers={"Range": "bytes=8-"})
+        assert partial.status_code == 206
+        assert partial.content == download.content[8:]
+        assert partial.headers["content-range"] == f"bytes 8-{original['size'] - 1}/{original['size']}"
+        # A Range for an older version of the file gets the whole current file
+        assert client.get(original["url"], headers={"Range": "bytes=8-", "If-Range": '"old"'}).status_code == 200
+        assert client.get(original["url"].rsplit("/", 1)[0] + "/unknown").status_code == 404
+
+
+def test_result_file_urls_are_percent_encoded(load_server):
+    server = load_server("url", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        files = process_upload(client, "user #1", "plan 100%.png", png_bytes(b"plan"))
+        url = files["original_image"]["url"]
+        assert url.startswith("/files/user%20%231/project/1/plan%20100%25_")
+        assert client.get(url).content == png_bytes(b"plan")
+
+
+def test_a_file_changed_after_its_manifest_is_served_as_it_is_now(load_server):
+    server = load_server("url", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        original = process_upload(client, "user", "plan.png", png_bytes(b"plan"))["original_image"]
+        image_name = original["url"].split("/")[-2]
+        file_path = server.result_file_paths("user", "project", "1", image_name)["original_image"]
+        with open(file_path, "ab") as f:
+            f.write(b"appended")
+
+        download = client.get(original["url"])
+        assert download.content == png_bytes(b"planappended")
+        assert int(download.headers["content-length"]) == len(download.content)
+        assert download.headers["etag"] == f'"{hashlib.sha256(download.content).hexdigest()}"' != original["etag"]
+        assert client.get(original["url"], headers={"If-None-Match": original["etag"]}).status_code == 200
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+from floorplan_serving import ResultLog, SqliteResultLog
+
+
+def append_results(log, user_id, count):
+    return [log.append(user_id, {"image_name": f"{index}.png"}) for index in range(count)]
+
+
+def segment_files(directory, user_id):
+    return sorted(name for name in os.listdir(os.path.join(directory, user_id)) if name.endswith(".jsonl"))
+
+
+def test_pages_follow_the_cursor_and_ack_removes_results(tmp_path):
+    log = ResultLog(str(tmp_path), fsync=False)
+    assert append_results(log, "user", 5) == [1, 2, 3, 4, 5]
+
+    page = log.read("user", limit=2)
+    assert [result["seq"] for result in page["results"]] == [1, 2]
+    assert page["next_cursor"] == 2 and page["has_more"]
+    assert [result["seq"] for result in log.read("user", cursor=2, limit=10)["results"]] == [3, 4, 5]
+
+    assert log.ack("user", 2) == 2
+    assert log.ack("user", 2) == 0
+    assert [result["seq"] for result in log.read("user")["results"]] == [3, 4, 5]
+    # The acknowledged cursor and the sequence numbers survive a restart
+    reloaded = ResultLog(str(tmp_path), fsync=False)
+    assert [result["seq"] for result in reloaded.read("user")["results"]] == [3, 4, 5]
+    assert reloaded.append("user", {"image_name": "next.png"}) == 6
+
+
+def test_acknowledged_segments_are_deleted_and_the_oldest_is_compacted(tmp_path):
+    # Every segment holds three results
+    log = ResultLog(str(tmp_path), segment_bytes=90, fsync=False)
+    append_results(log, "user", 9)
+    assert segment_files(str(tmp_path), "user") == ["000000000001.jsonl", "000000000004.jsonl", "000000000007.jsonl"]
+
+    log.ack("user", 3)
+    assert segment_files(str(tmp_path), "user") == ["000000000004.jsonl", "000000000007.jsonl"]
+
+    segment_path = os.path.join(str(tmp_path), "user", "000000000004.jsonl")
+    size = os.path.getsize(segment_path)
+    log.ack("user", 4)
+    assert os.path.getsize(segment_path) == size
+    log.ack("user", 5)
+    # More than half of segment 4 is acknowledged, so it is rewritten with its pending line only
+    assert os.path.getsize(segment_path) < size
+    assert [result["seq"] for result in log.read("user")["results"]] == [6, 7, 8, 9]
+    assert [result["seq"] for result in ResultLog(str(tmp_path), fsync=False).read("user")["results"]] == [6, 7, 8, 9]
+
+
+def test_a_line_cut_short_by_a_crash_is_truncated_on_load(tmp_path):
+    log = ResultLog(str(tmp_path), fsync=False)
+    append_results(log, "user", 2)
+    with open(os.path.join(str(tmp_path), "user", "000000000001.jsonl"), "ab") as f:
+        f.write(b'{"image_name": "torn.png", "se')
+
+    reloaded = ResultLog(str(tmp_path), fsync=False)
+    assert [result["seq"] for result in reloaded.read("user")["results"]] == [1, 2]
+    assert reloaded.append("user", {"image_name": "next.png"}) == 3
+    assert [result["image_name"] for result in reloaded.read("user")["results"]] == ["0.png", "1.png", "next.png"]
+
+
+def test_concurrent_appends_share_fsyncs(tmp_path, monkeypatch):
+    synced = []
+    fsync_path = ResultLog._fsync_path
+
+    def slow_fsync_path(path):
+        time.sleep(0.02)
+        synced.append(path)
+        fsync_path(path)
+
+    monkeypatch.setattr(ResultLog, "_fsync_path", staticmethod(slow_fsync_path))
+    log = ResultLog(str(tmp_path), fsync=True)
+    seqs = []
+    threads = [threading.Thread(target=lambda: seqs.append(log.append("user", {}))) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(seqs) == list(range(1, 21))
+    # One sync of the segment (and, the first time, of its directories) per group instead of one per append
+    assert len(synced) < 20
+
+
+def test_trim_keeps_the_newest_results_and_waits_for_the_slack(tmp_path):
+    log = ResultLog(str(tmp_path), fsync=False)
+    append_results(log, "user", 10)
+    assert log.trim("user", 3, slack=2) == 7
+    assert [result["seq"] for result in log.read("user")["results"]] == [8, 9, 10]
+
+    append_results(log, "user", 2)
+    assert log.trim("user", 3, slack=2) == 0
+    append_results(log, "user", 1)
+    assert log.trim("user", 3, slack=2) == 3
+    assert [result["seq"] for result in log.read("user")["results"]] == [11, 12, 13]
+    assert log.trim("unknown", 3) == 0
+
+
+def test_sqlite_result_log_trim_keeps_the_newest_results(tmp_path):
+    log = SqliteResultLog(str(tmp_path / "jobs.db"))
+    append_results(log, "user", 10)
+    assert log.trim("user", 3, slack=2) == 7
+    assert [result["seq"] for result in log.read("user")["results"]] == [8, 9, 10]
+    append_results(log, "user", 2)
+    assert log.trim("user", 3, slack=2) == 0
+    assert log.trim("unknown", 3) == 0
+
+
+def test_zipfile_server_keeps_the_newest_results_per_user(load_server):
+    server = load_server("zipfile", RESULTS_KEEP_PER_USER=2, RESULTS_TRIM_STEP=0, RESULTS_FSYNC=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        for index in range(3):
+            response = client.post(
+                "/receive_data",
+                data={"user_id": "user", "project_number": "project", "floor_number": "1"},
+                files={"images": (f"{index}.png", png_bytes(str(index).encode()), "image/png")}
+            )
+            assert response.status_code == 200, response.text
+        results = server.InferenceManager.get_result_log().read("user")["results"]
+    assert [result["image_name"] for result in results] == ["1.png", "2.png"]
@@ -0,0 +1,41 @@
+import logging
+import os
+import time
+
+from floorplan_serving import ArtifactRetention
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(bytes(size))
+
+
+def test_a_missing_upload_tree_is_indexed_as_empty(tmp_path, caplog):
+    retention = ArtifactRetention(str(tmp_path / "receive_data"), str(tmp_path / "artifacts.db"))
+    with caplog.at_level(logging.INFO, logger="floorplan_serving"):
+        retention._index_existing_folders()
+    assert retention.stats()["folders"] == 0
+    assert not [record for record in caplog.records if record.levelno >= logging.WARNING]
+    assert "Indexed 0 existing request folders" in caplog.text
+
+
+def test_existing_folders_are_indexed_and_old_ones_swept(tmp_path):
+    base_directory = str(tmp_path / "receive_data")
+    old_folder = os.path.join(base_directory, "user", "project", "floor_1", "old")
+    new_folder = os.path.join(base_directory, "user", "project", "floor_1", "new")
+    write_file(os.path.join(old_folder, "original_img", "old.png"), 100)
+    write_file(os.path.join(new_folder, "original_img", "new.png"), 50)
+    write_file(os.path.join(base_directory, "legacy.zip"), 10)
+    long_ago = time.time() - 2 * 24 * 60 * 60
+    os.utime(old_folder, (long_ago, long_ago))
+    deleted = []
+    retention = ArtifactRetention(base_directory, str(tmp_path / "artifacts.db"), on_delete=deleted.extend,
+                                  max_age_seconds=24 * 60 * 60, min_age_seconds=0)
+
+    retention._index_existing_folders()
+    assert retention.stats()["folders"] == 3
+    assert retention.stats()["size_bytes"] == 160
+    assert retention.sweep() == 1
+    assert not os.path.exists(old_folder) and os.path.exists(new_folder)
+    assert deleted == [("user", "project", "1", "old.png")]
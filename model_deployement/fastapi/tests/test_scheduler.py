@@ -0,0 +1,114 @@
+import threading
+
+from floorplan_serving import FairScheduler
+
+
+class Recorder:
+    """Jobs that record their start and wait until released, so the test decides when workers free up."""
+
+    def __init__(self):
+        self.started = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+        self._count = threading.Condition(self._lock)
+
+    def job(self, name):
+        with self._lock:
+            self.started.append(name)
+            self._count.notify_all()
+        self.release.wait(5)
+        return name
+
+    def wait_for(self, count):
+        with self._lock:
+            assert self._count.wait_for(lambda: len(self.started) >= count, 5), self.started
+
+
+def run_in_order(scheduler, requests):
+    """Queue requests behind a blocking one on a single worker and return the order they ran in."""
+    order = []
+    gate = threading.Event()
+    blocker = scheduler.submit(gate.wait, 5, user_id="blocker", project_number="p")
+    futures = [
+        scheduler.submit(order.append, name, user_id=user_id, project_number=project_number, priority=priority)
+        for name, user_id, project_number, priority in requests
+    ]
+    gate.set()
+    for future in [blocker] + futures:
+        future.result(timeout=5)
+    return order
+
+
+def test_users_and_their_projects_take_turns():
+    scheduler = FairScheduler(max_workers=1, reserved_interactive=0)
+    try:
+        order = run_in_order(scheduler, [
+            ("a1", "a", "p1", "interactive"),
+            ("a2", "a", "p1", "interactive"),
+            ("a3", "a", "p2", "interactive"),
+            ("b1", "b", "p1", "interactive"),
+        ])
+    finally:
+        scheduler.shutdown()
+    # A user flooding the queue does not hold back the next user, and their second project gets its turn early
+    assert order == ["a1", "b1", "a3", "a2"]
+
+
+def test_interactive_requests_run_before_bulk_ones():
+    scheduler = FairScheduler(max_workers=1, reserved_interactive=0)
+    try:
+        order = run_in_order(scheduler, [
+            ("bulk1", "a", "p", "bulk"),
+            ("bulk2", "b", "p", "bulk"),
+            ("interactive", "c", "p", "interactive"),
+        ])
+    finally:
+        scheduler.shutdown()
+    assert order == ["interactive", "bulk1", "bulk2"]
+
+
+def test_bulk_requests_leave_the_reserved_workers_to_interactive_ones():
+    scheduler = FairScheduler(max_workers=2, reserved_interactive=1, max_running_per_user=5)
+    recorder = Recorder()
+    try:
+        futures = [scheduler.submit(recorder.job, f"bulk{index}", user_id="a", priority="bulk") for index in range(2)]
+        recorder.wait_for(1)
+        futures.append(scheduler.submit(recorder.job, "interactive", user_id="b", priority="interactive"))
+        recorder.wait_for(2)
+        assert recorder.started == ["bulk0", "interactive"]
+        assert scheduler.stats()["classes"]["bulk"]["queued"] == 1
+        recorder.release.set()
+        assert [future.result(timeout=5) for future in futures] == ["bulk0", "bulk1", "interactive"]
+    finally:
+        recorder.release.set()
+        scheduler.shutdown()
+
+
+def test_a_user_runs_at_most_max_running_per_user_requests():
+    scheduler = FairScheduler(max_workers=3, reserved_interactive=0, max_running_per_user=1)
+    recorder = Recorder()
+    try:
+        futures = [scheduler.submit(recorder.job, f"a{index}", user_id="a") for index in range(2)]
+        futures.append(scheduler.submit(recorder.job, "b0", user_id="b"))
+        recorder.wait_for(2)
+        assert sorted(recorder.started) == ["a0", "b0"]
+        assert scheduler.stats()["classes"]["interactive"]["queued"] == 1
+        recorder.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        assert recorder.started[-1] == "a1"
+    finally:
+        recorder.release.set()
+        scheduler.shutdown()
+
+
+def test_queue_times_over_the_slo_are_counted():
+    scheduler = FairScheduler(max_workers=1, queue_slo_seconds={"interactive": 0, "bulk": 60})
+    try:
+        run_in_order(scheduler, [("a", "a", "p", "interactive"), ("b", "b", "p", "bulk")])
+        classes = scheduler.stats()["classes"]
+    finally:
+        scheduler.shutdown()
+    # The blocking request may start at once, the one queued behind it cannot
+    assert classes["interactive"]["started"] == 2 and classes["interactive"]["slo_misses"] >= 1
+    assert classes["bulk"]["started"] == 1 and classes["bulk"]["slo_misses"] == 0
@@ -0,0 +1,96 @@
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+from floorplan_serving import StagedPipeline, check_stage_methods
+
+STAGE_METHODS = {"crop": "crop_background", "segmentation": "segment", "detection": "detect", "oob": "detect_oob"}
+
+
+def stub_processor_class():
+    from src.utils.processor import FloorPlanProcessor
+    return FloorPlanProcessor
+
+
+class ProcessImageOnly:
+    """A processor that only runs whole images, like one without the stage methods."""
+
+    def __init__(self, config):
+        self._processor = stub_processor_class()(config)
+
+    def process_image(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+        self._processor.process_image(image_name, crop_image_dir, save_json_dir, save_image_dir)
+
+
+def wait_for_job(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+def upload(client):
+    response = client.post(
+        "/receive_data",
+        data={"user_id": "user", "project_number": "project", "floor_number": "1", "date": "2026"},
+        files={"images": ("plan.png", png_bytes(os.urandom(8)), "image/png")}
+    )
+    assert response.status_code == 202, response.text
+    return wait_for_job(client, response.json()["job_id"])
+
+
+def test_pipeline_runs_the_stages_in_order_with_parallel_steps():
+    calls = []
+    pipeline = StagedPipeline([
+        ("first", [("a", lambda item: calls.append(("a", item)))]),
+        ("second", [("b", lambda item: calls.append(("b", item))), ("c", lambda item: calls.append(("c", item)))]),
+    ])
+    try:
+        for item in range(3):
+            pipeline.submit(item).result(timeout=5)
+        for item in range(3):
+            steps = [step for step, called_item in calls if called_item == item]
+            assert steps[0] == "a" and sorted(steps[1:]) == ["b", "c"]
+        assert pipeline.stats()["steps"]["b"]["count"] == 3
+    finally:
+        pipeline.close()
+
+
+def test_stage_methods_are_checked_against_the_outputs_of_each_stage(stub_processor):
+    processor_class = stub_processor_class()
+    assert check_stage_methods(processor_class({}), STAGE_METHODS) == []
+    assert check_stage_methods(ProcessImageOnly({}), STAGE_METHODS) == [
+        "no crop_background method", "no segment method", "no detect method", "no detect_oob method"
+    ]
+
+    class MisplacedDetections(processor_class):
+        def detect(self, image_name, crop_image_dir, save_json_dir, save_image_dir):
+            self._write_json(os.path.join(save_json_dir, "detections.json"), {"detections": []})
+
+    assert check_stage_methods(MisplacedDetections({}), STAGE_METHODS) == [
+        f"detect did not write {os.path.join('save_json_dir', 'detect', 'stage_check_detection.json')}"
+    ]
+
+
+def test_staged_server_uses_the_pipeline_when_the_stage_methods_work(load_server):
+    server = load_server("url", INFERENCE_PIPELINE="staged", RESULT_CACHE_ENABLED=False)
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        assert server.image_pipeline is not None
+        assert upload(client)["status"] == "done"
+        assert server.image_pipeline.stats()["steps"]["crop"]["count"] == 1
+
+
+def test_staged_server_falls_back_to_process_image(load_server):
+    server = load_server("url", INFERENCE_PIPELINE="staged", RESULT_CACHE_ENABLED=False)
+    server.FloorPlanProcessor = ProcessImageOnly
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        assert server.image_pipeline is None
+        assert upload(client)["status"] == "done"
+        # ProcessImageOnly has no process_batch, so its images run on the inference threads
+        assert server.image_batcher.stats()["items"] == 0
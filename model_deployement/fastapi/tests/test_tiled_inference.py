@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from floorplan_serving import TiledInference
+
+
+@pytest.fixture
+def tiled():
+    tiled = TiledInference(None, {}, tile_size=100, overlap=40, min_image_size=100, workers=1)
+    yield tiled
+    tiled.close()
+
+
+def two_tiles(tiled):
+    """Return the two tiles side by side of a 160x100 plan: x 0-100 and 60-160, with cores meeting at x=80."""
+    return [
+        {"name": f"tile_0_{col}.png", "x": x, "y": 0, "w": w, "h": 100, "core": (core_x0, 0, core_x1, 100)}
+        for col, (x, w, core_x0, core_x1) in enumerate(tiled._axis(160))
+    ]
+
+
+def detection(class_name, box, score):
+    return {"class_name": class_name, "bbox": box, "score": score}
+
+
+def test_tile_cores_cover_the_plan_once(tiled):
+    axis = tiled._axis(250)
+    assert [(start, size) for start, size, _, _ in axis] == [(0, 100), (60, 100), (120, 100), (150, 100)]
+    assert [core for _, _, *core in axis] == [[0, 80], [80, 140], [140, 185], [185, 250]]
+    assert tiled._axis(80) == [(0, 80, 0, 80)]
+
+
+def test_a_detection_seen_by_both_tiles_is_kept_once_from_the_tile_seeing_it_whole(tiled):
+    left, right = two_tiles(tiled)
+    results = [
+        # Cut by the right edge of the left tile, with a higher score than the complete box of the right tile
+        (left, {"detections": [detection("door", [70, 10, 100, 30], 0.9), detection("window", [10, 10, 20, 20], 0.5)]}),
+        (right, {"detections": [detection("door", [10, 10, 40, 30], 0.6), detection("sink", [10, 10, 40, 30], 0.7)]}),
+    ]
+    merged = tiled._merge_detections(results, 160, 100)
+    assert sorted((obj["class_name"], obj["bbox"], obj["score"]) for obj in merged) == [
+        ("door", [70, 10, 100, 30], 0.6),
+        ("sink", [70, 10, 100, 30], 0.7),
+        ("window", [10, 10, 20, 20], 0.5),
+    ]
+
+
+def test_overlapping_detections_of_the_same_tile_are_not_merged(tiled):
+    left, _ = two_tiles(tiled)
+    results = [(left, {"detections": [detection("chair", [10, 10, 30, 30], 0.9), detection("chair", [12, 12, 30, 30], 0.8)]})]
+    assert len(tiled._merge_detections(results, 160, 100)) == 2
+
+
+def test_a_box_mostly_inside_a_larger_one_is_a_duplicate(tiled):
+    assert tiled._is_duplicate((0, 0, 10, 10), (0, 0, 10, 10))
+    assert tiled._is_duplicate((0, 0, 10, 10), (0, 0, 40, 40))  # IoU 0.06, but the smaller box lies inside
+    assert not tiled._is_duplicate((0, 0, 10, 10), (8, 0, 18, 10))
+    assert not tiled._is_duplicate((0, 0, 10, 10), (10, 0, 20, 10))
+
+
+def test_a_segment_crossing_the_seam_is_stitched_into_one_polygon(tiled):
+    left, right = two_tiles(tiled)
+    room = [[50, 20], [90, 20], [90, 60], [50, 60]]  # Plan coordinates, across the seam at x=80
+    results = [
+        (left, {"segments": [{"class_name": "room", "points": [[x - left["x"], y] for x, y in room]}]}),
+        (right, {"segments": [{"class_name": "room", "points": [[x - right["x"], y] for x, y in room]},
+                              {"class_name": "wall", "points": [[30, 5], [35, 5], [35, 8], [30, 8]]}]}),
+    ]
+    segments = tiled._stitch_segments(results)
+    assert sorted(segment["class_name"] for segment in segments) == ["room", "wall"]
+    room_points = next(segment["points"] for segment in segments if segment["class_name"] == "room")
+    xs, ys = [x for x, _ in room_points], [y for _, y in room_points]
+    assert (min(xs), min(ys), max(xs), max(ys)) == (50, 20, 90, 60)
+    wall_points = next(segment["points"] for segment in segments if segment["class_name"] == "wall")
+    assert wall_points == [[90, 5], [95, 5], [95, 8], [90, 8]]
+
+
+def test_tile_json_without_the_schema_fields_fails_loudly(tiled):
+    left, _ = two_tiles(tiled)
+    with pytest.raises(ValueError, match="'detections'.*found keys \\['objects'\\]"):
+        tiled._merge_detections([(left, {"objects": []})], 160, 100)
+    with pytest.raises(ValueError, match="no box field 'bbox'.*'xyxy'"):
+        tiled._merge_detections([(left, {"detections": [{"class_name": "door", "xyxy": [0, 0, 1, 1], "score": 1}]})], 160, 100)
+
+
+def test_the_processor_declares_its_output_schema(tmp_path):
+    class Processor:
+        OUTPUT_SCHEMA = {"detections": None, "class": "label", "box": "xyxy", "score": None}
+
+    tiled = TiledInference(Processor(), {}, tile_size=100, overlap=40, workers=1, schema={"box": "box"})
+    try:
+        left, right = two_tiles(tiled)
+        results = [(left, [{"label": "door", "xyxy": [70, 10, 100, 30]}]), (right, [{"label": "door", "xyxy": [10, 10, 40, 30]}])]
+        merged = tiled._merge_detections(results, 160, 100)
+        assert merged == [{"label": "door", "xyxy": [70, 10, 100, 30]}]
+
+        path = tmp_path / "detect" / "plan_detection.json"
+        tiled._write_json(str(path), results[0][1], "detections", merged, 160, 100)
+        assert json.loads(path.read_text()) == merged
+        tiled._write_json(str(path), {"width": 100, "segments": []}, "segments", [], 160, 100)
+        assert json.loads(path.read_text()) == {"width": 160, "segments": []}
+    finally:
+        tiled.close()
+
+
+def test_tile_renders_are_stitched_into_the_result_image_by_their_cores(tiled, tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    import numpy as np
+
+    left, right = two_tiles(tiled)
+    tile_image_dir = tmp_path / "tiles"
+    tile_image_dir.mkdir()
+    cv2.imwrite(str(tile_image_dir / left["name"]), np.full((100, 100, 3), 50, dtype=np.uint8))
+    cv2.imwrite(str(tile_image_dir / right["name"]), np.full((100, 100, 3), 200, dtype=np.uint8))
+    path = tmp_path / "images" / "plan.png"
+
+    assert tiled._stitch_result_image([left, right], str(tile_image_dir), 160, 100, str(path))
+    stitched = cv2.imread(str(path))
+    assert stitched.shape == (100, 160, 3)
+    assert (stitched[:, :80] == 50).all() and (stitched[:, 80:] == 200).all()
+
+
+def test_no_result_image_is_stitched_unless_every_tile_rendered_one(tiled, tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    import numpy as np
+
+    left, right = two_tiles(tiled)
+    cv2.imwrite(str(tmp_path / left["name"]), np.zeros((100, 100, 3), dtype=np.uint8))
+    path = tmp_path / "images" / "plan.png"
+    assert not tiled._stitch_result_image([left, right], str(tmp_path), 160, 100, str(path))
+    assert not path.exists()
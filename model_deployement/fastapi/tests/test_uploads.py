@@ -0,0 +1,104 @@
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from conftest import png_bytes, wait_until_ready
+from floorplan_serving import duplicate_base_names, extract_archive_images
+
+EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def write_archive(path, entries, compression=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, "w", compression) as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+def extract(tmp_path, entries, max_images=10, max_bytes=1024, compression=zipfile.ZIP_STORED):
+    destination = tmp_path / "extracted"
+    destination.mkdir()
+    archive_path = write_archive(tmp_path / "upload.zip", entries, compression)
+    return extract_archive_images(archive_path, str(destination), max_images, max_bytes, EXTENSIONS, chunk_size=64)
+
+
+def test_archive_folders_are_flattened_and_other_files_skipped(tmp_path):
+    names = extract(tmp_path, {
+        "floor/a.png": b"a",
+        "floor/sub/B.JPG": b"b",
+        "floor/notes.txt": b"notes",
+        "__MACOSX/floor/._a.png": b"fork",
+        "floor/._c.png": b"fork",
+    })
+    assert names == ["a.png", "B.JPG"]
+    assert sorted(os.listdir(tmp_path / "extracted")) == ["B.JPG", "a.png"]
+
+
+def test_archive_entries_cannot_escape_the_destination(tmp_path):
+    names = extract(tmp_path, {"../../escaped.png": b"x", "/absolute/root.png": b"y"})
+    assert names == ["escaped.png", "root.png"]
+    assert sorted(os.listdir(tmp_path / "extracted")) == ["escaped.png", "root.png"]
+    assert sorted(os.listdir(tmp_path)) == ["extracted", "upload.zip"]
+
+
+def test_a_zip_bomb_is_stopped_at_the_extracted_size_limit(tmp_path):
+    # 1 MB of zeros compresses to about 1 KB, but may only extract to max_bytes
+    with pytest.raises(HTTPException) as error:
+        extract(tmp_path, {"bomb.png": bytes(1024 * 1024)}, max_bytes=4096, compression=zipfile.ZIP_DEFLATED)
+    assert error.value.status_code == 413
+    assert os.path.getsize(tmp_path / "extracted" / "bomb.png") <= 4096
+
+
+def test_an_archive_with_too_many_images_is_rejected(tmp_path):
+    with pytest.raises(HTTPException) as error:
+        extract(tmp_path, {f"{index}.png": b"x" for index in range(3)}, max_images=2)
+    assert error.value.status_code == 413
+    assert os.listdir(tmp_path / "extracted") == []
+
+
+def test_images_flattened_to_the_same_name_are_rejected(tmp_path):
+    with pytest.raises(HTTPException) as error:
+        extract(tmp_path, {"a/plan.png": b"x", "b/plan.png": b"y"})
+    assert error.value.status_code == 400
+
+
+def test_a_file_that_is_not_a_zip_archive_is_rejected(tmp_path):
+    archive_path = tmp_path / "upload.zip"
+    archive_path.write_bytes(b"not a zip")
+    with pytest.raises(HTTPException) as error:
+        extract_archive_images(str(archive_path), str(tmp_path), 10, 1024, EXTENSIONS)
+    assert error.value.status_code == 400
+
+
+def test_duplicate_base_names():
+    assert duplicate_base_names(["plan.png", "plan.jpg", "other.png", "Plan.jpeg"]) == ["plan"]
+    assert duplicate_base_names(["a.png", "b.png"]) == []
+
+
+@pytest.mark.parametrize("server_name", ["url", "zipfile"])
+def test_a_batch_with_images_sharing_a_folder_name_is_rejected(load_server, tmp_path, server_name):
+    server = load_server(server_name)
+    form = {"user_id": "user", "project_number": "project", "floor_number": "1"}
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zipped:
+        zipped.writestr("floor/plan.jpg", png_bytes(b"archive"))
+    with TestClient(server.app) as client:
+        wait_until_ready(client)
+        # plan.png and plan.jpg would both be stored in the folder named after "plan"
+        response = client.post("/receive_batch", data=form, files=[
+            ("images", ("plan.png", png_bytes(b"a"), "image/png")),
+            ("images", ("plan.jpg", png_bytes(b"b"), "image/jpeg")),
+        ])
+        assert response.status_code == 400, response.text
+        assert "plan" in response.json()["detail"]
+        response = client.post("/receive_batch", data=form, files=[
+            ("images", ("plan.png", png_bytes(b"a"), "image/png")),
+            ("archive", ("floor.zip", archive.getvalue(), "application/zip")),
+        ])
+        assert response.status_code == 400, response.text
+    floor_directory = os.path.join(server.BASE_UPLOAD_DIRECTORY, "user", "project", "floor_1")
+    assert not os.path.isdir(floor_directory) or os.listdir(floor_directory) == []